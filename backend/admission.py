@@ -0,0 +1,227 @@
+"""
+Admission control for database-bound routes.
+
+At most ADMISSION_MAX_CONCURRENCY requests run at once (kept below the
+database pool size so background work still gets connections); the rest
+wait in a queue bounded by ADMISSION_QUEUE_LIMIT. Requests have a priority
+class: interactive (the UI's reads and edits), export (NDJSON streams) and
+batch (fan-out and maintenance jobs). A freed slot goes to the oldest waiter
+of the highest class that is below its own concurrency limit, so exports
+and batch jobs can never take all the slots or delay an interactive request
+already waiting.
+
+Overload is answered at once rather than with a timeout: 429 when the
+queue is full and nothing of lower priority is waiting to make room, 503
+when a request waited ADMISSION_QUEUE_TIMEOUT_MS without a slot or was
+pushed out of a full queue by a higher class. Both carry Retry-After,
+estimated from the queue length and recent service times.
+
+The limits are per worker; with several uvicorn workers the database sees
+up to workers x ADMISSION_MAX_CONCURRENCY requests.
+"""
+
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', '64'))
+ADMISSION_EXPORT_CONCURRENCY = int(os.environ.get('ADMISSION_EXPORT_CONCURRENCY', '8'))
+ADMISSION_BATCH_CONCURRENCY = int(os.environ.get('ADMISSION_BATCH_CONCURRENCY', '4'))
+ADMISSION_QUEUE_LIMIT = int(os.environ.get('ADMISSION_QUEUE_LIMIT', '256'))
+ADMISSION_QUEUE_TIMEOUT_MS = int(os.environ.get('ADMISSION_QUEUE_TIMEOUT_MS', '2000'))
+
+# Highest priority first
+PRIORITY_CLASSES = ("interactive", "export", "batch")
+
+RETRY_AFTER_MAX_SECONDS = 60
+
+
+class Overloaded(Exception):
+
+    def __init__(self, status_code: int, retry_after: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class AdmissionController:
+
+    def __init__(self, max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+                 class_limits: Optional[Dict[str, int]] = None,
+                 queue_limit: int = ADMISSION_QUEUE_LIMIT,
+                 queue_timeout_ms: int = ADMISSION_QUEUE_TIMEOUT_MS):
+        self.max_concurrency = max_concurrency
+        self.class_limits = {
+            "interactive": max_concurrency,
+            "export": ADMISSION_EXPORT_CONCURRENCY,
+            "batch": ADMISSION_BATCH_CONCURRENCY,
+            **(class_limits or {}),
+        }
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout_ms / 1000
+        self.active = 0
+        self._active: Dict[str, int] = {c: 0 for c in PRIORITY_CLASSES}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {c: deque() for c in PRIORITY_CLASSES}
+        # Moving average of how long a request of each class holds its slot
+        self._service_seconds: Dict[str, float] = {c: 0.1 for c in PRIORITY_CLASSES}
+        # admitted: got a slot (queued: after waiting); rejected: 429;
+        # timed_out and evicted: 503
+        self.stats = {
+            c: {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0, "evicted": 0}
+            for c in PRIORITY_CLASSES
+        }
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _can_start(self, priority_class: str) -> bool:
+        return self.active < self.max_concurrency and \
+            self._active[priority_class] < self.class_limits[priority_class]
+
+    def _start(self, priority_class: str) -> None:
+        self.active += 1
+        self._active[priority_class] += 1
+        self.stats[priority_class]["admitted"] += 1
+
+    def _dispatch(self) -> None:
+        """Hand free slots to waiters, highest class first"""
+        for priority_class in PRIORITY_CLASSES:
+            waiters = self._waiters[priority_class]
+            while waiters and self._can_start(priority_class):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self._start(priority_class)
+                    waiter.set_result(None)
+
+    def retry_after(self, priority_class: str) -> int:
+        """Seconds until the queue ahead of a new request has likely cleared"""
+        slots = max(min(self.max_concurrency, self.class_limits[priority_class]), 1)
+        ahead = self.queued + 1
+        seconds = math.ceil(ahead * self._service_seconds[priority_class] / slots)
+        return min(max(seconds, 1), RETRY_AFTER_MAX_SECONDS)
+
+    def _evict_below(self, priority_class: str) -> bool:
+        """Push the newest waiter of a lower class out of the queue"""
+        rank = PRIORITY_CLASSES.index(priority_class)
+        for lower in reversed(PRIORITY_CLASSES[rank + 1:]):
+            if self._waiters[lower]:
+                waiter = self._waiters[lower].pop()
+                self.stats[lower]["evicted"] += 1
+                waiter.set_exception(Overloaded(
+                    503, self.retry_after(lower), "Server busy, request shed for higher priority work",
+                ))
+                return True
+        return False
+
+    async def acquire(self, priority_class: str) -> None:
+        """Wait for a slot; raises Overloaded when none can be had"""
+        if self._can_start(priority_class) and not self._waiters[priority_class]:
+            self._start(priority_class)
+            return
+        if self.queued >= self.queue_limit and not self._evict_below(priority_class):
+            self.stats[priority_class]["rejected"] += 1
+            raise Overloaded(429, self.retry_after(priority_class), "Too many requests, retry later")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority_class].append(waiter)
+        self.stats[priority_class]["queued"] += 1
+        try:
+            # asyncio.wait leaves the future alone at the timeout, so a slot
+            # granted at that very moment is not lost
+            await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release(priority_class, 0.0)
+            else:
+                self._forget(priority_class, waiter)
+            raise
+        if not waiter.done():
+            self._forget(priority_class, waiter)
+            self.stats[priority_class]["timed_out"] += 1
+            raise Overloaded(503, self.retry_after(priority_class), "Server busy, no capacity within the wait limit")
+        waiter.result()  # raises Overloaded if evicted
+
+    def _forget(self, priority_class: str, waiter: asyncio.Future) -> None:
+        waiter.cancel()
+        try:
+            self._waiters[priority_class].remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self, priority_class: str, service_seconds: float) -> None:
+        self.active -= 1
+        self._active[priority_class] -= 1
+        if service_seconds:
+            average = self._service_seconds[priority_class]
+            self._service_seconds[priority_class] = average * 0.9 + service_seconds * 0.1
+        self._dispatch()
+
+    def metrics(self) -> dict:
+        classes = {}
+        for priority_class in PRIORITY_CLASSES:
+            stats = self.stats[priority_class]
+            shed = stats["rejected"] + stats["timed_out"] + stats["evicted"]
+            requests = stats["admitted"] + stats["rejected"] + stats["evicted"] + stats["timed_out"]
+            classes[priority_class] = {
+                **stats,
+                "limit": self.class_limits[priority_class],
+                "active": self._active[priority_class],
+                "queue_depth": len(self._waiters[priority_class]),
+                "avg_service_ms": round(self._service_seconds[priority_class] * 1000, 3),
+                # Share of requests answered with 429 or 503
+                "rejection_rate": round(shed / requests, 4) if requests else 0.0,
+            }
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queue_limit": self.queue_limit,
+            "active": self.active,
+            "queue_depth": self.queued,
+            "classes": classes,
+        }
+
+
+class AdmissionMiddleware:
+    """Holds a slot from routing until the response body (and background
+    tasks) are done, so streamed exports count for their whole length.
+
+    classify(scope) returns the request's priority class, or None for
+    routes that are never limited (health checks, metrics).
+    """
+
+    def __init__(self, app, controller: AdmissionController, classify: Callable[[dict], Optional[str]]):
+        self.app = app
+        self.controller = controller
+        self.classify = classify
+
+    async def __call__(self, scope, receive, send):
+        priority_class = self.classify(scope) if scope["type"] == "http" else None
+        if priority_class is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.controller.acquire(priority_class)
+        except Overloaded as exc:
+            await self._reject(exc, send)
+            return
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(priority_class, time.monotonic() - start)
+
+    @staticmethod
+    async def _reject(exc: Overloaded, send) -> None:
+        body = json.dumps({"detail": exc.detail}).encode()
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(exc.retry_after).encode()),
+        ]
+        await send({"type": "http.response.start", "status": exc.status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
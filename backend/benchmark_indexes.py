@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Index coverage benchmark for the transmittal list filters.
+
+Seeds a scratch database with synthetic transmittals, then runs the common
+filter combinations used by GET /api/transmittals and /transmittals/facets
+with and without TRANSMITTAL_INDEXES. For every combination it reports the
+winning plan, documents examined per document returned, and median latency,
+and exits non-zero if a combination needs a collection scan or an in-memory
+sort once the indexes exist.
+
+Facets run one aggregation per facet_groups entry (see
+MongoTransmittalRepository.facets), so each of those pipelines is explained
+and must match through an index too; only a group left with no filter at all
+counts the whole collection and is reported without being held to that.
+
+Usage:
+    MONGO_URL=mongodb://localhost:27017 python benchmark_indexes.py
+"""
+
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from pymongo import DESCENDING, MongoClient
+
+from storage.base import facet_groups, normalize_filters
+from storage.mongo import TRANSMITTAL_INDEXES, build_facet_pipeline, build_transmittal_query
+
+BENCH_DB_NAME = os.environ.get('BENCH_DB_NAME', 'transmittal_index_bench')
+SEED_COUNT = int(os.environ.get('BENCH_SEED_COUNT', '50000'))
+RUNS = int(os.environ.get('BENCH_RUNS', '20'))
+PAGE_SIZE = 9
+
+VALUES = {
+    "status": ["draft", "generated", "sent", "received"],
+    "department": ["Architecture", "Interior Design", "Structural", "MEP", "Landscape"],
+    "transmittal_type": ["Drawing", "Documents"],
+    "design_stage": ["Conceptual", "Schematic Design", "Design Development", "Construction"],
+    "send_to": ["Client", "Contractor", "Consultant", "Authority"],
+    "send_mode": ["Hardcopy", "Softcopy"],
+    "project_name": [f"Project {n:03d}" for n in range(40)],
+}
+
+# Filter combinations the dashboard actually issues
+COMBINATIONS = [
+    {},
+    {"status": ["sent"]},
+    {"department": ["Architecture"]},
+    {"department": ["Architecture"], "status": ["generated"]},
+    {"project_name": ["Project 007"]},
+    {"project_name": ["Project 007"], "status": ["draft"]},
+    {"transmittal_type": ["Documents"]},
+    {"transmittal_type": ["Drawing"], "department": ["Structural"]},
+    {"transmittal_type": ["Drawing"], "department": ["MEP"], "design_stage": ["Schematic Design"]},
+    {"send_to": ["Contractor"]},
+    {"send_to": ["Client"], "send_mode": ["Hardcopy"]},
+]
+
+# Filter sets the facet sidebar is typically queried with
+FACET_COMBINATIONS = [
+    {"department": ["Architecture"]},
+    {"department": ["Architecture"], "status": ["generated"]},
+    {"project_name": ["Project 007"], "status": ["draft"]},
+    {"transmittal_type": ["Drawing"], "department": ["MEP"], "design_stage": ["Schematic Design"]},
+]
+
+
+def seed(collection):
+    collection.drop()
+    now = datetime.utcnow()
+    batch = []
+    for n in range(SEED_COUNT):
+        doc = {field: random.choice(values) for field, values in VALUES.items()}
+        doc["id"] = f"bench-{n}"
+        doc["title"] = f"Benchmark transmittal {n}"
+        doc["documents"] = []
+        doc["document_count"] = 0
+        doc["created_date"] = now - timedelta(minutes=n)
+        batch.append(doc)
+        if len(batch) == 5000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+
+def plan_stages(plan):
+    """Flatten the stage names of an explain() winning plan"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for key in ("inputStage", "queryPlan", "winningPlan"):
+            stages.extend(plan_stages(plan.get(key)))
+        for child in plan.get("inputStages", []):
+            stages.extend(plan_stages(child))
+    return stages
+
+
+def measure(collection, query):
+    cursor = collection.find(query).sort("created_date", DESCENDING).limit(PAGE_SIZE)
+    explain = cursor.explain()
+    stats = explain.get("executionStats", {})
+    stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        list(collection.find(query).sort("created_date", DESCENDING).limit(PAGE_SIZE))
+        collection.count_documents(query)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    returned = max(stats.get("nReturned", 0), 1)
+    return {
+        "stages": stages,
+        "examined_ratio": stats.get("totalDocsExamined", 0) / returned,
+        "median_ms": statistics.median(timings),
+    }
+
+
+def explain_pipeline(db, pipeline):
+    """Stage names of the winning plan behind an aggregation's $match"""
+    explain = db.command("aggregate", "transmittals", pipeline=pipeline, explain=True)
+    first_stage = explain.get("stages", [{}])[0].get("$cursor", explain)
+    return plan_stages(first_stage.get("queryPlanner", {}).get("winningPlan", {}))
+
+
+def describe(combo):
+    return ", ".join(f"{k}={'|'.join(v)}" for k, v in combo.items()) or "(no filter)"
+
+
+def main():
+    client = MongoClient(os.environ['MONGO_URL'])
+    collection = client[BENCH_DB_NAME].transmittals
+
+    print(f"Seeding {SEED_COUNT} transmittals into {BENCH_DB_NAME}...")
+    seed(collection)
+
+    queries = [build_transmittal_query(combo) for combo in COMBINATIONS]
+    baseline = [measure(collection, q) for q in queries]
+
+    collection.create_indexes(TRANSMITTAL_INDEXES)
+    indexed = [measure(collection, q) for q in queries]
+
+    failures = 0
+    print(f"\n{'filters':<60} {'plan':<28} {'docs/ret':>9} {'before':>9} {'after':>9}")
+    for combo, before, after in zip(COMBINATIONS, baseline, indexed):
+        covered = "IXSCAN" in after["stages"] and "COLLSCAN" not in after["stages"] and "SORT" not in after["stages"]
+        failures += not covered
+        print(
+            f"{describe(combo):<60} {'>'.join(after['stages']):<28} "
+            f"{after['examined_ratio']:>9.1f} {before['median_ms']:>7.2f}ms {after['median_ms']:>7.2f}ms"
+            f"{'' if covered else '  NOT COVERED'}"
+        )
+
+    print(f"\n{'facets for / group filters':<60} {'counts':<28} plan")
+    for combo in FACET_COMBINATIONS:
+        print(describe(combo))
+        for n, (group_filters, fields) in enumerate(facet_groups(combo)):
+            stages = explain_pipeline(client[BENCH_DB_NAME], build_facet_pipeline(group_filters, fields, n == 0))
+            if not normalize_filters(group_filters):
+                note = "  (no filter, full count)"
+            else:
+                covered = "IXSCAN" in stages and "COLLSCAN" not in stages
+                failures += not covered
+                note = "" if covered else "  NOT COVERED"
+            print(f"  {describe(group_filters):<58} {','.join(fields)[:28]:<28} {'>'.join(stages)}{note}")
+
+    client.drop_database(BENCH_DB_NAME)
+    if failures:
+        print(f"\n{failures} combination(s) not covered by TRANSMITTAL_INDEXES")
+        sys.exit(1)
+    print("\nAll combinations are served by TRANSMITTAL_INDEXES")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Single-flight coalescing for hot read queries.
+
+When many clients ask for the same transmittal page, count or facets at
+once (a team opening the dashboard together, everyone reconnecting after a
+deploy) only the first request goes to the database; the others wait for
+and share its result. A finished result is also reused for COALESCE_TTL_MS.
+
+Every transmittal change made by this process bumps a write generation
+(through the audit log listener), and both in-flight calls and cached
+results are keyed by the generation they started in, so a client never gets
+a result older than its own write. Changes made by other workers become
+visible within COALESCE_TTL_MS at most.
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+COALESCE_TTL_MS = int(os.environ.get('COALESCE_TTL_MS', '250'))
+COALESCE_MAX_ENTRIES = int(os.environ.get('COALESCE_MAX_ENTRIES', '1024'))
+
+
+def filters_key(filters: Dict[str, Optional[list]]) -> Tuple:
+    """Hashable form of list filters; values within a field are ORed, so
+    their order does not matter"""
+    return tuple(sorted((field, tuple(sorted(values))) for field, values in filters.items() if values))
+
+
+class QueryCoalescer:
+
+    def __init__(self, ttl_ms: int = COALESCE_TTL_MS, max_entries: int = COALESCE_MAX_ENTRIES):
+        self.ttl = ttl_ms / 1000
+        self.max_entries = max_entries
+        self.generation = 0
+        self._inflight: Dict[Tuple, asyncio.Task] = {}
+        self._results: "OrderedDict[Tuple, Tuple[float, object]]" = OrderedDict()
+        # calls: requests seen; executed: database calls made; joined: shared
+        # an in-flight call; cached: served from the TTL window
+        self.stats = {"calls": 0, "executed": 0, "joined": 0, "cached": 0}
+
+    def invalidate(self, event=None) -> None:
+        """Audit log listener; may be called from a storage worker thread"""
+        self.generation += 1
+
+    async def run(self, key: Hashable, query: Callable[[], Awaitable]):
+        """Result of query(), shared with identical concurrent calls.
+
+        The result is shared, not copied; callers must not modify it.
+        """
+        self.stats["calls"] += 1
+        entry_key = (self.generation, key)
+
+        cached = self._results.get(entry_key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self.stats["cached"] += 1
+                return cached[1]
+            del self._results[entry_key]
+
+        task = self._inflight.get(entry_key)
+        if task is not None:
+            self.stats["joined"] += 1
+        else:
+            self.stats["executed"] += 1
+            # A task of its own, so a caller that disconnects does not
+            # cancel the query for the others
+            task = asyncio.ensure_future(query())
+            self._inflight[entry_key] = task
+            task.add_done_callback(lambda done: self._finished(entry_key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, entry_key: Tuple, task: asyncio.Task) -> None:
+        self._inflight.pop(entry_key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.ttl > 0 and entry_key[0] == self.generation:
+            self._results[entry_key] = (time.monotonic() + self.ttl, task.result())
+            self._prune()
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        for entry_key in [k for k, (expires, _) in self._results.items()
+                          if k[0] != self.generation or expires <= now]:
+            del self._results[entry_key]
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def metrics(self) -> dict:
+        calls = self.stats["calls"]
+        saved = self.stats["joined"] + self.stats["cached"]
+        return {
+            **self.stats,
+            "in_flight": len(self._inflight),
+            "cached_results": len(self._results),
+            "generation": self.generation,
+            # Share of calls answered without a database call of their own
+            "coalescing_ratio": round(saved / calls, 4) if calls else 0.0,
+        }
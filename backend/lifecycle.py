@@ -0,0 +1,131 @@
+"""
+Worker startup, readiness and graceful draining.
+
+Every uvicorn worker runs the app's lifespan on its own, so each worker has
+its own Lifecycle. A worker is live as soon as it serves requests, and ready
+once its startup has opened and warmed the database pool, compiled the
+response models and found every index in place; until then the readiness
+endpoint answers 503 and the load balancer keeps traffic on other workers.
+
+To drain a host before a deploy, touch DRAIN_FILE (shared by all workers
+there): readiness turns to 503 in every worker started before the file was
+touched, and their responses carry ``Connection: close`` so keep-alive
+clients reconnect to a ready worker. Workers started afterwards ignore it,
+so replacements come up ready while the old ones drain. On SIGTERM uvicorn
+stops accepting connections and lets in-flight requests finish before the
+lifespan shutdown runs, which waits up to DRAIN_TIMEOUT_SECONDS more for
+requests still counted here (streams and background tasks).
+"""
+
+import asyncio
+import os
+import time
+from typing import Optional
+
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+DRAIN_FILE = os.environ.get('DRAIN_FILE')
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get('DRAIN_TIMEOUT_SECONDS', '30'))
+WARM_CONNECTIONS = int(os.environ.get('WARM_CONNECTIONS', '10'))
+READINESS_TIMEOUT_SECONDS = float(os.environ.get('READINESS_TIMEOUT_SECONDS', '2'))
+
+# How long a look at DRAIN_FILE is reused; the file is checked per request
+DRAIN_CHECK_SECONDS = 1.0
+
+
+def compile_models(app: FastAPI) -> int:
+    """Finish building deferred response models and the OpenAPI schema now
+    rather than on the first request that needs them; returns the number
+    of schemas built"""
+    for route in app.routes:
+        model = getattr(route, "response_model", None)
+        if isinstance(model, type) and issubclass(model, BaseModel) and not model.__pydantic_complete__:
+            model.model_rebuild()
+    return len(app.openapi().get("components", {}).get("schemas", {}))
+
+
+class Lifecycle:
+
+    def __init__(self, drain_file: Optional[str] = DRAIN_FILE):
+        self.drain_file = drain_file
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        self.stopping = False
+        self.in_flight = 0
+        # What startup did, or why the worker is not ready
+        self.startup: dict = {}
+        self._drain_requested = False
+        self._drain_checked = 0.0
+
+    @property
+    def draining(self) -> bool:
+        if self.stopping:
+            return True
+        if self.drain_file and time.monotonic() - self._drain_checked >= DRAIN_CHECK_SECONDS:
+            self._drain_checked = time.monotonic()
+            try:
+                self._drain_requested = os.path.getmtime(self.drain_file) >= self.started_at
+            except OSError:
+                self._drain_requested = False
+        return self._drain_requested
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None and not self.draining
+
+    def mark_ready(self) -> None:
+        self.ready_at = time.time()
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT_SECONDS) -> bool:
+        """Stop reporting ready and wait for in-flight requests; False if
+        some were still running at the timeout"""
+        self.stopping = True
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not self.in_flight
+
+    def status(self) -> dict:
+        if self.draining:
+            state = "draining"
+        elif self.ready_at is None:
+            state = "starting"
+        else:
+            state = "ready"
+        return {
+            "status": state,
+            "worker": os.getpid(),
+            "uptime_seconds": round(time.time() - self.started_at, 3),
+            "in_flight": self.in_flight,
+            "startup": self.startup,
+        }
+
+
+class DrainMiddleware:
+    """Counts in-flight requests (until the response body and background
+    tasks are done) and closes keep-alive connections while draining.
+
+    Plain ASGI rather than @app.middleware, which would stop counting once
+    the response headers were sent.
+    """
+
+    def __init__(self, app, lifecycle: Lifecycle):
+        self.app = app
+        self.lifecycle = lifecycle
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_close(message):
+            if message["type"] == "http.response.start" and self.lifecycle.draining:
+                message["headers"] = [*message.get("headers", []), (b"connection", b"close")]
+            await send(message)
+
+        self.lifecycle.in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_close)
+        finally:
+            self.lifecycle.in_flight -= 1
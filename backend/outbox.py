@@ -0,0 +1,386 @@
+"""
+Share message delivery.
+
+POST /transmittals/{id}/share only writes messages to the outbox, in the
+same transaction as the transmittal change (see storage.OutboxRepository).
+OutboxDispatcher runs in the background: it leases due messages in batches,
+hands each channel's batch to its transport over one reused connection, and
+reschedules failures with exponential backoff until OUTBOX_MAX_ATTEMPTS.
+
+Transports are chosen by OUTBOX_TRANSPORT:
+    smtp   email over SMTP_HOST and Teams through incoming webhooks
+           (default when SMTP_HOST is set)
+    local  LocalTransport for both channels; messages are appended to
+           OUTBOX_LOCAL_PATH, or only logged (default otherwise)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import smtplib
+import time
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from typing import Dict, List, Optional
+
+import requests
+
+from storage import OutboxRepository
+
+logger = logging.getLogger(__name__)
+
+SHARE_CHANNELS = ("email", "teams")
+
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', '120'))
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '5'))
+# First retry delay; doubles per attempt up to an hour
+OUTBOX_RETRY_SECONDS = int(os.environ.get('OUTBOX_RETRY_SECONDS', '30'))
+# Messages per second per channel, to stay under provider limits
+OUTBOX_RATE_PER_SECOND = float(os.environ.get('OUTBOX_RATE_PER_SECOND', '20'))
+
+# The only Teams webhooks a share may post to: TEAMS_WEBHOOK_URL (the
+# default) and those listed in TEAMS_WEBHOOK_ALLOWLIST, comma separated.
+# Recipients are client input, so any other URL is refused rather than
+# letting a share make the server call arbitrary hosts.
+TEAMS_WEBHOOK_URL = os.environ.get('TEAMS_WEBHOOK_URL')
+TEAMS_WEBHOOK_ALLOWLIST = frozenset(
+    url.strip() for url in [TEAMS_WEBHOOK_URL or "", *os.environ.get('TEAMS_WEBHOOK_ALLOWLIST', '').split(',')]
+    if url.strip()
+)
+
+
+class DeliveryError(Exception):
+    """A message could not be delivered; permanent errors are not retried"""
+
+    def __init__(self, message: str, permanent: bool = False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+def compose_share_messages(
+    transmittal: dict, channel: str, recipients: List[str], note: Optional[str], now: datetime
+) -> List[dict]:
+    """One outbox message per recipient, due immediately"""
+    number = transmittal.get("transmittal_number") or transmittal["id"]
+    subject = f"Transmittal {number}: {transmittal['title']}"
+    lines = [
+        f"{transmittal.get('salutation', '')} {transmittal.get('recipient_name', '')},".strip(),
+        "",
+        f"Please find transmittal {number} ({transmittal['title']}) with "
+        f"{transmittal.get('document_count', 0)} document(s) for project {transmittal.get('project_name') or '-'}.",
+    ]
+    if note:
+        lines += ["", note]
+    lines += ["", transmittal.get("sender_name", ""), transmittal.get("sender_designation", "")]
+    body = "\n".join(lines).strip()
+
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "transmittal_id": transmittal["id"],
+            "channel": channel,
+            "recipient": recipient,
+            "subject": subject,
+            "body": body,
+            "state": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+        }
+        for recipient in recipients
+    ]
+
+
+class Transport(ABC):
+    """Delivers batches of messages for one channel"""
+
+    @abstractmethod
+    async def send_batch(self, messages: List[dict]) -> Dict[str, Optional[DeliveryError]]:
+        """Deliver messages; map each message id to None or its error"""
+
+    async def close(self) -> None:
+        pass
+
+
+class SMTPTransport(Transport):
+    """Sends email over one SMTP connection kept open between batches"""
+
+    def __init__(self, host: str, port: int, sender: str, username: Optional[str] = None,
+                 password: Optional[str] = None, starttls: bool = True):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self._smtp: Optional[smtplib.SMTP] = None
+
+    def _connection(self) -> smtplib.SMTP:
+        if self._smtp is not None:
+            try:
+                self._smtp.noop()
+                return self._smtp
+            except smtplib.SMTPException:
+                self._smtp = None
+        smtp = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password or "")
+        self._smtp = smtp
+        return smtp
+
+    def _send_all(self, messages: List[dict]) -> Dict[str, Optional[DeliveryError]]:
+        smtp = self._connection()
+        results = {}
+        for message in messages:
+            try:
+                email = EmailMessage()
+                email["From"] = self.sender
+                email["To"] = message["recipient"]
+                email["Subject"] = message["subject"]
+                email["Message-ID"] = f"<{message['id']}@transmittal-craft>"
+                email.set_content(message["body"])
+                smtp.send_message(email)
+                results[message["id"]] = None
+            except smtplib.SMTPRecipientsRefused as e:
+                results[message["id"]] = DeliveryError(str(e), permanent=True)
+            except smtplib.SMTPResponseException as e:
+                # 5xx replies are final, 4xx are worth retrying
+                results[message["id"]] = DeliveryError(str(e), permanent=e.smtp_code >= 500)
+            except smtplib.SMTPServerDisconnected as e:
+                self._smtp = None
+                for pending in messages[len(results):]:
+                    results[pending["id"]] = DeliveryError(str(e))
+                break
+            except (ValueError, smtplib.SMTPNotSupportedError) as e:
+                # A malformed address or header; sending again cannot help
+                results[message["id"]] = DeliveryError(str(e), permanent=True)
+            except Exception as e:
+                # Recorded against this message only, so the rest of the
+                # batch (some of it already sent) is not retried with it
+                results[message["id"]] = DeliveryError(str(e))
+        return results
+
+    async def send_batch(self, messages):
+        return await asyncio.to_thread(self._send_all, messages)
+
+    async def close(self):
+        if self._smtp is not None:
+            smtp, self._smtp = self._smtp, None
+            try:
+                await asyncio.to_thread(smtp.quit)
+            except smtplib.SMTPException:
+                pass
+
+
+class TeamsWebhookTransport(Transport):
+    """Posts to Teams incoming webhooks; the recipient is the webhook URL,
+    which must be one of allowed. One HTTP session keeps connections alive
+    across messages."""
+
+    def __init__(self, allowed: frozenset = TEAMS_WEBHOOK_ALLOWLIST, timeout: float = 15):
+        self.allowed = allowed
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _send_all(self, messages: List[dict]) -> Dict[str, Optional[DeliveryError]]:
+        results = {}
+        for message in messages:
+            if message["recipient"] not in self.allowed:
+                results[message["id"]] = DeliveryError("Webhook URL is not allowed", permanent=True)
+                continue
+            try:
+                reply = self.session.post(
+                    message["recipient"],
+                    json={"title": message["subject"], "text": message["body"].replace("\n", "  \n")},
+                    timeout=self.timeout,
+                )
+            except requests.RequestException as e:
+                results[message["id"]] = DeliveryError(str(e))
+                continue
+            if reply.ok:
+                results[message["id"]] = None
+            else:
+                retryable = reply.status_code == 429 or reply.status_code >= 500
+                results[message["id"]] = DeliveryError(f"HTTP {reply.status_code}", permanent=not retryable)
+        return results
+
+    async def send_batch(self, messages):
+        return await asyncio.to_thread(self._send_all, messages)
+
+    async def close(self):
+        self.session.close()
+
+
+class LocalTransport(Transport):
+    """Stand-in for SMTP and webhooks in development and tests.
+
+    Delivered messages are kept in ``sent`` and appended as JSON lines to
+    path when one is given. Recipients listed in ``failing`` fail with a
+    retryable error.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.sent: List[dict] = []
+        self.failing: Dict[str, bool] = {}  # recipient -> permanent
+
+    async def send_batch(self, messages):
+        results = {}
+        for message in messages:
+            if message["recipient"] in self.failing:
+                results[message["id"]] = DeliveryError(
+                    "Delivery refused by local transport", permanent=self.failing[message["recipient"]]
+                )
+                continue
+            self.sent.append(message)
+            results[message["id"]] = None
+            logger.info(f"[{message['channel']}] to {message['recipient']}: {message['subject']}")
+        if self.path:
+            delivered = [m for m in messages if results[m["id"]] is None]
+            lines = "".join(json.dumps(m, default=str) + "\n" for m in delivered)
+            await asyncio.to_thread(self._append, lines)
+        return results
+
+    def _append(self, lines: str) -> None:
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+
+class RateLimiter:
+    """Token bucket allowing rate messages per second on average"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def acquire(self, count: int) -> None:
+        while True:
+            now = time.monotonic()
+            # Let a batch larger than one second's worth through once full
+            capacity = max(self.rate, count)
+            self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return
+            await asyncio.sleep((count - self.tokens) / self.rate)
+
+
+def build_transports() -> Dict[str, Transport]:
+    """Transports per channel from the environment"""
+    mode = os.environ.get('OUTBOX_TRANSPORT', 'smtp' if os.environ.get('SMTP_HOST') else 'local')
+    if mode == 'local':
+        local = LocalTransport(os.environ.get('OUTBOX_LOCAL_PATH'))
+        return {channel: local for channel in SHARE_CHANNELS}
+    if mode == 'smtp':
+        return {
+            "email": SMTPTransport(
+                host=os.environ['SMTP_HOST'],
+                port=int(os.environ.get('SMTP_PORT', '587')),
+                sender=os.environ['SMTP_SENDER'],
+                username=os.environ.get('SMTP_USERNAME'),
+                password=os.environ.get('SMTP_PASSWORD'),
+                starttls=os.environ.get('SMTP_STARTTLS', 'true').lower() == 'true',
+            ),
+            "teams": TeamsWebhookTransport(),
+        }
+    raise ValueError(f"Unknown OUTBOX_TRANSPORT {mode!r}, expected 'smtp' or 'local'")
+
+
+class OutboxDispatcher:
+
+    def __init__(
+        self,
+        outbox: OutboxRepository,
+        transports: Dict[str, Transport],
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        rate_per_second: float = OUTBOX_RATE_PER_SECOND,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+    ):
+        self.outbox = outbox
+        self.transports = transports
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.limiters = {channel: RateLimiter(rate_per_second) for channel in transports}
+        self.stats = {"sent": 0, "retried": 0, "dead": 0}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def notify(self) -> None:
+        """Wake the dispatcher after new messages were queued"""
+        self._wake.set()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for transport in set(self.transports.values()):
+            await transport.close()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                dispatched = await self.dispatch_once()
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+                dispatched = 0
+            if dispatched < self.batch_size:
+                # Drained; sleep until notified or the next retry may be due
+                try:
+                    await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+    async def dispatch_once(self) -> int:
+        """Deliver one batch of due messages; returns how many were leased"""
+        messages = await self.outbox.claim(datetime.utcnow(), self.batch_size, OUTBOX_LEASE_SECONDS)
+        by_channel: Dict[str, List[dict]] = {}
+        for message in messages:
+            by_channel.setdefault(message["channel"], []).append(message)
+        await asyncio.gather(*(self._deliver(channel, batch) for channel, batch in by_channel.items()))
+        return len(messages)
+
+    async def _deliver(self, channel: str, messages: List[dict]) -> None:
+        transport = self.transports.get(channel)
+        if transport is None:
+            results = {m["id"]: DeliveryError(f"No transport for {channel}", permanent=True) for m in messages}
+        else:
+            await self.limiters[channel].acquire(len(messages))
+            try:
+                results = await transport.send_batch(messages)
+            except Exception as e:
+                results = {m["id"]: DeliveryError(str(e)) for m in messages}
+
+        now = datetime.utcnow()
+        delivered = [message_id for message_id, error in results.items() if error is None]
+        if delivered:
+            await self.outbox.mark_sent(delivered, now)
+            self.stats["sent"] += len(delivered)
+        for message in messages:
+            error = results.get(message["id"], DeliveryError("No result from transport"))
+            if error is None:
+                continue
+            if error.permanent or message["attempts"] >= self.max_attempts:
+                logger.warning(f"Giving up on {channel} message {message['id']} to {message['recipient']}: {error}")
+                await self.outbox.mark_failed(message["id"], str(error), None)
+                self.stats["dead"] += 1
+            else:
+                delay = min(OUTBOX_RETRY_SECONDS * 2 ** (message["attempts"] - 1), 3600)
+                await self.outbox.mark_failed(message["id"], str(error), now + timedelta(seconds=delay))
+                self.stats["retried"] += 1
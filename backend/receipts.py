@@ -0,0 +1,196 @@
+"""
+Receipt optimization.
+
+Receipts arrive as full-resolution phone photos and scanned PDFs. After a
+transmittal is marked received, the receipt is processed in a worker pool:
+images are re-encoded to a bounded resolution and quality, and a small JPEG
+thumbnail is made for images and for the first page of PDFs. The original is
+kept untouched for download.
+
+Each stored receipt gets a receipt_id, and a job only writes its result
+while the transmittal still holds that receipt, whatever else changed in
+the meantime. Jobs run as background tasks, which a restart loses, so the
+ReceiptSweeper also re-runs receipts left "pending" at startup and every
+RECEIPT_SWEEP_INTERVAL_SECONDS.
+
+Pillow is needed for images and PyMuPDF for PDF previews. Both are optional:
+without them receipts are stored as uploaded and marked "unsupported".
+"""
+
+import asyncio
+import base64
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Optional, Set
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:  # pragma: no cover - optional dependency
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+# Longest edge of the optimized image and its JPEG quality
+RECEIPT_MAX_DIMENSION = int(os.environ.get('RECEIPT_MAX_DIMENSION', '2000'))
+RECEIPT_JPEG_QUALITY = int(os.environ.get('RECEIPT_JPEG_QUALITY', '82'))
+# Longest edge of thumbnails shown on cards and in lists
+RECEIPT_THUMBNAIL_SIZE = int(os.environ.get('RECEIPT_THUMBNAIL_SIZE', '320'))
+RECEIPT_WORKERS = int(os.environ.get('RECEIPT_WORKERS', '2'))
+RECEIPT_SWEEP_INTERVAL_SECONDS = int(os.environ.get('RECEIPT_SWEEP_INTERVAL_SECONDS', '300'))
+RECEIPT_SWEEP_BATCH = 100
+
+
+class UnsupportedReceipt(Exception):
+    """The receipt type cannot be processed with the installed libraries"""
+
+
+def decode_receipt(receipt_file: str) -> bytes:
+    """Decode a base64 receipt, with or without a data: URL prefix"""
+    if receipt_file.startswith("data:"):
+        receipt_file = receipt_file.split(",", 1)[1]
+    return base64.b64decode(receipt_file)
+
+
+def sniff_content_type(content: bytes) -> Optional[str]:
+    if content.startswith(b"%PDF"):
+        return "application/pdf"
+    if content.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if content.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return "image/webp"
+    if content[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return None
+
+
+def _to_jpeg(image, max_dimension: int, quality: int) -> bytes:
+    image = image.copy()
+    image.thumbnail((max_dimension, max_dimension))
+    if image.mode not in ("RGB", "L"):
+        # Flatten transparency onto white rather than black
+        background = Image.new("RGB", image.size, "white")
+        rgba = image.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def process_receipt(content: bytes, content_type: str) -> dict:
+    """Build the optimized image and thumbnail for one receipt.
+
+    Runs in a worker process, so it takes and returns only plain bytes.
+    The optimized image is omitted when re-encoding would not make the
+    file smaller, and for PDFs, which are served as uploaded.
+    """
+    if content_type == "application/pdf":
+        if fitz is None or Image is None:
+            raise UnsupportedReceipt("PDF previews need PyMuPDF and Pillow")
+        with fitz.open(stream=content, filetype="pdf") as pdf:
+            page = pdf[0]
+            zoom = RECEIPT_THUMBNAIL_SIZE / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        preview = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+        return {"optimized": None, "thumbnail": _to_jpeg(preview, RECEIPT_THUMBNAIL_SIZE, 75)}
+
+    if not content_type.startswith("image/"):
+        raise UnsupportedReceipt(f"Cannot process {content_type} receipts")
+    if Image is None:
+        raise UnsupportedReceipt("Image receipts need Pillow")
+
+    with Image.open(io.BytesIO(content)) as image:
+        # Phone photos are stored sideways with an orientation tag
+        image = ImageOps.exif_transpose(image)
+        optimized = _to_jpeg(image, RECEIPT_MAX_DIMENSION, RECEIPT_JPEG_QUALITY)
+        thumbnail = _to_jpeg(image, RECEIPT_THUMBNAIL_SIZE, 75)
+    return {
+        "optimized": optimized if len(optimized) < len(content) else None,
+        "thumbnail": thumbnail,
+    }
+
+
+class ReceiptProcessor:
+    """Runs process_receipt in a lazily started process pool"""
+
+    def __init__(self, workers: int = RECEIPT_WORKERS):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def process(self, content: bytes, content_type: str) -> dict:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, process_receipt, content, content_type)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class ReceiptSweeper:
+    """Runs receipt jobs, at most one per receipt in this worker, and
+    periodically re-runs the ones still pending.
+
+    optimize(transmittal_id, receipt_id) does the work for one receipt.
+    """
+
+    def __init__(self, storage, optimize: Callable[[str, Optional[str]], Awaitable[None]],
+                 interval: int = RECEIPT_SWEEP_INTERVAL_SECONDS):
+        self.storage = storage
+        self.optimize = optimize
+        self.interval = interval
+        self.running: Set[tuple] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                swept = await self.sweep_once()
+                if swept:
+                    logger.info(f"Re-ran {swept} pending receipt job(s)")
+            except Exception:
+                logger.exception("Pending receipt sweep failed")
+            await asyncio.sleep(self.interval)
+
+    async def run(self, transmittal_id: str, receipt_id: Optional[str]) -> None:
+        key = (transmittal_id, receipt_id)
+        if key in self.running:
+            return
+        self.running.add(key)
+        try:
+            await self.optimize(transmittal_id, receipt_id)
+        finally:
+            self.running.discard(key)
+
+    async def sweep_once(self) -> int:
+        """Run the pending receipts no job here is working on; returns how many"""
+        pending = [
+            key for key in await self.storage.transmittals.pending_receipts(RECEIPT_SWEEP_BATCH)
+            if key not in self.running
+        ]
+        for transmittal_id, receipt_id in pending:
+            await self.run(transmittal_id, receipt_id)
+        return len(pending)
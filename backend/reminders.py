@@ -0,0 +1,144 @@
+"""
+Overdue acknowledgement scanner.
+
+Sending a transmittal sets ack_due_at ACK_DUE_DAYS ahead, and
+next_reminder_at with it; acknowledging it ("Received") clears both. The
+scanner periodically reads the transmittals whose next_reminder_at has passed
+through the partial index on that field, groups them by recipient and queues
+one reminder per recipient in the outbox. Each reminded transmittal's
+next_reminder_at moves ACK_REMINDER_INTERVAL_DAYS ahead in the same
+transaction, so it is not reminded about again until then, and a second
+scanner (another worker) finds nothing left to do. ack_due_at keeps the date
+acknowledgement was due, for the overdue list and the reminder text.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+ACK_SCAN_INTERVAL_SECONDS = int(os.environ.get('ACK_SCAN_INTERVAL_SECONDS', '3600'))
+ACK_REMINDER_INTERVAL_DAYS = int(os.environ.get('ACK_REMINDER_INTERVAL_DAYS', '3'))
+# Mailbox that gets reminders for transmittals without a recipient_email
+ACK_REMINDER_FALLBACK = os.environ.get('ACK_REMINDER_FALLBACK')
+ACK_SCAN_PAGE_SIZE = 500
+
+
+def reminder_address(transmittal: dict) -> Optional[str]:
+    return transmittal.get("recipient_email") or ACK_REMINDER_FALLBACK
+
+
+def compose_reminders(transmittals: List[dict], now: datetime) -> List[dict]:
+    """One outbox message per address, listing every overdue transmittal.
+
+    The message is filed under the most overdue transmittal; all of them are
+    listed in transmittal_ids.
+    """
+    by_address: Dict[str, List[dict]] = {}
+    for transmittal in transmittals:
+        address = reminder_address(transmittal)
+        if address:
+            by_address.setdefault(address, []).append(transmittal)
+
+    messages = []
+    for address, overdue in by_address.items():
+        overdue.sort(key=lambda t: t["ack_due_at"])
+        lines = [f"{overdue[0].get('salutation', '')} {overdue[0].get('recipient_name', '')},".strip(), "",
+                 "We have not yet received acknowledgement for the following transmittals:", ""]
+        for transmittal in overdue:
+            days = (now - transmittal["ack_due_at"]).days
+            lines.append(
+                f"- {transmittal.get('transmittal_number') or transmittal['id']}: {transmittal['title']}"
+                f" (due {transmittal['ack_due_at']:%Y-%m-%d}, {days} day(s) overdue)"
+            )
+        lines += ["", "Please confirm receipt at your earliest convenience."]
+        messages.append({
+            "id": str(uuid.uuid4()),
+            "transmittal_id": overdue[0]["id"],
+            "transmittal_ids": [transmittal["id"] for transmittal in overdue],
+            "kind": "reminder",
+            "channel": "email",
+            "recipient": address,
+            "subject": f"Acknowledgement overdue for {len(overdue)} transmittal(s)",
+            "body": "\n".join(lines),
+            "state": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+        })
+    return messages
+
+
+class AcknowledgementScanner:
+
+    def __init__(self, storage: Storage, on_queued=None, interval: int = ACK_SCAN_INTERVAL_SECONDS):
+        self.storage = storage
+        # Called after reminders were queued, e.g. to wake the dispatcher
+        self.on_queued = on_queued
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if not ACK_REMINDER_FALLBACK:
+            logger.warning(
+                "ACK_REMINDER_FALLBACK is not set; overdue transmittals without a recipient_email are not reminded"
+            )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                reminded = await self.scan_once()
+                if reminded:
+                    logger.info(f"Queued acknowledgement reminders for {reminded} overdue transmittal(s)")
+            except Exception:
+                logger.exception("Overdue acknowledgement scan failed")
+            await asyncio.sleep(self.interval)
+
+    async def scan_once(self, now: Optional[datetime] = None) -> int:
+        """Queue reminders for everything overdue; returns transmittals reminded about"""
+        now = now or datetime.utcnow()
+        # Without a fallback mailbox only addressed transmittals can be
+        # reminded, so leave the rest in the database
+        addressed_only = not ACK_REMINDER_FALLBACK
+        overdue: List[dict] = []
+        while True:
+            page = await self.storage.transmittals.reminders_due(now, len(overdue), ACK_SCAN_PAGE_SIZE, addressed_only)
+            overdue.extend(page)
+            if len(page) < ACK_SCAN_PAGE_SIZE:
+                break
+
+        groups: Dict[str, List[str]] = {}
+        for transmittal in overdue:
+            address = reminder_address(transmittal)
+            if address:
+                groups.setdefault(address, []).append(transmittal["id"])
+
+        fields = {
+            "next_reminder_at": now + timedelta(days=ACK_REMINDER_INTERVAL_DAYS),
+            "last_reminded_at": now,
+            "updated_at": now,
+        }
+        reminded = 0
+        for transmittal_ids in groups.values():
+            reminded += len(await self.storage.outbox.enqueue_reminders(
+                transmittal_ids, now, fields, lambda due: compose_reminders(due, now)
+            ))
+        if reminded and self.on_queued:
+            self.on_queued()
+        return reminded
@@ -1,31 +1,163 @@
-from fastapi import FastAPI, APIRouter, HTTPException, File, UploadFile, Form
+from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException, File, UploadFile, Form, Depends, Query, Header, Request, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.routing import Match
 import os
+import asyncio
 import logging
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Union
+from urllib.parse import parse_qs
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter, ValidationError, field_validator, model_validator
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 import uuid
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
 import base64
+import hashlib
+import json
 
 
 ROOT_DIR = Path(__file__).parent
+# Before the modules below, which read their settings on import
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+from admission import AdmissionController, AdmissionMiddleware
+from coalescing import QueryCoalescer, filters_key
+from lifecycle import READINESS_TIMEOUT_SECONDS, WARM_CONNECTIONS, DrainMiddleware, Lifecycle, compile_models
+from outbox import TEAMS_WEBHOOK_ALLOWLIST, TEAMS_WEBHOOK_URL, OutboxDispatcher, build_transports, compose_share_messages
+from reminders import AcknowledgementScanner
+from streaming import ndjson_response
+from receipts import ReceiptProcessor, ReceiptSweeper, UnsupportedReceipt, decode_receipt, sniff_content_type
+from tracing import TRACE_SERVER_TIMING, SpanExporter, TracedRoute, start_trace, storage_listeners
+from storage import (
+    ACK_DUE_DAYS,
+    FILTER_FIELDS,
+    TOMBSTONE_RETENTION_DAYS,
+    Storage,
+    StatusCursor,
+    create_storage,
+    transmittal_as_of,
+    transmittal_history,
+)
+
+
+# Storage backend (MongoDB by default, see storage/__init__.py), with every
+# database round trip recorded in the request's trace. Created by lifespan,
+# so importing this module needs neither configuration nor a database.
+storage: Storage = None
+
+# Shares identical concurrent list/count/facet queries; every transmittal
+# change recorded in the audit log starts a new generation of results
+query_coalescer = QueryCoalescer()
+
+# Writes finished request traces to TRACE_EXPORT_PATH / TRACE_COLLECTOR_URL
+span_exporter = SpanExporter()
+
+# Worker pool that optimizes receipts after upload
+receipt_processor = ReceiptProcessor()
+
+# Delivers share messages queued in the outbox (created by lifespan)
+outbox_dispatcher: OutboxDispatcher = None
+
+# Chases sent transmittals whose acknowledgement is overdue (created by lifespan)
+acknowledgement_scanner: AcknowledgementScanner = None
+
+# Runs receipt jobs and re-runs the ones left pending (created by lifespan)
+receipt_sweeper: ReceiptSweeper = None
+
+# Readiness and draining of this worker
+lifecycle = Lifecycle()
+
+# Concurrency limits and the wait queue in front of the routes (see admission.py)
+admission_controller = AdmissionController()
+
+# Upper bound on recipients of one share request
+SHARE_MAX_RECIPIENTS = int(os.environ.get('SHARE_MAX_RECIPIENTS', '5000'))
+
+# A pending Idempotency-Key is leased to the request running it for this
+# long; after that a retry can take it over, so a worker that died mid
+# request does not leave the key stuck until it expires
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '300'))
+
+# Upper bound on ids accepted by the batch GET endpoint
+MAX_BATCH_IDS = int(os.environ.get('MAX_BATCH_IDS', '100'))
+
+# Writes stamp updated_at before they commit, so a slower concurrent write
+# can still land with an earlier timestamp; the changes feed holds back
+# events younger than this so its checkpoint never passes one
+CHANGES_SETTLE_SECONDS = float(os.environ.get('CHANGES_SETTLE_SECONDS', '5'))
+
+# Page size bounds for the JSON status list; NDJSON streams are unbounded
+STATUS_PAGE_DEFAULT = 100
+STATUS_PAGE_MAX = 1000
+
+# Admission class of the routes that are not interactive; format=ndjson
+# streams are exports whatever the route
+ROUTE_PRIORITY_CLASSES = {
+    "/api/transmittals/{transmittal_id}/share": "batch",
+    "/api/transmittals/overdue/remind": "batch",
+    "/api/documents/issues/rebuild": "batch",
+}
+
+# Never queued or rejected, so probes and metrics answer under overload
+ADMISSION_EXEMPT_ROUTES = {
+    "/api/",
+    "/api/health/live",
+    "/api/health/ready",
+    "/api/metrics/admission",
+    "/api/metrics/coalescing",
+}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open and warm the storage before the worker reports ready; on
+    shutdown drain requests, then stop the background work"""
+    global storage, outbox_dispatcher, acknowledgement_scanner, receipt_sweeper
+    started = time.perf_counter()
+    storage = create_storage(**storage_listeners())
+    storage.audit.add_listener(query_coalescer.invalidate)
+    outbox_dispatcher = OutboxDispatcher(storage.outbox, build_transports())
+    acknowledgement_scanner = AcknowledgementScanner(storage, on_queued=outbox_dispatcher.notify)
+    receipt_sweeper = ReceiptSweeper(storage, optimize_receipt)
+
+    await storage.initialize()
+    await storage.warm_up(WARM_CONNECTIONS)
+    schemas = compile_models(app)
+    missing_indexes = await storage.missing_indexes()
+    lifecycle.startup = {
+        "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+        "warm_connections": WARM_CONNECTIONS,
+        "schemas": schemas,
+        "missing_indexes": missing_indexes,
+    }
+    outbox_dispatcher.start()
+    acknowledgement_scanner.start()
+    receipt_sweeper.start()
+    if missing_indexes:
+        logger.error(f"Not ready, indexes missing: {', '.join(missing_indexes)}")
+    else:
+        lifecycle.mark_ready()
+    try:
+        yield
+    finally:
+        if not await lifecycle.drain():
+            logger.warning(f"Shutting down with {lifecycle.in_flight} request(s) still running")
+        await receipt_sweeper.stop()
+        receipt_processor.shutdown()
+        await acknowledgement_scanner.stop()
+        await outbox_dispatcher.stop()
+        await storage.close()
+        span_exporter.close()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-# Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+# Create a router with the /api prefix; TracedRoute times validation,
+# handler and serialization separately
+api_router = APIRouter(prefix="/api", route_class=TracedRoute)
 
 
 # Define Models
@@ -37,6 +169,12 @@ class StatusCheck(BaseModel):
 class StatusCheckCreate(BaseModel):
     client_name: str
 
+class StatusRate(BaseModel):
+    client_name: str
+    window_start: datetime
+    count: int
+    per_minute: float
+
 # Transmittal Models
 class DocumentItem(BaseModel):
     document_no: str
@@ -45,6 +183,28 @@ class DocumentItem(BaseModel):
     copies: int
     action: str  # for approval, for planning, etc.
 
+class DocumentItemUpdate(BaseModel):
+    document_no: Optional[str] = None
+    title: Optional[str] = None
+    revision: Optional[int] = None
+    copies: Optional[int] = None
+    action: Optional[str] = None
+
+class DocumentPage(BaseModel):
+    total: int
+    skip: int
+    limit: int
+    documents: List[DocumentItem]
+
+def unique_document_nos(documents: Optional[List[DocumentItem]]) -> Optional[List[DocumentItem]]:
+    """Document numbers identify documents within a transmittal (the
+    documents sub-resource and the issue index are keyed by them)"""
+    if documents is not None:
+        document_nos = [document.document_no for document in documents]
+        if len(set(document_nos)) != len(document_nos):
+            raise ValueError("Duplicate document numbers")
+    return documents
+
 class TransmittalCreate(BaseModel):
     transmittal_type: str  # Drawing, Documents
     department: str  # Architecture, Interior Design, etc.
@@ -53,6 +213,7 @@ class TransmittalCreate(BaseModel):
     send_to: str  # Client, Contractor, etc.
     salutation: str  # Mr, Ms, Dr
     recipient_name: str
+    recipient_email: Optional[EmailStr] = None  # where acknowledgement reminders go
     sender_name: str
     sender_designation: str
     send_mode: str  # Hardcopy, Softcopy
@@ -62,6 +223,8 @@ class TransmittalCreate(BaseModel):
     purpose: Optional[str] = None
     remarks: Optional[str] = None
 
+    _unique_documents = field_validator("documents")(unique_document_nos)
+
 class TransmittalUpdate(BaseModel):
     transmittal_type: Optional[str] = None
     department: Optional[str] = None
@@ -70,6 +233,7 @@ class TransmittalUpdate(BaseModel):
     send_to: Optional[str] = None
     salutation: Optional[str] = None
     recipient_name: Optional[str] = None
+    recipient_email: Optional[EmailStr] = None
     sender_name: Optional[str] = None
     sender_designation: Optional[str] = None
     send_mode: Optional[str] = None
@@ -79,14 +243,95 @@ class TransmittalUpdate(BaseModel):
     purpose: Optional[str] = None
     remarks: Optional[str] = None
 
+    _unique_documents = field_validator("documents")(unique_document_nos)
+
 class SendDetails(BaseModel):
     delivery_person: Optional[str] = None  # Receptionist, Me, Other
     send_date: Optional[datetime] = None
 
 class ReceiveDetails(BaseModel):
-    receipt_file: Optional[str] = None  # base64 encoded file
+    receipt_file: Optional[str] = None  # base64 encoded original, kept for download
+    receipt_content_type: Optional[str] = None
     received_date: Optional[date] = None
     received_time: Optional[str] = None  # HH:MM format
+    # Set by the receipt worker pool, not by clients
+    receipt_status: Optional[str] = None  # pending, ready, unsupported, failed
+    receipt_optimized: Optional[str] = None  # base64 JPEG at bounded resolution
+    receipt_thumbnail: Optional[str] = None  # base64 JPEG, served as the receipt's thumbnail variant
+    receipt_id: Optional[str] = None  # identifies the stored receipt to its optimization job
+
+EMAIL_ADDRESS = TypeAdapter(EmailStr)
+
+class ShareRequest(BaseModel):
+    channel: Literal["email", "teams"]
+    # Email addresses, or Teams webhook URLs from TEAMS_WEBHOOK_ALLOWLIST
+    # (TEAMS_WEBHOOK_URL if empty)
+    recipients: List[str] = []
+    note: Optional[str] = None
+
+    @model_validator(mode="after")
+    def valid_email_recipients(self):
+        if self.channel == "email":
+            recipients = []
+            for recipient in self.recipients:
+                if recipient.strip():
+                    try:
+                        recipients.append(EMAIL_ADDRESS.validate_python(recipient.strip()))
+                    except ValidationError:
+                        raise ValueError(f"Invalid email address {recipient!r}")
+            self.recipients = recipients
+        return self
+
+class ShareMessage(BaseModel):
+    id: str
+    channel: str
+    recipient: str
+    subject: str
+    state: str  # pending, sending, sent, dead
+    attempts: int
+    created_at: datetime
+    next_attempt_at: Optional[datetime] = None
+    sent_at: Optional[datetime] = None
+    last_error: Optional[str] = None
+
+class DocumentIssue(BaseModel):
+    document_no: str
+    revision: Optional[int] = None
+    title: Optional[str] = None
+    transmittal_id: str
+    transmittal_number: Optional[str] = None
+    project_name: Optional[str] = None
+    recipient_name: Optional[str] = None
+    recipient_email: Optional[str] = None
+    send_to: Optional[str] = None
+    issued_at: Optional[datetime] = None
+    status: Optional[str] = None
+    sent_status: Optional[str] = None
+    sent_date: Optional[datetime] = None
+    received_status: Optional[str] = None
+    received_date: Optional[date] = None
+    superseded: bool = False  # a later revision has been issued since
+
+class DocumentIssueHistory(BaseModel):
+    document_no: str
+    latest_revision: Optional[int] = None
+    issues: List[DocumentIssue]
+    # The newest issue each recipient holds, where that is not the latest revision
+    superseded_holders: List[DocumentIssue]
+
+class AuditEvent(BaseModel):
+    version: int
+    at: datetime
+    # create, update, generate, send, receive, share, remind, optimize_receipt,
+    # add_documents, update_document, remove_document, delete
+    action: str
+    changes: Dict[str, Any]
+    # field -> {"from", "to"}; None where the state before it is not recorded
+    diff: Optional[Dict[str, Any]] = None
+
+class TransmittalHistory(BaseModel):
+    events: List[AuditEvent]
+    has_more: bool
 
 class Transmittal(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -98,6 +343,7 @@ class Transmittal(BaseModel):
     send_to: str
     salutation: str
     recipient_name: str
+    recipient_email: Optional[str] = None
     sender_name: str
     sender_designation: str
     send_mode: str
@@ -109,10 +355,17 @@ class Transmittal(BaseModel):
     status: str = "draft"  # draft, generated, sent, received
     document_count: int = 0
     created_date: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    version: int = 1  # bumped on every write, source of the ETag
     generated_date: Optional[datetime] = None
     send_details: Optional[SendDetails] = None
     receive_details: Optional[ReceiveDetails] = None
     sent_status: Optional[str] = None  # Sent, Not Sent
+    last_shared_at: Optional[datetime] = None
+    last_shared_via: Optional[str] = None  # email, teams
+    ack_due_at: Optional[datetime] = None  # set while a sent transmittal awaits acknowledgement
+    next_reminder_at: Optional[datetime] = None  # when the scanner may remind about it next
+    last_reminded_at: Optional[datetime] = None
     received_status: Optional[str] = None  # Received, Not Received
 
 class TransmittalResponse(BaseModel):
@@ -125,6 +378,7 @@ class TransmittalResponse(BaseModel):
     send_to: str
     salutation: str
     recipient_name: str
+    recipient_email: Optional[str] = None
     sender_name: str
     sender_designation: str
     send_mode: str
@@ -136,88 +390,558 @@ class TransmittalResponse(BaseModel):
     status: str
     document_count: int
     created_date: datetime
+    updated_at: Optional[datetime] = None
+    version: int = 1
+    generated_date: Optional[datetime] = None
+    send_details: Optional[SendDetails] = None
+    receive_details: Optional[ReceiveDetails] = None
+    sent_status: Optional[str] = None
+    received_status: Optional[str] = None
+    last_shared_at: Optional[datetime] = None
+    last_shared_via: Optional[str] = None
+    ack_due_at: Optional[datetime] = None
+    next_reminder_at: Optional[datetime] = None
+    last_reminded_at: Optional[datetime] = None
+
+class TransmittalSummaryResponse(BaseModel):
+    id: str
+    transmittal_number: Optional[str] = None
+    transmittal_type: str
+    department: str
+    design_stage: Optional[str] = None
+    transmittal_date: date
+    send_to: str
+    salutation: str
+    recipient_name: str
+    recipient_email: Optional[str] = None
+    sender_name: str
+    sender_designation: str
+    send_mode: str
+    title: str
+    project_name: Optional[str] = None
+    purpose: Optional[str] = None
+    remarks: Optional[str] = None
+    status: str
+    document_count: int
+    created_date: datetime
+    updated_at: Optional[datetime] = None
+    version: int = 1
     generated_date: Optional[datetime] = None
     send_details: Optional[SendDetails] = None
     receive_details: Optional[ReceiveDetails] = None
     sent_status: Optional[str] = None
     received_status: Optional[str] = None
+    last_shared_at: Optional[datetime] = None
+    last_shared_via: Optional[str] = None
+    ack_due_at: Optional[datetime] = None
+    next_reminder_at: Optional[datetime] = None
+    last_reminded_at: Optional[datetime] = None
+    # The summary leaves the receipt images out; when this is set, cards load
+    # the thumbnail from /transmittals/{id}/receipt?variant=thumbnail
+    has_receipt_thumbnail: bool = False
+
+    @model_validator(mode="after")
+    def flag_receipt_thumbnail(self):
+        self.has_receipt_thumbnail = bool(self.receive_details and self.receive_details.receipt_status == "ready")
+        return self
+
+TransmittalView = Literal["full", "summary"]
+
+class TransmittalBatch(BaseModel):
+    transmittals: List[Union[TransmittalResponse, TransmittalSummaryResponse]]
+    missing: List[str]
+
+class TransmittalChanges(BaseModel):
+    changed: List[TransmittalResponse]
+    deleted: List[str]
+    checkpoint: datetime
+    checkpoint_id: Optional[str] = None
+    has_more: bool
+
+class FacetValue(BaseModel):
+    value: Optional[str] = None
+    count: int
+
+class TransmittalFacets(BaseModel):
+    total: int
+    facets: Dict[str, List[FacetValue]]
+
+class TransmittalFilters:
+    """Query parameters shared by the list, count and facet endpoints.
+
+    Each field may be repeated (``?department=A&department=B``) to match any
+    of the given values; different fields are combined with AND.
+    """
+
+    def __init__(
+        self,
+        status: Optional[List[str]] = Query(None),
+        department: Optional[List[str]] = Query(None),
+        transmittal_type: Optional[List[str]] = Query(None),
+        design_stage: Optional[List[str]] = Query(None),
+        send_to: Optional[List[str]] = Query(None),
+        send_mode: Optional[List[str]] = Query(None),
+        project_name: Optional[List[str]] = Query(None),
+    ):
+        self.status = status
+        self.department = department
+        self.transmittal_type = transmittal_type
+        self.design_stage = design_stage
+        self.send_to = send_to
+        self.send_mode = send_mode
+        self.project_name = project_name
+
+    def to_dict(self) -> Dict[str, Optional[List[str]]]:
+        return {field: getattr(self, field) for field in FILTER_FIELDS}
+
+def to_view_response(transmittal: dict, view: TransmittalView):
+    if view == "summary":
+        return TransmittalSummaryResponse(**transmittal)
+    return TransmittalResponse(**transmittal)
+
+def transmittal_etag(transmittal: dict, view: TransmittalView = "full") -> str:
+    """Strong ETag for a single transmittal, derived from its version"""
+    suffix = "-summary" if view == "summary" else ""
+    return f'"{transmittal["id"]}-{transmittal.get("version", 0)}{suffix}"'
+
+def list_etag(transmittals: List[dict], view: TransmittalView) -> str:
+    """Weak ETag for a page, derived from the ids and versions it contains"""
+    digest = hashlib.sha1(view.encode())
+    for transmittal in transmittals:
+        digest.update(f"|{transmittal['id']}:{transmittal.get('version', 0)}".encode())
+    return f'W/"{digest.hexdigest()}"'
+
+def etag_matches(header: Optional[str], etag: str, weak: bool = True) -> bool:
+    """Check an If-Match / If-None-Match header against an ETag.
+
+    If-None-Match uses weak comparison, If-Match strong comparison (RFC 9110).
+    """
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    if "*" in candidates:
+        return True
+    if not weak:
+        return etag in candidates and not etag.startswith("W/")
+    strip = lambda tag: tag[2:] if tag.startswith("W/") else tag
+    return strip(etag) in {strip(candidate) for candidate in candidates}
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+def check_if_match(if_match: Optional[str], transmittal: dict) -> Optional[int]:
+    """Enforce If-Match and return the version the update must be pinned to,
+    so a concurrent write in between fails too"""
+    if if_match is None:
+        return None
+    if not etag_matches(if_match, transmittal_etag(transmittal), weak=False):
+        raise HTTPException(status_code=412, detail="Transmittal has been modified")
+    return transmittal.get("version")
+
+async def run_idempotent(idempotency_key: Optional[str], scope: str, payload, response: Response, operation):
+    """Run a mutating operation at most once per Idempotency-Key.
+
+    The first request claims the key with a pending record, leased until
+    IDEMPOTENCY_LEASE_SECONDS from now, runs the operation and stores its
+    response. A retry with the same key and payload gets the stored response
+    back without touching the transmittals again, or takes the key over once
+    the lease has run out; reusing a key for a different request is
+    rejected. Requests without the header run normally.
+    """
+    if not idempotency_key:
+        return await operation()
+    
+    request_hash = hashlib.sha256(
+        json.dumps(jsonable_encoder(payload), sort_keys=True).encode()
+    ).hexdigest()
+    now = datetime.utcnow()
+    lease_id = uuid.uuid4().hex
+    claimed = await storage.idempotency_keys.claim({
+        "key": idempotency_key,
+        "scope": scope,
+        "request_hash": request_hash,
+        "state": "pending",
+        "lease_id": lease_id,
+        "locked_until": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS),
+        "created_at": now
+    })
+    if not claimed:
+        record = await storage.idempotency_keys.get(idempotency_key)
+        if not record:
+            raise HTTPException(status_code=409, detail="Idempotency-Key expired while in use, retry the request",
+                                headers={"Retry-After": "1"})
+        if record["scope"] != scope or record["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if record["state"] == "pending":
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress",
+                                headers={"Retry-After": "1"})
+        headers = dict(record.get("headers") or {})
+        headers["Idempotent-Replayed"] = "true"
+        return JSONResponse(status_code=record["status_code"], content=record["response"], headers=headers)
+    
+    try:
+        result = await operation()
+    except BaseException:
+        # Nothing was committed for a failed request, so release the key
+        # and let the client retry it. Cancelled requests (a client that
+        # went away) release it too, shielded so the release itself is not
+        # cancelled
+        await asyncio.shield(storage.idempotency_keys.release(idempotency_key, lease_id))
+        raise
+    
+    headers = {"ETag": response.headers["ETag"]} if "ETag" in response.headers else {}
+    await storage.idempotency_keys.complete(idempotency_key, 200, jsonable_encoder(result), headers)
+    return result
+
+def encode_status_cursor(status_check: dict) -> str:
+    return f"{status_check['timestamp'].isoformat()}_{status_check['id']}"
+
+def decode_status_cursor(cursor: str) -> StatusCursor:
+    try:
+        timestamp, status_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(timestamp), status_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def holds_issue(issue: dict) -> bool:
+    """Whether the recipient has the issued copy: it was sent or received"""
+    return issue.get("sent_status") == "Sent" or issue.get("status") == "received"
+
+def recipient_key(issue: dict) -> Tuple:
+    if issue.get("recipient_email"):
+        return (issue["recipient_email"].lower(),)
+    return (issue.get("recipient_name"), issue.get("send_to"))
+
+async def update_issue_index(write, transmittal_id: str) -> None:
+    """Run a document issue index write that follows a committed change.
+
+    A failure is logged rather than raised: the transmittal change is
+    already saved, and POST /documents/issues/rebuild repairs the index.
+    """
+    try:
+        await write
+    except Exception:
+        logger.exception(f"Document issue index not updated for transmittal {transmittal_id}")
+
+def document_issue_history(document_no: str, issues: List[dict]) -> DocumentIssueHistory:
+    revisions = [issue["revision"] for issue in issues if issue.get("revision") is not None]
+    latest = max(revisions) if revisions else None
+
+    # Issues arrive highest revision first, so the first held issue per
+    # recipient is the newest one they have
+    newest_held: Dict[Tuple, dict] = {}
+    for issue in issues:
+        if holds_issue(issue):
+            newest_held.setdefault(recipient_key(issue), issue)
+
+    def superseded(issue: dict) -> bool:
+        return latest is not None and issue.get("revision") is not None and issue["revision"] < latest
+
+    return DocumentIssueHistory(
+        document_no=document_no,
+        latest_revision=latest,
+        issues=[DocumentIssue(**issue, superseded=superseded(issue)) for issue in issues],
+        superseded_holders=[
+            DocumentIssue(**issue, superseded=True) for issue in newest_held.values() if superseded(issue)
+        ],
+    )
 
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
 async def root():
     return {"message": "Hello World"}
 
+@api_router.get("/metrics/coalescing")
+async def get_coalescing_metrics():
+    """How many list/count/facet queries were answered by sharing another
+    call's database query or its recent result"""
+    return query_coalescer.metrics()
+
+@api_router.get("/metrics/admission")
+async def get_admission_metrics():
+    """Concurrency, queue depth and rejections of each priority class in
+    this worker"""
+    return admission_controller.metrics()
+
+@api_router.get("/health/live")
+async def liveness():
+    """This worker is serving requests; never touches the database"""
+    return {"status": "alive", "worker": os.getpid()}
+
+@api_router.get("/health/ready")
+async def readiness():
+    """200 once this worker has finished startup and can reach the
+    database, 503 while starting, draining or cut off from it"""
+    status = lifecycle.status()
+    if storage is not None:
+        status["pool"] = storage.pool_stats()
+    if status["status"] == "ready":
+        try:
+            await asyncio.wait_for(storage.ping(), READINESS_TIMEOUT_SECONDS)
+        except Exception as exc:
+            status["status"] = "unavailable"
+            status["error"] = str(exc) or type(exc).__name__
+    return JSONResponse(status, status_code=200 if status["status"] == "ready" else 503)
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
     status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    await storage.status_checks.insert(status_obj.dict())
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
+async def get_status_checks(
+    response: Response,
+    client_name: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    format: Literal["json", "ndjson"] = "json",
+    accept_encoding: Optional[str] = Header(None)
+):
+    """Get status checks newest first.
+
+    JSON pages hold at most STATUS_PAGE_MAX entries; pass the X-Next-Cursor
+    response header back as ``cursor`` for the next page. ``format=ndjson``
+    streams every matching entry (or ``limit`` of them) without buffering.
+    """
+    before = decode_status_cursor(cursor) if cursor else None
+    if format == "ndjson":
+        return ndjson_response(
+            storage.status_checks.iterate(client_name, before, limit), StatusCheck, accept_encoding
+        )
+    
+    limit = min(limit or STATUS_PAGE_DEFAULT, STATUS_PAGE_MAX)
+    status_checks = await storage.status_checks.list(client_name, before, limit)
+    if len(status_checks) == limit:
+        response.headers["X-Next-Cursor"] = encode_status_cursor(status_checks[-1])
     return [StatusCheck(**status_check) for status_check in status_checks]
 
+@api_router.get("/status/rates", response_model=List[StatusRate])
+async def get_status_rates(
+    window: int = Query(300, ge=60, le=86400),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    client_name: Optional[str] = None
+):
+    """Get probe counts per client_name over fixed time windows (in seconds)"""
+    until = until or datetime.utcnow()
+    since = since or until - timedelta(hours=24)
+    buckets = await storage.status_checks.rates(since, until, window, client_name)
+    return [
+        StatusRate(client_name=name, window_start=window_start, count=count, per_minute=count * 60 / window)
+        for name, window_start, count in buckets
+    ]
+
 # Transmittal API Endpoints
 
 @api_router.post("/transmittals", response_model=TransmittalResponse)
-async def create_transmittal(transmittal_data: TransmittalCreate):
+async def create_transmittal(
+    transmittal_data: TransmittalCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None)
+):
     """Create a new transmittal as draft"""
-    transmittal_dict = transmittal_data.dict()
-    transmittal_dict['document_count'] = len(transmittal_data.documents)
-    transmittal_obj = Transmittal(**transmittal_dict)
+    async def operation():
+        transmittal_dict = transmittal_data.dict()
+        transmittal_dict['document_count'] = len(transmittal_data.documents)
+        transmittal_obj = Transmittal(**transmittal_dict)
     
-    # Convert to dict with proper serialization for MongoDB
-    insert_dict = transmittal_obj.dict()
-    # Convert date objects to ISO format strings for MongoDB
-    if isinstance(insert_dict.get('transmittal_date'), date):
-        insert_dict['transmittal_date'] = insert_dict['transmittal_date'].isoformat()
+        # Convert to dict with proper serialization for MongoDB
+        insert_dict = transmittal_obj.dict()
+        # Convert date objects to ISO format strings for MongoDB
+        if isinstance(insert_dict.get('transmittal_date'), date):
+            insert_dict['transmittal_date'] = insert_dict['transmittal_date'].isoformat()
     
-    await db.transmittals.insert_one(insert_dict)
-    return TransmittalResponse(**transmittal_obj.dict())
+        await storage.transmittals.insert(insert_dict)
+        response.headers["ETag"] = transmittal_etag(insert_dict)
+        return TransmittalResponse(**transmittal_obj.dict())
+    
+    return await run_idempotent(idempotency_key, "POST /transmittals", transmittal_data, response, operation)
 
-@api_router.get("/transmittals", response_model=List[TransmittalResponse])
+@api_router.get("/transmittals", response_model=List[Union[TransmittalResponse, TransmittalSummaryResponse]])
 async def get_transmittals(
-    status: Optional[str] = None,
+    filters: TransmittalFilters = Depends(),
     skip: int = 0,
-    limit: int = 9
+    limit: Optional[int] = None,
+    view: TransmittalView = "full",
+    format: Literal["json", "ndjson"] = "json",
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None)
 ):
-    """Get transmittals with optional filtering and pagination"""
-    query = {}
-    if status and status != "all":
-        query["status"] = status
+    """Get transmittals with optional filtering and pagination.
+
+    JSON returns one page of ``limit`` (default 9). ``format=ndjson`` streams
+    every match after ``skip`` (or ``limit`` of them) as the cursor is read,
+    gzip or brotli compressed when the client accepts it; meant for
+    integrations that mirror all transmittals.
+    """
+    if format == "ndjson":
+        return ndjson_response(
+            storage.transmittals.iterate(filters.to_dict(), skip, limit, view=view),
+            TransmittalSummaryResponse if view == "summary" else TransmittalResponse,
+            accept_encoding,
+        )
+
+    if limit is None:
+        limit = 9
+    if if_none_match:
+        # Revalidation: compare against ids and versions only, and load the
+        # full page only when it has actually changed
+        page = await query_coalescer.run(
+            ("list", filters_key(filters.to_dict()), skip, limit, "version"),
+            lambda: storage.transmittals.list(filters.to_dict(), skip, limit, view="version"),
+        )
+        etag = list_etag(page, view)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
     
-    transmittals = await db.transmittals.find(query).sort("created_date", -1).skip(skip).limit(limit).to_list(limit)
-    return [TransmittalResponse(**transmittal) for transmittal in transmittals]
+    transmittals = await query_coalescer.run(
+        ("list", filters_key(filters.to_dict()), skip, limit, view),
+        lambda: storage.transmittals.list(filters.to_dict(), skip, limit, view=view),
+    )
+    etag = list_etag(transmittals, view)
+    return JSONResponse(
+        content=jsonable_encoder([to_view_response(transmittal, view) for transmittal in transmittals]),
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
 
 @api_router.get("/transmittals/count")
-async def get_transmittals_count(status: Optional[str] = None):
+async def get_transmittals_count(filters: TransmittalFilters = Depends()):
     """Get total count of transmittals"""
-    query = {}
-    if status and status != "all":
-        query["status"] = status
-    
-    count = await db.transmittals.count_documents(query)
+    count = await query_coalescer.run(
+        ("count", filters_key(filters.to_dict())),
+        lambda: storage.transmittals.count(filters.to_dict()),
+    )
     return {"count": count}
 
-@api_router.get("/transmittals/{transmittal_id}", response_model=TransmittalResponse)
-async def get_transmittal(transmittal_id: str):
+@api_router.get("/transmittals/facets", response_model=TransmittalFacets)
+async def get_transmittal_facets(filters: TransmittalFilters = Depends()):
+    """Get per-value counts for every filterable field.
+
+    Each field's counts apply the other fields' filters but not its own, so
+    the values not selected still show what adding them would match.
+    """
+    total, facets = await query_coalescer.run(
+        ("facets", filters_key(filters.to_dict())),
+        lambda: storage.transmittals.facets(filters.to_dict()),
+    )
+    return TransmittalFacets(
+        total=total,
+        facets={
+            field: [FacetValue(value=value, count=count) for value, count in values]
+            for field, values in facets.items()
+        },
+    )
+
+@api_router.get("/transmittals/batch", response_model=TransmittalBatch)
+async def get_transmittals_batch(ids: List[str] = Query(...), view: TransmittalView = "full"):
+    """Get many transmittals by id in one query, in the order requested"""
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids can be requested at once")
+    
+    transmittals = await storage.transmittals.get_many(ids, view=view)
+    by_id = {transmittal["id"]: transmittal for transmittal in transmittals}
+    return TransmittalBatch(
+        transmittals=[to_view_response(by_id[i], view) for i in ids if i in by_id],
+        missing=[i for i in ids if i not in by_id]
+    )
+
+@api_router.get("/transmittals/changes", response_model=TransmittalChanges)
+async def get_transmittal_changes(
+    since: Optional[datetime] = None,
+    since_id: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=1000)
+):
+    """Get transmittals changed or deleted after a checkpoint, oldest first.
+
+    Pass the returned ``checkpoint`` and ``checkpoint_id`` as ``since`` and
+    ``since_id`` on the next call; keep calling while ``has_more`` is true.
+    Omitting ``since`` starts from the beginning. Changes from the last
+    CHANGES_SETTLE_SECONDS are reported on a later call.
+    """
+    if since is None:
+        since = datetime.min
+    elif since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    horizon = datetime.utcnow() - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    if since != datetime.min and since < horizon:
+        raise HTTPException(status_code=410, detail="Checkpoint is older than tombstone retention, full resync required")
+    
+    settled_before = datetime.utcnow() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    changed = await storage.transmittals.changed_since(since, limit + 1, since_id)
+    deleted = await storage.transmittals.deleted_since(since, limit + 1, since_id)
+    
+    # Ordered by (timestamp, id), the same cursor the next page starts after
+    events = sorted(
+        [(t["updated_at"], t["id"], "changed", t) for t in changed] +
+        [(t["deleted_at"], t["id"], "deleted", t) for t in deleted],
+        key=lambda event: event[:2]
+    )
+    events = [event for event in events if event[0] <= settled_before]
+    has_more = len(events) > limit
+    events = events[:limit]
+    
+    return TransmittalChanges(
+        changed=[TransmittalResponse(**t) for _, _, kind, t in events if kind == "changed"],
+        deleted=[transmittal_id for _, transmittal_id, kind, _ in events if kind == "deleted"],
+        checkpoint=events[-1][0] if events else since,
+        checkpoint_id=events[-1][1] if events else since_id,
+        has_more=has_more
+    )
+
+@api_router.get("/transmittals/overdue", response_model=List[TransmittalSummaryResponse])
+async def get_overdue_transmittals(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """Sent transmittals whose acknowledgement is overdue, most overdue first"""
+    transmittals = await storage.transmittals.overdue(datetime.utcnow(), skip, limit)
+    return [TransmittalSummaryResponse(**transmittal) for transmittal in transmittals]
+
+@api_router.post("/transmittals/overdue/remind")
+async def remind_overdue_transmittals():
+    """Run the overdue scan now instead of waiting for the next interval"""
+    reminded = await acknowledgement_scanner.scan_once()
+    return {"message": "Reminders queued", "reminded": reminded}
+
+@api_router.get("/transmittals/{transmittal_id}", response_model=Union[TransmittalResponse, TransmittalSummaryResponse])
+async def get_transmittal(
+    transmittal_id: str,
+    response: Response,
+    view: TransmittalView = "full",
+    if_none_match: Optional[str] = Header(None)
+):
     """Get a specific transmittal by ID"""
-    transmittal = await db.transmittals.find_one({"id": transmittal_id})
+    if if_none_match:
+        current = await storage.transmittals.get(transmittal_id, view="version")
+        if current and etag_matches(if_none_match, transmittal_etag(current, view)):
+            return not_modified(transmittal_etag(current, view))
+    
+    transmittal = await storage.transmittals.get(transmittal_id, view=view)
     if not transmittal:
         raise HTTPException(status_code=404, detail="Transmittal not found")
-    return TransmittalResponse(**transmittal)
+    response.headers["ETag"] = transmittal_etag(transmittal, view)
+    response.headers["Cache-Control"] = "no-cache"
+    return to_view_response(transmittal, view)
 
 @api_router.put("/transmittals/{transmittal_id}", response_model=TransmittalResponse)
-async def update_transmittal(transmittal_id: str, update_data: TransmittalUpdate):
+async def update_transmittal(
+    transmittal_id: str,
+    update_data: TransmittalUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None)
+):
     """Update a transmittal (only if status is draft)"""
-    transmittal = await db.transmittals.find_one({"id": transmittal_id})
+    transmittal = await storage.transmittals.get(transmittal_id, view="version")
     if not transmittal:
         raise HTTPException(status_code=404, detail="Transmittal not found")
     
     if transmittal.get("status") != "draft":
         raise HTTPException(status_code=400, detail="Cannot edit generated transmittal")
+    expected_version = check_if_match(if_match, transmittal)
     
     update_dict = {k: v for k, v in update_data.dict().items() if v is not None}
     if 'documents' in update_dict:
@@ -226,133 +950,465 @@ async def update_transmittal(transmittal_id: str, update_data: TransmittalUpdate
     # Convert date objects to ISO format strings for MongoDB
     if 'transmittal_date' in update_dict and isinstance(update_dict['transmittal_date'], date):
         update_dict['transmittal_date'] = update_dict['transmittal_date'].isoformat()
+    update_dict['updated_at'] = datetime.utcnow()
     
-    await db.transmittals.update_one(
-        {"id": transmittal_id},
-        {"$set": update_dict}
-    )
-    
-    updated_transmittal = await db.transmittals.find_one({"id": transmittal_id})
+    updated_transmittal = await storage.transmittals.update(transmittal_id, update_dict, expected_version)
+    if not updated_transmittal:
+        raise HTTPException(status_code=412, detail="Transmittal has been modified")
+    response.headers["ETag"] = transmittal_etag(updated_transmittal)
     return TransmittalResponse(**updated_transmittal)
 
+async def raise_document_write_error(transmittal_id: str, document_no: Optional[str] = None):
+    """Explain why a positional document update matched nothing"""
+    transmittal = await storage.transmittals.get(transmittal_id, view="version")
+    if not transmittal:
+        raise HTTPException(status_code=404, detail="Transmittal not found")
+    if transmittal.get("status") != "draft":
+        raise HTTPException(status_code=400, detail="Cannot edit generated transmittal")
+    if document_no is not None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    raise HTTPException(status_code=409, detail="Document number already exists in this transmittal")
+
+@api_router.get("/transmittals/{transmittal_id}/documents", response_model=DocumentPage)
+async def get_transmittal_documents(
+    transmittal_id: str,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=500)
+):
+    """Get one page of a transmittal's documents without loading the rest"""
+    page = await storage.transmittals.get_documents(transmittal_id, skip, limit)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Transmittal not found")
+    total, page_documents = page
+    return DocumentPage(total=total, skip=skip, limit=limit, documents=page_documents)
+
+@api_router.post("/transmittals/{transmittal_id}/documents", response_model=List[DocumentItem])
+async def add_transmittal_documents(
+    transmittal_id: str,
+    documents: List[DocumentItem],
+    response: Response,
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Append documents to a draft transmittal"""
+    async def operation():
+        document_nos = [document.document_no for document in documents]
+        if len(set(document_nos)) != len(document_nos):
+            raise HTTPException(status_code=400, detail="Duplicate document numbers in request")
+    
+        updated = await storage.transmittals.push_documents(
+            transmittal_id, [document.dict() for document in documents], datetime.utcnow()
+        )
+        if not updated:
+            await raise_document_write_error(transmittal_id)
+        response.headers["ETag"] = transmittal_etag(updated)
+        return documents
+    
+    return await run_idempotent(idempotency_key, f"POST /transmittals/{transmittal_id}/documents", documents, response, operation)
+
+@api_router.patch("/transmittals/{transmittal_id}/documents/{document_no}", response_model=DocumentItem)
+async def update_transmittal_document(
+    transmittal_id: str,
+    document_no: str,
+    update_data: DocumentItemUpdate,
+    response: Response
+):
+    """Update a single document of a draft transmittal in place"""
+    update_dict = {k: v for k, v in update_data.dict().items() if v is not None}
+    if not update_dict:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    
+    result = await storage.transmittals.update_document(transmittal_id, document_no, update_dict, datetime.utcnow())
+    if not result:
+        exists = await storage.transmittals.has_document(transmittal_id, document_no)
+        await raise_document_write_error(transmittal_id, None if exists else document_no)
+    updated, document = result
+    response.headers["ETag"] = transmittal_etag(updated)
+    return DocumentItem(**document)
+
+@api_router.delete("/transmittals/{transmittal_id}/documents/{document_no}")
+async def delete_transmittal_document(transmittal_id: str, document_no: str, response: Response):
+    """Remove a single document from a draft transmittal"""
+    updated = await storage.transmittals.pull_document(transmittal_id, document_no, datetime.utcnow())
+    if not updated:
+        await raise_document_write_error(transmittal_id, document_no)
+    response.headers["ETag"] = transmittal_etag(updated)
+    return {"message": "Document removed successfully"}
+
 @api_router.delete("/transmittals/{transmittal_id}")
 async def delete_transmittal(transmittal_id: str):
     """Delete a transmittal (only if status is draft)"""
-    transmittal = await db.transmittals.find_one({"id": transmittal_id})
+    transmittal = await storage.transmittals.get(transmittal_id, view="version")
     if not transmittal:
         raise HTTPException(status_code=404, detail="Transmittal not found")
     
     if transmittal.get("status") != "draft":
         raise HTTPException(status_code=400, detail="Cannot delete generated transmittal")
     
-    await db.transmittals.delete_one({"id": transmittal_id})
+    await storage.transmittals.delete(transmittal_id, datetime.utcnow())
     return {"message": "Transmittal deleted successfully"}
 
 @api_router.post("/transmittals/{transmittal_id}/generate", response_model=TransmittalResponse)
-async def generate_transmittal(transmittal_id: str):
-    """Generate a transmittal (change status from draft to generated)"""
-    transmittal = await db.transmittals.find_one({"id": transmittal_id})
-    if not transmittal:
-        raise HTTPException(status_code=404, detail="Transmittal not found")
+async def generate_transmittal(
+    transmittal_id: str,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    if_match: Optional[str] = Header(None)
+):
+    """Generate a transmittal (change status from draft to generated).
+
+    The update is pinned to the version checked here (or to If-Match), so a
+    write in between fails with 409 (412 for If-Match) instead of being
+    generated unseen.
+    """
+    async def operation():
+        transmittal = await storage.transmittals.get(transmittal_id, view="version")
+        if not transmittal:
+            raise HTTPException(status_code=404, detail="Transmittal not found")
     
-    if transmittal.get("status") != "draft":
-        raise HTTPException(status_code=400, detail="Transmittal already generated")
+        if transmittal.get("status") != "draft":
+            raise HTTPException(status_code=400, detail="Transmittal already generated")
+        expected_version = check_if_match(if_match, transmittal) or transmittal.get("version")
     
-    # Generate transmittal number
-    count = await db.transmittals.count_documents({"status": {"$ne": "draft"}})
-    transmittal_number = f"TRN-{datetime.now().year}-{str(count + 1).zfill(3)}"
+        # Generate transmittal number
+        count = await storage.transmittals.count_issued()
+        transmittal_number = f"TRN-{datetime.now().year}-{str(count + 1).zfill(3)}"
+        now = datetime.utcnow()
     
-    await db.transmittals.update_one(
-        {"id": transmittal_id},
-        {"$set": {
+        updated_transmittal = await storage.transmittals.update(transmittal_id, {
             "status": "generated",
             "transmittal_number": transmittal_number,
-            "generated_date": datetime.utcnow()
-        }}
-    )
+            "generated_date": now,
+            "updated_at": now
+        }, expected_version, action="generate")
+        if not updated_transmittal:
+            current = await storage.transmittals.get(transmittal_id, view="version")
+            if not current:
+                raise HTTPException(status_code=404, detail="Transmittal not found")
+            if current.get("status") != "draft":
+                raise HTTPException(status_code=400, detail="Transmittal already generated")
+            if if_match is not None:
+                raise HTTPException(status_code=412, detail="Transmittal has been modified")
+            raise HTTPException(status_code=409, detail="Transmittal was modified while being generated, retry the request")
+        await update_issue_index(storage.document_issues.index(updated_transmittal), transmittal_id)
+        return TransmittalResponse(**updated_transmittal)
     
-    updated_transmittal = await db.transmittals.find_one({"id": transmittal_id})
-    return TransmittalResponse(**updated_transmittal)
+    return await run_idempotent(idempotency_key, f"POST /transmittals/{transmittal_id}/generate", None, response, operation)
 
 @api_router.post("/transmittals/{transmittal_id}/duplicate", response_model=TransmittalResponse)
-async def duplicate_transmittal(transmittal_id: str, mode: str = "opposite"):
+async def duplicate_transmittal(
+    transmittal_id: str,
+    response: Response,
+    mode: str = "opposite",
+    idempotency_key: Optional[str] = Header(None)
+):
     """Duplicate transmittal with opposite send mode or same mode"""
-    transmittal = await db.transmittals.find_one({"id": transmittal_id})
-    if not transmittal:
-        raise HTTPException(status_code=404, detail="Transmittal not found")
+    async def operation():
+        transmittal = await storage.transmittals.get(transmittal_id)
+        if not transmittal:
+            raise HTTPException(status_code=404, detail="Transmittal not found")
     
-    # Create duplicate
-    duplicate_dict = dict(transmittal)
-    duplicate_dict.pop("_id", None)  # Remove MongoDB _id
-    duplicate_dict["id"] = str(uuid.uuid4())
-    duplicate_dict["status"] = "draft"
-    duplicate_dict["transmittal_number"] = None
-    duplicate_dict["generated_date"] = None
-    duplicate_dict["created_date"] = datetime.utcnow()
-    duplicate_dict["send_details"] = None
-    duplicate_dict["receive_details"] = None
-    duplicate_dict["sent_status"] = None
-    duplicate_dict["received_status"] = None
-    
-    # Change send mode if mode is opposite
-    if mode == "opposite":
-        duplicate_dict["send_mode"] = "Hardcopy" if transmittal["send_mode"] == "Softcopy" else "Softcopy"
-        duplicate_dict["title"] = f"{duplicate_dict['title']} - {duplicate_dict['send_mode']} Copy"
-    else:
-        duplicate_dict["title"] = f"{duplicate_dict['title']} - Copy"
+        # Create duplicate
+        duplicate_dict = dict(transmittal)
+        duplicate_dict["id"] = str(uuid.uuid4())
+        duplicate_dict["status"] = "draft"
+        duplicate_dict["transmittal_number"] = None
+        duplicate_dict["generated_date"] = None
+        duplicate_dict["created_date"] = datetime.utcnow()
+        duplicate_dict["updated_at"] = duplicate_dict["created_date"]
+        duplicate_dict["version"] = 1
+        duplicate_dict["send_details"] = None
+        duplicate_dict["receive_details"] = None
+        duplicate_dict["sent_status"] = None
+        duplicate_dict["received_status"] = None
+        duplicate_dict["last_shared_at"] = None
+        duplicate_dict["last_shared_via"] = None
+        duplicate_dict["ack_due_at"] = None
+        duplicate_dict["next_reminder_at"] = None
+        duplicate_dict["last_reminded_at"] = None
+    
+        # Change send mode if mode is opposite
+        if mode == "opposite":
+            duplicate_dict["send_mode"] = "Hardcopy" if transmittal["send_mode"] == "Softcopy" else "Softcopy"
+            duplicate_dict["title"] = f"{duplicate_dict['title']} - {duplicate_dict['send_mode']} Copy"
+        else:
+            duplicate_dict["title"] = f"{duplicate_dict['title']} - Copy"
+    
+        await storage.transmittals.insert(duplicate_dict)
+        return TransmittalResponse(**duplicate_dict)
     
-    await db.transmittals.insert_one(duplicate_dict)
-    return TransmittalResponse(**duplicate_dict)
+    return await run_idempotent(idempotency_key, f"POST /transmittals/{transmittal_id}/duplicate", {"mode": mode}, response, operation)
 
 @api_router.post("/transmittals/{transmittal_id}/send")
-async def update_send_status(transmittal_id: str, send_details: SendDetails, sent_status: str):
+async def update_send_status(
+    transmittal_id: str,
+    send_details: SendDetails,
+    sent_status: str,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None)
+):
     """Update send details and status"""
-    transmittal = await db.transmittals.find_one({"id": transmittal_id})
-    if not transmittal:
-        raise HTTPException(status_code=404, detail="Transmittal not found")
+    async def operation():
+        transmittal = await storage.transmittals.get(transmittal_id, view="version")
+        if not transmittal:
+            raise HTTPException(status_code=404, detail="Transmittal not found")
+        expected_version = check_if_match(if_match, transmittal)
     
-    send_dict = send_details.dict()
-    # Convert datetime objects to ISO format strings for MongoDB if needed
-    if 'send_date' in send_dict and send_dict['send_date'] and isinstance(send_dict['send_date'], (date, datetime)):
-        send_dict['send_date'] = send_dict['send_date'].isoformat()
+        send_dict = send_details.dict()
+        # Convert datetime objects to ISO format strings for MongoDB if needed
+        if 'send_date' in send_dict and send_dict['send_date'] and isinstance(send_dict['send_date'], (date, datetime)):
+            send_dict['send_date'] = send_dict['send_date'].isoformat()
     
-    update_data = {
-        "status": "sent",
-        "send_details": send_dict,
-        "sent_status": sent_status
-    }
+        now = datetime.utcnow()
+        # Acknowledgement is only awaited once it has actually gone out
+        ack_due_at = now + timedelta(days=ACK_DUE_DAYS) if sent_status == "Sent" else None
+        update_data = {
+            "status": "sent",
+            "send_details": send_dict,
+            "sent_status": sent_status,
+            "ack_due_at": ack_due_at,
+            "next_reminder_at": ack_due_at,
+            "updated_at": now
+        }
     
-    await db.transmittals.update_one(
-        {"id": transmittal_id},
-        {"$set": update_data}
-    )
+        updated = await storage.transmittals.update(
+            transmittal_id, update_data, expected_version, view="version", action="send"
+        )
+        if not updated:
+            raise HTTPException(status_code=412, detail="Transmittal has been modified")
+        await update_issue_index(storage.document_issues.update_transmittal(transmittal_id, update_data), transmittal_id)
+        response.headers["ETag"] = transmittal_etag(updated)
+    
+        return {"message": "Send status updated successfully"}
     
-    return {"message": "Send status updated successfully"}
+    return await run_idempotent(idempotency_key, f"POST /transmittals/{transmittal_id}/send", {"send_details": send_details, "sent_status": sent_status}, response, operation)
 
 @api_router.post("/transmittals/{transmittal_id}/receive")
-async def update_receive_status(transmittal_id: str, receive_details: ReceiveDetails, received_status: str):
-    """Update receive details and status"""
-    transmittal = await db.transmittals.find_one({"id": transmittal_id})
-    if not transmittal:
-        raise HTTPException(status_code=404, detail="Transmittal not found")
+async def update_receive_status(
+    transmittal_id: str,
+    receive_details: ReceiveDetails,
+    received_status: str,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    if_match: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Update receive details and status; the receipt is optimized afterwards"""
+    async def operation():
+        transmittal = await storage.transmittals.get(transmittal_id, view="version")
+        if not transmittal:
+            raise HTTPException(status_code=404, detail="Transmittal not found")
+        expected_version = check_if_match(if_match, transmittal)
     
-    receive_dict = receive_details.dict()
-    # Convert date objects to ISO format strings for MongoDB
-    if 'received_date' in receive_dict and isinstance(receive_dict['received_date'], date):
-        receive_dict['received_date'] = receive_dict['received_date'].isoformat()
+        receive_dict = receive_details.dict()
+        # Convert date objects to ISO format strings for MongoDB
+        if 'received_date' in receive_dict and isinstance(receive_dict['received_date'], date):
+            receive_dict['received_date'] = receive_dict['received_date'].isoformat()
+        receive_dict.update(receipt_status=None, receipt_optimized=None, receipt_thumbnail=None, receipt_id=None)
+        if receive_dict.get('receipt_file'):
+            receive_dict.update(receipt_status="pending", receipt_id=uuid.uuid4().hex)
     
-    update_data = {
-        "status": "received",
-        "receive_details": receive_dict,
-        "received_status": received_status
-    }
+        update_data = {
+            "status": "received",
+            "receive_details": receive_dict,
+            "received_status": received_status,
+            "updated_at": datetime.utcnow()
+        }
+        if received_status == "Received":
+            update_data["ack_due_at"] = None
+            update_data["next_reminder_at"] = None
     
-    await db.transmittals.update_one(
-        {"id": transmittal_id},
-        {"$set": update_data}
-    )
+        updated = await storage.transmittals.update(
+            transmittal_id, update_data, expected_version, view="version", action="receive"
+        )
+        if not updated:
+            raise HTTPException(status_code=412, detail="Transmittal has been modified")
+        await update_issue_index(storage.document_issues.update_transmittal(transmittal_id, update_data), transmittal_id)
+        response.headers["ETag"] = transmittal_etag(updated)
+        if receive_dict['receipt_status'] == "pending":
+            background_tasks.add_task(receipt_sweeper.run, transmittal_id, receive_dict['receipt_id'])
+    
+        return {"message": "Receive status updated successfully"}
     
-    return {"message": "Receive status updated successfully"}
+    return await run_idempotent(idempotency_key, f"POST /transmittals/{transmittal_id}/receive", {"receive_details": receive_details, "received_status": received_status}, response, operation)
+
+@api_router.post("/transmittals/{transmittal_id}/share")
+async def share_transmittal(
+    transmittal_id: str,
+    share: ShareRequest,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Queue a transmittal for delivery by email or Teams.
+
+    The messages go to the outbox in the same transaction as the status
+    change and are sent in the background, so this returns as soon as they
+    are queued. A generated transmittal becomes sent.
+    """
+    async def operation():
+        transmittal = await storage.transmittals.get(transmittal_id, view="summary")
+        if not transmittal:
+            raise HTTPException(status_code=404, detail="Transmittal not found")
+        if transmittal.get("status") == "draft":
+            raise HTTPException(status_code=400, detail="Generate the transmittal before sharing it")
+        check_if_match(if_match, transmittal)
+
+        recipients = list(dict.fromkeys(r.strip() for r in share.recipients if r.strip()))
+        if share.channel == "teams":
+            if not recipients and TEAMS_WEBHOOK_URL:
+                recipients = [TEAMS_WEBHOOK_URL]
+            if any(recipient not in TEAMS_WEBHOOK_ALLOWLIST for recipient in recipients):
+                raise HTTPException(status_code=400, detail="Teams recipients must be configured webhook URLs")
+        if not recipients:
+            raise HTTPException(status_code=400, detail="No recipients given")
+        if len(recipients) > SHARE_MAX_RECIPIENTS:
+            raise HTTPException(status_code=400, detail=f"At most {SHARE_MAX_RECIPIENTS} recipients per share")
+
+        now = datetime.utcnow()
+        update_data = {"last_shared_at": now, "last_shared_via": share.channel, "updated_at": now}
+        if transmittal["status"] == "generated":
+            update_data.update(
+                status="sent",
+                sent_status="Sent",
+                send_details={"delivery_person": None, "send_date": now.isoformat()},
+                ack_due_at=now + timedelta(days=ACK_DUE_DAYS),
+                next_reminder_at=now + timedelta(days=ACK_DUE_DAYS),
+            )
+        messages = compose_share_messages(transmittal, share.channel, recipients, share.note, now)
+
+        # Pinned to the version the messages were composed from
+        updated = await storage.outbox.enqueue(transmittal_id, update_data, messages, transmittal["version"])
+        if not updated:
+            raise HTTPException(status_code=412, detail="Transmittal has been modified")
+        response.headers["ETag"] = transmittal_etag(updated)
+        outbox_dispatcher.notify()
+
+        return {"message": "Share queued", "queued": len(messages)}
+
+    return await run_idempotent(idempotency_key, f"POST /transmittals/{transmittal_id}/share", share, response, operation)
+
+@api_router.get("/transmittals/{transmittal_id}/shares", response_model=List[ShareMessage])
+async def get_transmittal_shares(transmittal_id: str):
+    """Share messages queued for a transmittal and their delivery state"""
+    if not await storage.transmittals.get(transmittal_id, view="version"):
+        raise HTTPException(status_code=404, detail="Transmittal not found")
+    return [ShareMessage(**message) for message in await storage.outbox.list(transmittal_id)]
+
+@api_router.get("/transmittals/{transmittal_id}/history", response_model=TransmittalHistory)
+async def get_transmittal_history(
+    transmittal_id: str,
+    after_version: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=500)
+):
+    """Recorded changes of a transmittal, oldest first, each with a diff.
+
+    Pass the last returned version as ``after_version`` to continue while
+    ``has_more`` is true. The history stays available after deletion.
+    """
+    events = await transmittal_history(storage.audit, transmittal_id, after_version, limit + 1)
+    if not events and after_version == 0:
+        raise HTTPException(status_code=404, detail="No history recorded for this transmittal")
+    return TransmittalHistory(events=[AuditEvent(**event) for event in events[:limit]], has_more=len(events) > limit)
+
+@api_router.get("/transmittals/{transmittal_id}/as-of", response_model=TransmittalResponse)
+async def get_transmittal_as_of(transmittal_id: str, at: datetime):
+    """The transmittal as it was at a point in time, rebuilt from the audit
+    log (receipt images are not kept there)"""
+    if at.tzinfo is not None:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    transmittal = await transmittal_as_of(storage.audit, transmittal_id, at)
+    if not transmittal:
+        raise HTTPException(status_code=404, detail="No recorded state of this transmittal at that time")
+    return TransmittalResponse(**transmittal)
+
+async def optimize_receipt(transmittal_id: str, receipt_id: Optional[str]):
+    """Build the optimized receipt and thumbnail for one received transmittal.
+
+    Pinned to the receipt rather than the transmittal's version, so other
+    writes in the meantime do not strand it, while a receipt replaced in the
+    meantime is left to its own job.
+    """
+    pinned = {"receive_details.receipt_id": receipt_id, "receive_details.receipt_status": "pending"}
+    transmittal = await storage.transmittals.get(transmittal_id)
+    details = (transmittal or {}).get("receive_details") or {}
+    if details.get("receipt_id") != receipt_id or details.get("receipt_status") != "pending":
+        return
+    try:
+        content = decode_receipt(details["receipt_file"])
+        content_type = details.get("receipt_content_type") or sniff_content_type(content) or "application/octet-stream"
+        result = await receipt_processor.process(content, content_type)
+    except UnsupportedReceipt as e:
+        logger.info(f"Receipt of transmittal {transmittal_id} left as uploaded: {e}")
+        fields = {"receive_details.receipt_status": "unsupported"}
+    except Exception:
+        logger.exception(f"Failed to optimize receipt of transmittal {transmittal_id}")
+        fields = {"receive_details.receipt_status": "failed"}
+    else:
+        fields = {
+            "receive_details.receipt_status": "ready",
+            "receive_details.receipt_content_type": content_type,
+            "receive_details.receipt_optimized": (
+                base64.b64encode(result["optimized"]).decode('utf-8') if result["optimized"] else None
+            ),
+            "receive_details.receipt_thumbnail": base64.b64encode(result["thumbnail"]).decode('utf-8'),
+        }
+    fields["updated_at"] = datetime.utcnow()
+    updated = await storage.transmittals.update(
+        transmittal_id, fields, view="version", action="optimize_receipt", match=pinned
+    )
+    if not updated:
+        logger.info(f"Receipt of transmittal {transmittal_id} was replaced or removed while being optimized")
+
+@api_router.get("/transmittals/{transmittal_id}/receipt")
+async def get_receipt(
+    transmittal_id: str,
+    variant: Literal["original", "optimized", "thumbnail"] = "optimized",
+    if_none_match: Optional[str] = Header(None)
+):
+    """Download a receipt. The optimized variant falls back to the original
+    until processing has finished, or when it would not be smaller."""
+    transmittal = await storage.transmittals.get(transmittal_id)
+    if not transmittal:
+        raise HTTPException(status_code=404, detail="Transmittal not found")
+    details = transmittal.get("receive_details") or {}
+    if not details.get("receipt_file"):
+        raise HTTPException(status_code=404, detail="Transmittal has no receipt")
+
+    etag = f'"{transmittal_id}-{transmittal.get("version", 0)}-receipt-{variant}"'
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    if variant == "thumbnail":
+        if not details.get("receipt_thumbnail"):
+            raise HTTPException(status_code=404, detail="Receipt thumbnail not available")
+        content, content_type = decode_receipt(details["receipt_thumbnail"]), "image/jpeg"
+    elif variant == "optimized" and details.get("receipt_optimized"):
+        content, content_type = decode_receipt(details["receipt_optimized"]), "image/jpeg"
+    else:
+        content = decode_receipt(details["receipt_file"])
+        content_type = details.get("receipt_content_type") or sniff_content_type(content) or "application/octet-stream"
+
+    return Response(
+        content=content,
+        media_type=content_type,
+        headers={"ETag": etag, "Cache-Control": "no-cache"},
+    )
+
+@api_router.get("/documents/{document_no:path}/issues", response_model=DocumentIssueHistory)
+async def get_document_issues(document_no: str):
+    """Every transmittal that issued a document, highest revision first,
+    with the recipients still holding a superseded revision"""
+    issues = await storage.document_issues.list(document_no)
+    if not issues:
+        raise HTTPException(status_code=404, detail="Document has not been issued")
+    return document_issue_history(document_no, issues)
+
+@api_router.post("/documents/issues/rebuild")
+async def rebuild_document_issues():
+    """Recreate the document issue index from the transmittals"""
+    indexed = await storage.document_issues.rebuild()
+    return {"message": "Document issue index rebuilt", "indexed": indexed}
 
 @api_router.post("/transmittals/upload-receipt")
 async def upload_receipt(file: UploadFile = File(...)):
@@ -372,12 +1428,50 @@ async def upload_receipt(file: UploadFile = File(...)):
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Trace each request and, with TRACE_SERVER_TIMING, report its database
+    round trips and time split in a Server-Timing header. Traces are
+    exported either way. For streamed responses the trace ends once the
+    headers are sent."""
+    with start_trace(f"{request.method} {request.url.path}") as trace:
+        response = await call_next(request)
+    route = request.scope.get("route")
+    if route is not None:
+        trace.name = f"{request.method} {route.path}"
+    if TRACE_SERVER_TIMING:
+        response.headers["Server-Timing"] = trace.server_timing()
+    span_exporter.export(trace)
+    return response
+
+def admission_class(scope: dict) -> Optional[str]:
+    """Priority class of a request, or None if it is not limited"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            break
+    else:
+        # Not found or method not allowed; answered without the database
+        return None
+    if route.path in ADMISSION_EXEMPT_ROUTES:
+        return None
+    if route.path in ROUTE_PRIORITY_CLASSES:
+        return ROUTE_PRIORITY_CLASSES[route.path]
+    if parse_qs(scope["query_string"].decode("latin-1")).get("format") == ["ndjson"]:
+        return "export"
+    return "interactive"
+
+app.add_middleware(AdmissionMiddleware, controller=admission_controller, classify=admission_class)
+
+app.add_middleware(DrainMiddleware, lifecycle=lifecycle)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Idempotent-Replayed", "X-Next-Cursor", "Server-Timing", "Retry-After"],
 )
 
 # Configure logging
@@ -386,7 +1480,3 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
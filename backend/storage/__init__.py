@@ -0,0 +1,52 @@
+"""Storage backends for transmittals and status checks.
+
+STORAGE_BACKEND selects the implementation: ``mongo`` (default, needs
+MONGO_URL and DB_NAME) or ``sqlite`` (embedded, file at SQLITE_PATH).
+"""
+
+import os
+from pathlib import Path
+from typing import Sequence
+
+from .audit import transmittal_as_of, transmittal_history
+from .base import (
+    ACK_DUE_DAYS,
+    AUDIT_SNAPSHOT_INTERVAL,
+    DOCUMENT_ISSUE_FIELDS,
+    FILTER_FIELDS,
+    IDEMPOTENCY_KEY_TTL_HOURS,
+    OUTBOX_RETENTION_DAYS,
+    RECEIPT_BLOB_FIELDS,
+    STATUS_CHECK_RETENTION_DAYS,
+    TOMBSTONE_RETENTION_DAYS,
+    AuditRepository,
+    DocumentIssueRepository,
+    Filters,
+    IdempotencyKeyRepository,
+    OutboxRepository,
+    StatusCheckRepository,
+    StatusCursor,
+    Storage,
+    TransmittalRepository,
+    TransmittalView,
+)
+
+DEFAULT_SQLITE_PATH = Path(__file__).parent.parent / 'transmittals.db'
+
+
+def create_storage(mongo_listeners: Sequence = (), sqlite_listeners: Sequence = ()) -> Storage:
+    """Build the storage backend configured in the environment.
+
+    mongo_listeners are pymongo event listeners; sqlite_listeners are told
+    about every SQLite call (see SQLiteStorage). Only those of the selected
+    backend are used.
+    """
+    backend = os.environ.get('STORAGE_BACKEND', 'mongo')
+    if backend == 'mongo':
+        # Imported lazily so the SQLite backend runs without Motor installed
+        from .mongo import MongoStorage
+        return MongoStorage(os.environ['MONGO_URL'], os.environ['DB_NAME'], event_listeners=list(mongo_listeners))
+    if backend == 'sqlite':
+        from .sqlite import SQLiteStorage
+        return SQLiteStorage(os.environ.get('SQLITE_PATH', str(DEFAULT_SQLITE_PATH)), sqlite_listeners)
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}, expected 'mongo' or 'sqlite'")
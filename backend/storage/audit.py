@@ -0,0 +1,199 @@
+"""Audit events and their replay, shared by every storage backend.
+
+Each mutation of a transmittal is recorded as an event carrying the new
+version and the change applied, in the Mongo update vocabulary the
+repositories already speak:
+
+- ``set``: field path -> new value
+- ``push_documents``: documents appended
+- ``update_document``: ``{"document_no": ..., "set": {...}}``
+- ``pull_document``: document_no removed
+- ``state``: the whole transmittal, on create events only
+
+Events only say what was written, which the write path knows without
+reading the document first. Earlier values are recovered when the history is
+read, by replaying events onto the nearest snapshot.
+
+Receipt blobs (RECEIPT_BLOB_FIELDS) are left out of
+events and snapshots; a reconstructed transmittal keeps the receipt metadata
+but not the images.
+"""
+
+import copy
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from .base import AUDIT_SNAPSHOT_INTERVAL, RECEIPT_BLOB_FIELDS, AuditRepository
+
+AUDIT_OMITTED_FIELDS = RECEIPT_BLOB_FIELDS
+BLOB_PATHS = {f"receive_details.{field}" for field in AUDIT_OMITTED_FIELDS}
+
+
+def set_path(document: dict, path: str, value) -> None:
+    """Apply a Mongo-style $set of a possibly dotted field path"""
+    *parents, leaf = path.split(".")
+    for parent in parents:
+        if not isinstance(document.get(parent), dict):
+            document[parent] = {}
+        document = document[parent]
+    document[leaf] = value
+
+
+def get_path(document: dict, path: str):
+    """Value at a possibly dotted field path, None where it is missing"""
+    for key in path.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def without_blobs(fields: dict) -> dict:
+    """Copy of a transmittal or a set of fields minus the receipt blobs"""
+    stripped = {k: v for k, v in fields.items() if k not in BLOB_PATHS}
+    if isinstance(stripped.get("receive_details"), dict):
+        stripped["receive_details"] = {
+            k: v for k, v in stripped["receive_details"].items() if k not in AUDIT_OMITTED_FIELDS
+        }
+    return stripped
+
+
+def audit_event(transmittal_id: str, version: int, action: str, changes: dict, at: Optional[datetime] = None) -> dict:
+    if "set" in changes:
+        changes = {**changes, "set": without_blobs(changes["set"])}
+    return {
+        "id": str(uuid.uuid4()),
+        "transmittal_id": transmittal_id,
+        "version": version,
+        "at": at or (changes.get("set") or {}).get("updated_at") or datetime.utcnow(),
+        "action": action,
+        "changes": changes,
+    }
+
+
+def audit_snapshot(transmittal: dict, at: Optional[datetime] = None) -> dict:
+    return {
+        "transmittal_id": transmittal["id"],
+        "version": transmittal.get("version") or 0,
+        "at": at or transmittal.get("updated_at") or datetime.utcnow(),
+        "state": without_blobs(transmittal),
+    }
+
+
+def snapshot_due(version: int) -> bool:
+    return version % AUDIT_SNAPSHOT_INTERVAL == 0
+
+
+def apply_event(state: Optional[dict], event: dict) -> Optional[dict]:
+    """State after event; None once the transmittal is deleted"""
+    changes = event["changes"]
+    if event["action"] == "create":
+        return copy.deepcopy(changes["state"])
+    if state is None or event["action"] == "delete":
+        return None
+    state = copy.deepcopy(state)
+    for path, value in (changes.get("set") or {}).items():
+        set_path(state, path, value)
+    documents = state.setdefault("documents", [])
+    if changes.get("push_documents"):
+        documents.extend(copy.deepcopy(changes["push_documents"]))
+    if changes.get("update_document"):
+        update = changes["update_document"]
+        for document in documents:
+            if document.get("document_no") == update["document_no"]:
+                document.update(update["set"])
+                break
+    if changes.get("pull_document") is not None:
+        state["documents"] = [d for d in documents if d.get("document_no") != changes["pull_document"]]
+    state["document_count"] = len(state["documents"])
+    state["version"] = event["version"]
+    return state
+
+
+def replay(snapshot: Optional[dict], events: Iterable[dict]) -> Optional[dict]:
+    """Apply events that directly follow snapshot (or creation, when
+    snapshot is None); None if one is missing"""
+    state, version = (snapshot["state"], snapshot["version"]) if snapshot else (None, 0)
+    for event in events:
+        if event["version"] != version + 1:
+            return None
+        state, version = apply_event(state, event), event["version"]
+    return state
+
+
+def diff_states(before: Optional[dict], after: Optional[dict]) -> Dict[str, dict]:
+    """field -> {"from", "to"} for every top-level field that changed.
+
+    Documents are compared by document_no and reported as added, removed
+    and changed rather than as two whole arrays.
+    """
+    before, after = before or {}, after or {}
+    diff = {}
+    for field in sorted(set(before) | set(after)):
+        if field in ("documents", "version"):
+            continue
+        if before.get(field) != after.get(field):
+            diff[field] = {"from": before.get(field), "to": after.get(field)}
+
+    old = {d.get("document_no"): d for d in before.get("documents") or []}
+    new = {d.get("document_no"): d for d in after.get("documents") or []}
+    documents = {
+        "added": [no for no in new if no not in old],
+        "removed": [no for no in old if no not in new],
+        "changed": [no for no in new if no in old and new[no] != old[no]],
+    }
+    if any(documents.values()):
+        diff["documents"] = documents
+    return diff
+
+
+def with_diffs(state: Optional[dict], events: List[dict]) -> List[dict]:
+    """Events with a diff against the state before each one.
+
+    state is the transmittal just before the first event. It is None both
+    before creation and when unknown (history older than the first
+    snapshot); in the latter case diff is None.
+    """
+    result = []
+    for event in events:
+        after = apply_event(state, event)
+        if event["action"] == "delete":
+            diff = {}
+        elif state is None and event["action"] != "create":
+            diff = None
+        else:
+            diff = diff_states(state, after)
+        result.append({**event, "diff": diff})
+        state = after
+    return result
+
+
+async def _state_at(audit: AuditRepository, transmittal_id: str, version: int) -> Optional[dict]:
+    snapshot = await audit.snapshot(transmittal_id, version)
+    events = await audit.events(transmittal_id, snapshot["version"] if snapshot else 0, version, None)
+    return replay(snapshot, events)
+
+
+async def transmittal_as_of(audit: AuditRepository, transmittal_id: str, at: datetime) -> Optional[dict]:
+    """The transmittal as it was at a point in time.
+
+    None if it did not exist yet, was deleted, or its history from the
+    nearest snapshot on is incomplete.
+    """
+    await audit.flush()
+    version = await audit.version_at(transmittal_id, at)
+    if version is None:
+        return None
+    return await _state_at(audit, transmittal_id, version)
+
+
+async def transmittal_history(audit: AuditRepository, transmittal_id: str, after_version: int, limit: int) -> List[dict]:
+    """One page of events after after_version, each with its diff"""
+    await audit.flush()
+    events = await audit.events(transmittal_id, after_version, None, limit)
+    if not events:
+        return []
+    first_version = events[0]["version"]
+    state = await _state_at(audit, transmittal_id, first_version - 1) if first_version > 1 else None
+    return with_diffs(state, events)
@@ -0,0 +1,472 @@
+"""Repository interfaces shared by every storage backend.
+
+Repositories take and return plain dicts shaped like the Mongo documents the
+API has always stored: dates as ISO strings, timestamps as naive UTC
+datetimes, no ``_id``. Business rules (draft-only edits, numbering, ETags)
+stay in server.py; repositories only offer the conditional reads and writes
+those rules need, each as a single atomic operation where the backend allows.
+"""
+
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, List, Literal, Optional, Sequence, Tuple
+
+# Fields the transmittal list can be filtered and faceted on
+FILTER_FIELDS = (
+    "status",
+    "department",
+    "transmittal_type",
+    "design_stage",
+    "send_to",
+    "send_mode",
+    "project_name",
+)
+
+# Deleted transmittals leave a tombstone so /transmittals/changes can report
+# the deletion. Tombstones expire after this many days; clients whose
+# checkpoint is older than that must do a full resync.
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', '90'))
+
+# Responses to mutating requests sent with an Idempotency-Key are kept this
+# long, so a retry within the window replays the stored result
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+
+# Status checks are written constantly by uptime probers; they are kept for
+# this many days
+STATUS_CHECK_RETENTION_DAYS = int(os.environ.get('STATUS_CHECK_RETENTION_DAYS', '7'))
+
+# Base64 receipt variants under receive_details that only the receipt
+# download needs; summary views leave them out, and lists load the
+# thumbnail from the receipt endpoint instead
+RECEIPT_BLOB_FIELDS = ("receipt_file", "receipt_optimized", "receipt_thumbnail")
+
+# Days a recipient has to acknowledge a sent transmittal before it is
+# reported overdue and reminded about
+ACK_DUE_DAYS = int(os.environ.get('ACK_DUE_DAYS', '7'))
+
+# Delivered share messages are kept this long for the share history;
+# undeliverable ones are kept until removed by hand
+OUTBOX_RETENTION_DAYS = int(os.environ.get('OUTBOX_RETENTION_DAYS', '30'))
+
+# The audit log keeps the whole transmittal every this many versions, so a
+# past state is rebuilt by replaying at most this many events
+AUDIT_SNAPSHOT_INTERVAL = int(os.environ.get('AUDIT_SNAPSHOT_INTERVAL', '20'))
+
+# Document issue index row field -> transmittal field it is copied from;
+# document_no, revision and title come from the document itself
+DOCUMENT_ISSUE_FIELDS = {
+    "transmittal_number": "transmittal_number",
+    "project_name": "project_name",
+    "recipient_name": "recipient_name",
+    "recipient_email": "recipient_email",
+    "send_to": "send_to",
+    "status": "status",
+    "sent_status": "sent_status",
+    "sent_date": "send_details.send_date",
+    "received_status": "received_status",
+    "received_date": "receive_details.received_date",
+}
+
+# full: the whole document
+# summary: without the documents array and the receipt blobs
+# version: only id, version and status, for precondition checks
+TransmittalView = Literal["full", "summary", "version"]
+
+# field -> accepted values; fields are ANDed, values within a field ORed
+Filters = Dict[str, Optional[List[str]]]
+
+# (timestamp, id) of the last status check on the previous page
+StatusCursor = Tuple[datetime, str]
+
+
+def normalize_filters(filters: Filters) -> Dict[str, List[str]]:
+    """Drop empty values and the "all" status pseudo-filter"""
+    normalized = {}
+    for field in FILTER_FIELDS:
+        values = [v for v in (filters.get(field) or []) if v]
+        if field == "status":
+            values = [v for v in values if v != "all"]
+        if values:
+            normalized[field] = values
+    return normalized
+
+
+def facet_groups(filters: Filters) -> List[Tuple[Filters, List[str]]]:
+    """(filters, fields counted under them) for a facets query.
+
+    A field's counts leave out that field's own filter, so the values not
+    selected still show how many transmittals choosing them would add. The
+    first group holds the unfiltered fields under every filter.
+    """
+    active = normalize_filters(filters)
+    groups = [(active, [field for field in FILTER_FIELDS if field not in active])]
+    groups += [({f: v for f, v in active.items() if f != field}, [field]) for field in active]
+    return groups
+
+
+def document_issue_fields(fields: dict) -> dict:
+    """Index row fields affected by a set of transmittal fields (as given
+    to TransmittalRepository.update, dotted or nested)"""
+    row = {}
+    for column, path in DOCUMENT_ISSUE_FIELDS.items():
+        parent, _, child = path.partition(".")
+        if path in fields:
+            row[column] = fields[path]
+        elif child and parent in fields:
+            row[column] = (fields[parent] or {}).get(child)
+    return row
+
+
+def _revision_key(document: dict) -> tuple:
+    # Missing revisions sort lowest, as null does in Mongo
+    return (document.get("revision") is not None, document.get("revision") or 0)
+
+
+def document_issue_rows(transmittal: dict) -> List[dict]:
+    """Index rows for every document of an issued transmittal.
+
+    One row per document number: transmittals saved before repeated numbers
+    were rejected keep the highest revision (the last listed on a tie).
+    """
+    shared = document_issue_fields(transmittal)
+    shared.update(
+        transmittal_id=transmittal["id"],
+        issued_at=transmittal.get("generated_date") or transmittal.get("updated_at"),
+    )
+    latest: Dict[str, dict] = {}
+    for document in transmittal.get("documents") or []:
+        current = latest.get(document["document_no"])
+        if current is None or _revision_key(document) >= _revision_key(current):
+            latest[document["document_no"]] = document
+    return [
+        {
+            "document_no": document["document_no"],
+            "revision": document.get("revision"),
+            "title": document.get("title"),
+            **shared,
+        }
+        for document in latest.values()
+    ]
+
+
+class TransmittalRepository(ABC):
+
+    @abstractmethod
+    async def insert(self, transmittal: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def get(self, transmittal_id: str, view: TransmittalView = "full") -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def get_many(self, transmittal_ids: Sequence[str], view: TransmittalView = "full") -> List[dict]:
+        """Transmittals with the given ids, in no particular order"""
+
+    @abstractmethod
+    async def list(self, filters: Filters, skip: int, limit: int, view: TransmittalView = "full") -> List[dict]:
+        """One page of matching transmittals, newest first"""
+
+    @abstractmethod
+    def iterate(
+        self, filters: Filters, skip: int, limit: Optional[int], view: TransmittalView = "full"
+    ) -> AsyncIterator[dict]:
+        """Like list, but yields batches lazily and may be unbounded"""
+
+    @abstractmethod
+    async def count(self, filters: Filters) -> int:
+        ...
+
+    @abstractmethod
+    async def facets(self, filters: Filters) -> Tuple[int, Dict[str, List[Tuple[Optional[str], int]]]]:
+        """Total matches and (value, count) pairs per FILTER_FIELDS entry,
+        most frequent first; each field's counts ignore its own filter
+        (see facet_groups)"""
+
+    @abstractmethod
+    async def count_issued(self) -> int:
+        """Number of transmittals that have left draft"""
+
+    @abstractmethod
+    async def update(
+        self,
+        transmittal_id: str,
+        fields: dict,
+        expected_version: Optional[int] = None,
+        view: TransmittalView = "full",
+        action: str = "update",
+        match: Optional[dict] = None,
+    ) -> Optional[dict]:
+        """Set fields and bump version; return the updated document.
+
+        Returns None if the transmittal does not exist or, when
+        expected_version is given, no longer has that version, or when
+        match (dotted path -> value) is given, no longer has those values.
+        action names the change in the audit log.
+        """
+
+    @abstractmethod
+    async def delete(self, transmittal_id: str, deleted_at: datetime) -> None:
+        """Delete a transmittal and record a tombstone for it"""
+
+    @abstractmethod
+    async def changed_since(self, since: datetime, limit: int, after_id: Optional[str] = None) -> List[dict]:
+        """Transmittals after the (since, after_id) cursor in (updated_at, id)
+        order; without after_id, those with updated_at after since"""
+
+    @abstractmethod
+    async def deleted_since(self, since: datetime, limit: int, after_id: Optional[str] = None) -> List[dict]:
+        """Tombstones ({id, deleted_at}) after the (since, after_id) cursor
+        in (deleted_at, id) order"""
+
+    @abstractmethod
+    async def overdue(self, now: datetime, skip: int, limit: int) -> List[dict]:
+        """Summaries of transmittals whose ack_due_at has passed, most
+        overdue first. Served by a partial index over only the transmittals
+        that have an ack_due_at, so the cost follows the number outstanding."""
+
+    @abstractmethod
+    async def pending_receipts(self, limit: int) -> List[Tuple[str, Optional[str]]]:
+        """(id, receipt_id) of transmittals whose receipt still awaits
+        optimization, through a partial index over only those"""
+
+    @abstractmethod
+    async def reminders_due(self, now: datetime, skip: int, limit: int, addressed_only: bool = False) -> List[dict]:
+        """Summaries of transmittals whose next_reminder_at has passed,
+        longest waiting first; with addressed_only, only those with a
+        recipient_email. Served by a partial index like overdue's."""
+
+    @abstractmethod
+    async def get_documents(self, transmittal_id: str, skip: int, limit: int) -> Optional[Tuple[int, List[dict]]]:
+        """(document_count, one page of documents), or None if not found"""
+
+    @abstractmethod
+    async def has_document(self, transmittal_id: str, document_no: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def push_documents(self, transmittal_id: str, documents: List[dict], updated_at: datetime) -> Optional[dict]:
+        """Append documents to a draft whose document numbers do not clash.
+
+        Returns the id/version of the updated transmittal, or None if nothing
+        matched.
+        """
+
+    @abstractmethod
+    async def update_document(
+        self, transmittal_id: str, document_no: str, fields: dict, updated_at: datetime
+    ) -> Optional[Tuple[dict, dict]]:
+        """Update one document of a draft in place.
+
+        Returns (id/version, updated document), or None if the draft or the
+        document was not found or a renamed document_no would clash.
+        """
+
+    @abstractmethod
+    async def pull_document(self, transmittal_id: str, document_no: str, updated_at: datetime) -> Optional[dict]:
+        """Remove one document from a draft; id/version or None"""
+
+
+class StatusCheckRepository(ABC):
+
+    @abstractmethod
+    async def insert(self, status_check: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def list(self, client_name: Optional[str], before: Optional[StatusCursor], limit: int) -> List[dict]:
+        """Status checks newest first, strictly older than before"""
+
+    @abstractmethod
+    def iterate(
+        self, client_name: Optional[str], before: Optional[StatusCursor], limit: Optional[int]
+    ) -> AsyncIterator[dict]:
+        """Like list, but yields batches lazily and may be unbounded"""
+
+    @abstractmethod
+    async def rates(
+        self, since: datetime, until: datetime, window: int, client_name: Optional[str]
+    ) -> List[Tuple[str, datetime, int]]:
+        """(client_name, window_start, count) per window of seconds"""
+
+
+class IdempotencyKeyRepository(ABC):
+
+    @abstractmethod
+    async def claim(self, record: dict) -> bool:
+        """Insert a pending record; False if the key already exists.
+
+        A pending record for the same scope and request_hash whose
+        locked_until is before the new record's created_at is replaced, so a
+        retry takes over a request whose worker died.
+        """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def complete(self, key: str, status_code: int, response, headers: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def release(self, key: str, lease_id: Optional[str] = None) -> None:
+        """Drop a pending record so the request can be retried; with
+        lease_id, only if no other request has taken it over since"""
+
+
+class OutboxRepository(ABC):
+    """Outgoing share messages, written together with the transmittal change
+    that caused them and delivered later by outbox.OutboxDispatcher.
+
+    A message moves pending -> sending (leased by one dispatcher) -> sent, or
+    back to pending with a later next_attempt_at, or to dead once retries are
+    exhausted. A lease that expires before the message is marked makes it
+    claimable again, so delivery is at least once.
+    """
+
+    @abstractmethod
+    async def enqueue(
+        self, transmittal_id: str, fields: dict, messages: List[dict], expected_version: Optional[int] = None
+    ) -> Optional[dict]:
+        """Set fields on the transmittal, bump its version and insert the
+        messages, atomically (see MongoOutboxRepository for standalone
+        MongoDB servers).
+
+        Returns the id/version of the updated transmittal, or None (and
+        queues nothing) if it does not exist or no longer has expected_version.
+        """
+
+    @abstractmethod
+    async def enqueue_reminders(
+        self,
+        transmittal_ids: Sequence[str],
+        now: datetime,
+        fields: dict,
+        compose: Callable[[List[dict]], List[dict]],
+    ) -> List[str]:
+        """Remind about transmittals that are still overdue, in one transaction.
+
+        Of transmittal_ids, those with next_reminder_at at or before now get fields
+        set and their version bumped, and the messages compose builds from
+        their summaries are queued. Returns the ids reminded about, which is
+        empty when another scanner got there first.
+        """
+
+    @abstractmethod
+    async def claim(self, now: datetime, limit: int, lease_seconds: int) -> List[dict]:
+        """Lease up to limit due messages, oldest first"""
+
+    @abstractmethod
+    async def mark_sent(self, message_ids: Sequence[str], sent_at: datetime) -> None:
+        ...
+
+    @abstractmethod
+    async def mark_failed(self, message_id: str, error: str, next_attempt_at: Optional[datetime]) -> None:
+        """Schedule a retry, or give up on the message if next_attempt_at is None"""
+
+    @abstractmethod
+    async def list(self, transmittal_id: str) -> List[dict]:
+        """Messages queued for a transmittal, oldest first"""
+
+
+class DocumentIssueRepository(ABC):
+    """Reverse index from document_no and revision to the transmittals that
+    issued it: one row per document of every generated transmittal, shaped
+    by document_issue_rows. Written when a transmittal is generated and kept
+    in step with its status; rebuild() recreates it from the transmittals.
+    """
+
+    @abstractmethod
+    async def index(self, transmittal: dict) -> None:
+        """Replace the rows of a transmittal with rows for its documents"""
+
+    @abstractmethod
+    async def update_transmittal(self, transmittal_id: str, fields: dict) -> None:
+        """Copy changed transmittal fields (see document_issue_fields) onto
+        its rows"""
+
+    @abstractmethod
+    async def list(self, document_no: str) -> List[dict]:
+        """Every issue of a document, highest revision first, then newest"""
+
+    @abstractmethod
+    async def rebuild(self) -> int:
+        """Recreate the index from all issued transmittals; returns the
+        number of rows. Changes made while it runs may need another rebuild."""
+
+
+class AuditRepository(ABC):
+    """Append-only log of transmittal changes (see storage/audit.py).
+
+    Backends record an event for every mutation made through the other
+    repositories, without adding a round trip to the request that made it,
+    and a snapshot of the whole transmittal every AUDIT_SNAPSHOT_INTERVAL
+    versions. Neither is ever purged, so the history outlives deletion.
+    """
+
+    # Called with each event as it is recorded; reads issued afterwards see
+    # the change
+    listeners: List[Callable[[dict], None]]
+
+    def add_listener(self, listener: Callable[[dict], None]) -> None:
+        self.listeners.append(listener)
+
+    def _notify(self, event: dict) -> None:
+        for listener in self.listeners:
+            listener(event)
+
+    @abstractmethod
+    async def events(
+        self, transmittal_id: str, after_version: int, until_version: Optional[int], limit: Optional[int]
+    ) -> List[dict]:
+        """Events with after_version < version <= until_version, oldest first"""
+
+    @abstractmethod
+    async def snapshot(self, transmittal_id: str, version: int) -> Optional[dict]:
+        """Latest snapshot ({transmittal_id, version, at, state}) at or
+        before version"""
+
+    @abstractmethod
+    async def version_at(self, transmittal_id: str, at: datetime) -> Optional[int]:
+        """Version written by the last event at or before at"""
+
+    @abstractmethod
+    async def flush(self) -> None:
+        """Make every event recorded so far readable"""
+
+
+class Storage(ABC):
+    transmittals: TransmittalRepository
+    status_checks: StatusCheckRepository
+    idempotency_keys: IdempotencyKeyRepository
+    outbox: OutboxRepository
+    audit: AuditRepository
+    document_issues: DocumentIssueRepository
+
+    @abstractmethod
+    async def initialize(self) -> None:
+        """Create indexes/tables and migrate old documents"""
+
+    @abstractmethod
+    async def close(self) -> None:
+        ...
+
+    @abstractmethod
+    async def ping(self) -> None:
+        """Raise if the database cannot be reached"""
+
+    @abstractmethod
+    async def warm_up(self, connections: int) -> None:
+        """Open up to connections database connections (and read the hot
+        index pages) before the first request needs them"""
+
+    @abstractmethod
+    async def missing_indexes(self) -> List[str]:
+        """Names of indexes initialize should have created but the database
+        does not have"""
+
+    @abstractmethod
+    def pool_stats(self) -> dict:
+        """Connection pool statistics for the readiness endpoint"""
@@ -0,0 +1,1049 @@
+"""MongoDB storage backend (Motor)."""
+
+import asyncio
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, DeleteMany, IndexModel, InsertOne, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from .audit import AUDIT_OMITTED_FIELDS, audit_event, audit_snapshot, snapshot_due, without_blobs
+from .base import (
+    ACK_DUE_DAYS,
+    DOCUMENT_ISSUE_FIELDS,
+    FILTER_FIELDS,
+    IDEMPOTENCY_KEY_TTL_HOURS,
+    OUTBOX_RETENTION_DAYS,
+    RECEIPT_BLOB_FIELDS,
+    STATUS_CHECK_RETENTION_DAYS,
+    TOMBSTONE_RETENTION_DAYS,
+    AuditRepository,
+    DocumentIssueRepository,
+    Filters,
+    IdempotencyKeyRepository,
+    OutboxRepository,
+    StatusCheckRepository,
+    Storage,
+    TransmittalRepository,
+    document_issue_fields,
+    document_issue_rows,
+    facet_groups,
+    normalize_filters,
+)
+
+logger = logging.getLogger(__name__)
+
+# Audit events are buffered in memory and inserted in batches of up to
+# AUDIT_BATCH_SIZE at least every AUDIT_FLUSH_SECONDS. If the database is
+# unreachable at most AUDIT_BUFFER_LIMIT events are held for the retry.
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', '500'))
+AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', '1'))
+AUDIT_BUFFER_LIMIT = int(os.environ.get('AUDIT_BUFFER_LIMIT', '50000'))
+
+# Compound indexes for the transmittal list. Each one puts the equality
+# fields first and the created_date sort key last, so a filtered page is read
+# in index order without an in-memory sort. Narrowing fields that are rarely
+# used alone (design_stage, send_mode) are left to the fetch filter rather
+# than getting indexes of their own. backend/benchmark_indexes.py checks that
+# the common filter combinations are served by these indexes.
+TRANSMITTAL_INDEXES = [
+    IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    IndexModel([("created_date", DESCENDING)], name="created_date"),
+    IndexModel([("status", ASCENDING), ("created_date", DESCENDING)], name="status_created"),
+    IndexModel([("department", ASCENDING), ("created_date", DESCENDING)], name="department_created"),
+    IndexModel(
+        [("department", ASCENDING), ("status", ASCENDING), ("created_date", DESCENDING)],
+        name="department_status_created",
+    ),
+    IndexModel([("project_name", ASCENDING), ("created_date", DESCENDING)], name="project_created"),
+    IndexModel(
+        [("project_name", ASCENDING), ("status", ASCENDING), ("created_date", DESCENDING)],
+        name="project_status_created",
+    ),
+    # Type alone still sorts in the index; type_department_created would not
+    IndexModel([("transmittal_type", ASCENDING), ("created_date", DESCENDING)], name="type_created"),
+    IndexModel(
+        [("transmittal_type", ASCENDING), ("department", ASCENDING), ("created_date", DESCENDING)],
+        name="type_department_created",
+    ),
+    IndexModel([("send_to", ASCENDING), ("created_date", DESCENDING)], name="send_to_created"),
+    # The changes feed pages on (updated_at, id)
+    IndexModel([("updated_at", ASCENDING), ("id", ASCENDING)], name="updated_at_id"),
+    # Only transmittals awaiting acknowledgement carry a date here, so the
+    # overdue scan reads an index the size of the outstanding set
+    IndexModel(
+        [("ack_due_at", ASCENDING)],
+        name="ack_due_partial",
+        partialFilterExpression={"ack_due_at": {"$type": "date"}},
+    ),
+    # Likewise for the reminder scan, which is throttled separately so
+    # ack_due_at keeps the real due date
+    IndexModel(
+        [("next_reminder_at", ASCENDING)],
+        name="next_reminder_partial",
+        partialFilterExpression={"next_reminder_at": {"$type": "date"}},
+    ),
+    # Receipts the optimizer has not finished, for the sweep after a restart
+    IndexModel(
+        [("id", ASCENDING)],
+        name="receipt_pending_partial",
+        partialFilterExpression={"receive_details.receipt_status": "pending"},
+    ),
+]
+
+TOMBSTONE_INDEXES = [
+    IndexModel(
+        [("deleted_at", ASCENDING)],
+        name="deleted_at_ttl",
+        expireAfterSeconds=TOMBSTONE_RETENTION_DAYS * 24 * 3600,
+    ),
+]
+
+IDEMPOTENCY_KEY_INDEXES = [
+    IndexModel([("key", ASCENDING)], name="key_unique", unique=True),
+    IndexModel(
+        [("created_at", ASCENDING)],
+        name="created_at_ttl",
+        expireAfterSeconds=IDEMPOTENCY_KEY_TTL_HOURS * 3600,
+    ),
+]
+
+STATUS_CHECK_INDEXES = [
+    IndexModel(
+        [("timestamp", ASCENDING)],
+        name="timestamp_ttl",
+        expireAfterSeconds=STATUS_CHECK_RETENTION_DAYS * 24 * 3600,
+    ),
+    # Newest-first pagination with id as the tie breaker
+    IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timestamp_id"),
+    IndexModel([("client_name", ASCENDING), ("timestamp", DESCENDING)], name="client_timestamp"),
+]
+
+OUTBOX_INDEXES = [
+    IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    # Due pending messages, and expired leases of crashed dispatchers
+    IndexModel([("state", ASCENDING), ("next_attempt_at", ASCENDING)], name="state_next_attempt"),
+    IndexModel([("state", ASCENDING), ("leased_until", ASCENDING)], name="state_leased_until"),
+    IndexModel([("transmittal_id", ASCENDING), ("created_at", ASCENDING)], name="transmittal_created"),
+    # Only delivered messages have sent_at, so only they expire
+    IndexModel(
+        [("sent_at", ASCENDING)],
+        name="sent_at_ttl",
+        expireAfterSeconds=OUTBOX_RETENTION_DAYS * 24 * 3600,
+    ),
+]
+
+AUDIT_EVENT_INDEXES = [
+    IndexModel([("transmittal_id", ASCENDING), ("version", ASCENDING)], name="transmittal_version", unique=True),
+    IndexModel([("transmittal_id", ASCENDING), ("at", ASCENDING)], name="transmittal_at"),
+]
+
+AUDIT_SNAPSHOT_INDEXES = [
+    IndexModel([("transmittal_id", ASCENDING), ("version", DESCENDING)], name="transmittal_version", unique=True),
+]
+
+DOCUMENT_ISSUE_INDEXES = [
+    IndexModel([("transmittal_id", ASCENDING), ("document_no", ASCENDING)], name="transmittal_document", unique=True),
+    # Serves a document's whole issue history in its sort order
+    IndexModel(
+        [("document_no", ASCENDING), ("revision", DESCENDING), ("issued_at", DESCENDING)],
+        name="document_revision_issued",
+    ),
+]
+
+# Checked by missing_indexes once initialize has created them
+COLLECTION_INDEXES = {
+    "transmittals": TRANSMITTAL_INDEXES,
+    "transmittal_tombstones": TOMBSTONE_INDEXES,
+    "idempotency_keys": IDEMPOTENCY_KEY_INDEXES,
+    "status_checks": STATUS_CHECK_INDEXES,
+    "outbox": OUTBOX_INDEXES,
+    "transmittal_events": AUDIT_EVENT_INDEXES,
+    "transmittal_snapshots": AUDIT_SNAPSHOT_INDEXES,
+    "document_issues": DOCUMENT_ISSUE_INDEXES,
+}
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Counts connection pool (CMAP) events per server.
+
+    The driver calls it from its own threads, so the counters are updated
+    under a lock; the readiness endpoint reads them through stats().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, event, **deltas: int) -> None:
+        address = "%s:%s" % event.address
+        with self._lock:
+            server = self._servers.setdefault(address, {
+                "open": 0, "checked_out": 0, "created": 0, "closed": 0, "checkout_failures": 0, "cleared": 0,
+            })
+            for counter, delta in deltas.items():
+                server[counter] += delta
+
+    def connection_created(self, event):
+        self._count(event, created=1, open=1)
+
+    def connection_closed(self, event):
+        self._count(event, closed=1, open=-1)
+
+    def connection_checked_out(self, event):
+        self._count(event, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._count(event, checked_out=-1)
+
+    def connection_check_out_failed(self, event):
+        self._count(event, checkout_failures=1)
+
+    def pool_cleared(self, event):
+        self._count(event, cleared=1)
+
+    # Not counted; the base class raises NotImplementedError
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {address: dict(server) for address, server in self._servers.items()}
+
+PROJECTIONS = {
+    "full": {"_id": 0},
+    "summary": {
+        "_id": 0,
+        "documents": 0,
+        **{f"receive_details.{field}": 0 for field in RECEIPT_BLOB_FIELDS},
+    },
+    "version": {"_id": 0, "id": 1, "version": 1, "status": 1},
+}
+
+
+def build_transmittal_query(filters: Filters) -> dict:
+    """Build a Mongo filter from field -> accepted values"""
+    query = {}
+    for field, values in normalize_filters(filters).items():
+        query[field] = values[0] if len(values) == 1 else {"$in": values}
+    return query
+
+
+def build_facet_pipeline(filters: Filters, fields: List[str], with_total: bool) -> List[dict]:
+    """Aggregation counting fields under filters, for one facet_groups entry"""
+    facet_stages = {field: [{"$sortByCount": f"${field}"}] for field in fields}
+    if with_total:
+        facet_stages["total"] = [{"$count": "count"}]
+    return [
+        {"$match": build_transmittal_query(filters)},
+        {"$facet": facet_stages},
+    ]
+
+
+def _after_cursor(field: str, since: datetime, after_id: Optional[str]) -> dict:
+    """Documents after (since, after_id) in (field, id) order"""
+    if after_id is None:
+        return {field: {"$gt": since}}
+    return {"$or": [{field: {"$gt": since}}, {field: since, "id": {"$gt": after_id}}]}
+
+
+class MongoTransmittalRepository(TransmittalRepository):
+
+    def __init__(self, db, audit: "MongoAuditRepository"):
+        self.collection = db.transmittals
+        self.tombstones = db.transmittal_tombstones
+        self.audit = audit
+
+    async def insert(self, transmittal):
+        await self.collection.insert_one(dict(transmittal))
+        self.audit.record(audit_event(
+            transmittal["id"], transmittal.get("version") or 1, "create",
+            {"state": without_blobs(transmittal)}, transmittal.get("updated_at"),
+        ))
+
+    async def get(self, transmittal_id, view="full"):
+        return await self.collection.find_one({"id": transmittal_id}, PROJECTIONS[view])
+
+    async def get_many(self, transmittal_ids, view="full"):
+        ids = list(transmittal_ids)
+        return await self.collection.find({"id": {"$in": ids}}, PROJECTIONS[view]).to_list(len(ids))
+
+    async def list(self, filters, skip, limit, view="full"):
+        cursor = self.collection.find(build_transmittal_query(filters), PROJECTIONS[view])
+        return await cursor.sort("created_date", -1).skip(skip).limit(limit).to_list(limit)
+
+    async def iterate(self, filters, skip, limit, view="full"):
+        cursor = self.collection.find(build_transmittal_query(filters), PROJECTIONS[view])
+        # Full documents carry the documents array, so fetch fewer at a time
+        cursor = cursor.sort("created_date", -1).skip(skip).batch_size(100 if view == "full" else 500)
+        if limit:
+            cursor = cursor.limit(limit)
+        async for transmittal in cursor:
+            yield transmittal
+
+    async def count(self, filters):
+        return await self.collection.count_documents(build_transmittal_query(filters))
+
+    async def _facet(self, filters, fields, with_total):
+        pipeline = build_facet_pipeline(filters, fields, with_total)
+        result = await self.collection.aggregate(pipeline).to_list(1)
+        return result[0] if result else {}
+
+    async def facets(self, filters):
+        # One aggregation per distinct filter set, each able to use an index
+        groups = facet_groups(filters)
+        results = await asyncio.gather(*(
+            self._facet(group_filters, fields, with_total=n == 0)
+            for n, (group_filters, fields) in enumerate(groups)
+        ))
+        counts = {}
+        for (_, fields), buckets in zip(groups, results):
+            for field in fields:
+                counts[field] = [(b["_id"], b["count"]) for b in buckets.get(field, [])]
+        total = results[0].get("total") or [{"count": 0}]
+        return total[0]["count"], {field: counts[field] for field in FILTER_FIELDS}
+
+    async def count_issued(self):
+        return await self.collection.count_documents({"status": {"$ne": "draft"}})
+
+    async def update(self, transmittal_id, fields, expected_version=None, view="full", action="update", match=None):
+        query = {"id": transmittal_id, **(match or {})}
+        if expected_version is not None:
+            query["version"] = expected_version
+        updated = await self.collection.find_one_and_update(
+            query,
+            {"$set": fields, "$inc": {"version": 1}},
+            projection=PROJECTIONS[view],
+            return_document=ReturnDocument.AFTER,
+        )
+        if updated:
+            self.audit.record(
+                audit_event(transmittal_id, updated["version"], action, {"set": fields}),
+                updated if view == "full" else None,
+            )
+        return updated
+
+    async def delete(self, transmittal_id, deleted_at):
+        deleted = await self.collection.find_one_and_delete({"id": transmittal_id}, {"_id": 0, "version": 1})
+        if deleted:
+            self.audit.record(audit_event(transmittal_id, (deleted.get("version") or 0) + 1, "delete", {}, deleted_at))
+        await self.tombstones.insert_one({"id": transmittal_id, "deleted_at": deleted_at})
+
+    async def changed_since(self, since, limit, after_id=None):
+        cursor = self.collection.find(_after_cursor("updated_at", since, after_id), PROJECTIONS["full"])
+        return await cursor.sort([("updated_at", 1), ("id", 1)]).limit(limit).to_list(limit)
+
+    async def deleted_since(self, since, limit, after_id=None):
+        cursor = self.tombstones.find(_after_cursor("deleted_at", since, after_id), {"_id": 0})
+        return await cursor.sort([("deleted_at", 1), ("id", 1)]).limit(limit).to_list(limit)
+
+    async def overdue(self, now, skip, limit):
+        # $type matches the partial index filter, so the planner can use it
+        cursor = self.collection.find({"ack_due_at": {"$type": "date", "$lte": now}}, PROJECTIONS["summary"])
+        return await cursor.sort("ack_due_at", ASCENDING).skip(skip).limit(limit).to_list(limit)
+
+    async def pending_receipts(self, limit):
+        cursor = self.collection.find(
+            {"receive_details.receipt_status": "pending"}, {"_id": 0, "id": 1, "receive_details.receipt_id": 1}
+        )
+        return [
+            (transmittal["id"], (transmittal.get("receive_details") or {}).get("receipt_id"))
+            for transmittal in await cursor.limit(limit).to_list(limit)
+        ]
+
+    async def reminders_due(self, now, skip, limit, addressed_only=False):
+        query = {"next_reminder_at": {"$type": "date", "$lte": now}}
+        if addressed_only:
+            query["recipient_email"] = {"$nin": [None, ""]}
+        cursor = self.collection.find(query, PROJECTIONS["summary"])
+        return await cursor.sort("next_reminder_at", ASCENDING).skip(skip).limit(limit).to_list(limit)
+
+    async def get_documents(self, transmittal_id, skip, limit):
+        transmittal = await self.collection.find_one(
+            {"id": transmittal_id},
+            {"_id": 0, "document_count": 1, "documents": {"$slice": [skip, limit]}},
+        )
+        if not transmittal:
+            return None
+        return transmittal.get("document_count", 0), transmittal.get("documents", [])
+
+    async def has_document(self, transmittal_id, document_no):
+        return bool(await self.collection.count_documents(
+            {"id": transmittal_id, "documents.document_no": document_no}, limit=1
+        ))
+
+    async def push_documents(self, transmittal_id, documents, updated_at):
+        document_nos = [document["document_no"] for document in documents]
+        updated = await self.collection.find_one_and_update(
+            {"id": transmittal_id, "status": "draft", "documents.document_no": {"$nin": document_nos}},
+            {
+                "$push": {"documents": {"$each": documents}},
+                "$inc": {"document_count": len(documents), "version": 1},
+                "$set": {"updated_at": updated_at},
+            },
+            projection=PROJECTIONS["version"],
+            return_document=ReturnDocument.AFTER,
+        )
+        if updated:
+            self.audit.record(audit_event(
+                transmittal_id, updated["version"], "add_documents",
+                {"set": {"updated_at": updated_at}, "push_documents": documents},
+            ))
+        return updated
+
+    async def update_document(self, transmittal_id, document_no, fields, updated_at):
+        update_dict = {f"documents.$[item].{k}": v for k, v in fields.items()}
+        update_dict["updated_at"] = updated_at
+
+        query = {"id": transmittal_id, "status": "draft", "documents.document_no": document_no}
+        new_document_no = fields.get("document_no", document_no)
+        if new_document_no != document_no:
+            query["documents"] = {"$not": {"$elemMatch": {"document_no": new_document_no}}}
+
+        updated = await self.collection.find_one_and_update(
+            query,
+            {"$set": update_dict, "$inc": {"version": 1}},
+            array_filters=[{"item.document_no": document_no}],
+            projection={
+                "_id": 0, "id": 1, "version": 1, "status": 1,
+                "documents": {"$elemMatch": {"document_no": new_document_no}},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+        if not updated:
+            return None
+        self.audit.record(audit_event(
+            transmittal_id, updated["version"], "update_document",
+            {"set": {"updated_at": updated_at}, "update_document": {"document_no": document_no, "set": fields}},
+        ))
+        document = updated.pop("documents")[0]
+        return updated, document
+
+    async def pull_document(self, transmittal_id, document_no, updated_at):
+        updated = await self.collection.find_one_and_update(
+            {"id": transmittal_id, "status": "draft", "documents.document_no": document_no},
+            # A pipeline, so document_count stays right even for transmittals
+            # stored with repeated numbers before they were rejected
+            [
+                {"$set": {
+                    "documents": {"$filter": {"input": "$documents", "cond": {"$ne": ["$$this.document_no", document_no]}}},
+                    "version": {"$add": ["$version", 1]},
+                    "updated_at": updated_at,
+                }},
+                {"$set": {"document_count": {"$size": "$documents"}}},
+            ],
+            projection=PROJECTIONS["version"],
+            return_document=ReturnDocument.AFTER,
+        )
+        if updated:
+            self.audit.record(audit_event(
+                transmittal_id, updated["version"], "remove_document",
+                {"set": {"updated_at": updated_at}, "pull_document": document_no},
+            ))
+        return updated
+
+    async def initialize(self):
+        await self.collection.create_indexes(TRANSMITTAL_INDEXES)
+        # Superseded by updated_at_id
+        if "updated_at" in await self.collection.index_information():
+            await self.collection.drop_index("updated_at")
+        await self.tombstones.create_indexes(TOMBSTONE_INDEXES)
+        # Transmittals written before updated_at/version existed
+        await self.collection.update_many(
+            {"updated_at": {"$exists": False}},
+            [{"$set": {"updated_at": "$created_date"}}],
+        )
+        await self.collection.update_many({"version": {"$exists": False}}, {"$set": {"version": 1}})
+        # Sent before acknowledgement tracking existed
+        await self.collection.update_many(
+            {
+                "status": {"$in": ["sent", "received"]},
+                "sent_status": "Sent",
+                "received_status": {"$ne": "Received"},
+                "ack_due_at": {"$exists": False},
+            },
+            [{"$set": {"ack_due_at": {"$add": ["$updated_at", ACK_DUE_DAYS * 24 * 3600 * 1000]}}}],
+        )
+        # Given a due date by an earlier backfill without ever being sent
+        await self.collection.update_many(
+            {"ack_due_at": {"$type": "date"}, "sent_status": {"$ne": "Sent"}},
+            {"$set": {"ack_due_at": None, "next_reminder_at": None}},
+        )
+        # Awaiting acknowledgement from before reminders had their own date
+        await self.collection.update_many(
+            {"ack_due_at": {"$type": "date"}, "next_reminder_at": {"$exists": False}},
+            [{"$set": {"next_reminder_at": "$ack_due_at"}}],
+        )
+
+
+class MongoStatusCheckRepository(StatusCheckRepository):
+
+    def __init__(self, db):
+        self.collection = db.status_checks
+
+    async def insert(self, status_check):
+        await self.collection.insert_one(dict(status_check))
+
+    def _cursor(self, client_name, before):
+        query = {}
+        if before:
+            timestamp, status_id = before
+            query["$or"] = [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "id": {"$lt": status_id}},
+            ]
+        if client_name:
+            query["client_name"] = client_name
+        return self.collection.find(query, {"_id": 0}).sort([("timestamp", -1), ("id", -1)])
+
+    async def list(self, client_name, before, limit):
+        return await self._cursor(client_name, before).limit(limit).to_list(limit)
+
+    async def iterate(self, client_name, before, limit):
+        cursor = self._cursor(client_name, before).batch_size(500)
+        if limit:
+            cursor = cursor.limit(limit)
+        async for status_check in cursor:
+            yield status_check
+
+    async def rates(self, since, until, window, client_name):
+        match = {"timestamp": {"$gte": since, "$lt": until}}
+        if client_name:
+            match["client_name"] = client_name
+
+        window_ms = window * 1000
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {
+                    "client_name": "$client_name",
+                    "window_start": {"$toDate": {"$subtract": [
+                        {"$toLong": "$timestamp"},
+                        {"$mod": [{"$toLong": "$timestamp"}, window_ms]},
+                    ]}},
+                },
+                "count": {"$sum": 1},
+            }},
+            {"$sort": {"_id.window_start": 1, "_id.client_name": 1}},
+        ]
+
+        buckets = await self.collection.aggregate(pipeline).to_list(None)
+        return [
+            (bucket["_id"]["client_name"], bucket["_id"]["window_start"], bucket["count"])
+            for bucket in buckets
+        ]
+
+    async def initialize(self):
+        await self.collection.create_indexes(STATUS_CHECK_INDEXES)
+
+
+class MongoIdempotencyKeyRepository(IdempotencyKeyRepository):
+
+    def __init__(self, db):
+        self.collection = db.idempotency_keys
+
+    async def claim(self, record):
+        try:
+            await self.collection.insert_one(dict(record))
+        except DuplicateKeyError:
+            expired = await self.collection.find_one_and_replace(
+                {
+                    "key": record["key"],
+                    "scope": record["scope"],
+                    "request_hash": record["request_hash"],
+                    "state": "pending",
+                    "locked_until": {"$lt": record["created_at"]},
+                },
+                dict(record),
+            )
+            return expired is not None
+        return True
+
+    async def get(self, key):
+        return await self.collection.find_one({"key": key}, {"_id": 0})
+
+    async def complete(self, key, status_code, response, headers):
+        await self.collection.update_one(
+            {"key": key},
+            {"$set": {
+                "state": "done",
+                "status_code": status_code,
+                "response": response,
+                "headers": headers,
+            }},
+        )
+
+    async def release(self, key, lease_id=None):
+        query = {"key": key, "state": "pending"}
+        if lease_id is not None:
+            query["lease_id"] = lease_id
+        await self.collection.delete_one(query)
+
+    async def initialize(self):
+        await self.collection.create_indexes(IDEMPOTENCY_KEY_INDEXES)
+
+
+class MongoOutboxRepository(OutboxRepository):
+    """Outbox collection.
+
+    On a replica set or sharded cluster (a single-node replica set will do)
+    messages and the transmittal change are written in one multi-document
+    transaction. A standalone server has no transactions, so there the
+    messages are written first in the ``held`` state, which the dispatcher
+    ignores, and released once the version-pinned transmittal update has
+    succeeded (deleted if it failed). Each held message lists the versions
+    it waits for in ``held_for``; messages a stopped worker left held are
+    settled by claim after a lease period.
+    """
+
+    def __init__(self, client, db, audit: "MongoAuditRepository"):
+        self.client = client
+        self.collection = db.outbox
+        self.transmittals = db.transmittals
+        self.audit = audit
+        self.transactions = True
+
+    async def _hold(self, messages: List[dict], held_for: List[dict]) -> List[str]:
+        if messages:
+            await self.collection.insert_many([
+                {**message, "state": "held", "held_for": held_for} for message in messages
+            ])
+        return [message["id"] for message in messages]
+
+    async def _settle(self, message_ids: List[str], release: bool) -> None:
+        if not message_ids:
+            return
+        query = {"id": {"$in": message_ids}, "state": "held"}
+        if release:
+            await self.collection.update_many(query, {"$set": {"state": "pending"}, "$unset": {"held_for": ""}})
+        else:
+            await self.collection.delete_many(query)
+
+    async def _settle_stale(self, now, lease_seconds) -> None:
+        """Release held messages whose transmittals reached the versions they
+        wait for, and drop the rest"""
+        stale = await self.collection.find(
+            {"state": "held", "created_at": {"$lte": now - timedelta(seconds=lease_seconds)}},
+            {"_id": 0, "id": 1, "held_for": 1},
+        ).to_list(1000)
+        if not stale:
+            return
+        ids = list({held["id"] for message in stale for held in message["held_for"]})
+        versions = {
+            transmittal["id"]: transmittal["version"]
+            async for transmittal in self.transmittals.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, "version": 1})
+        }
+        reached = {
+            message["id"]: all(versions.get(held["id"], 0) >= held["version"] for held in message["held_for"])
+            for message in stale
+        }
+        await self._settle([message_id for message_id, ok in reached.items() if ok], True)
+        await self._settle([message_id for message_id, ok in reached.items() if not ok], False)
+
+    async def enqueue(self, transmittal_id, fields, messages, expected_version=None):
+        query = {"id": transmittal_id}
+        if expected_version is not None:
+            query["version"] = expected_version
+        if not self.transactions:
+            held = await self._hold(messages, [{"id": transmittal_id, "version": (expected_version or 0) + 1}])
+            updated = await self.transmittals.find_one_and_update(
+                query,
+                {"$set": fields, "$inc": {"version": 1}},
+                projection=PROJECTIONS["version"],
+                return_document=ReturnDocument.AFTER,
+            )
+            await self._settle(held, updated is not None)
+            if updated:
+                self.audit.record(audit_event(transmittal_id, updated["version"], "share", {"set": fields}))
+            return updated
+
+        async with await self.client.start_session() as session:
+            async with session.start_transaction():
+                updated = await self.transmittals.find_one_and_update(
+                    query,
+                    {"$set": fields, "$inc": {"version": 1}},
+                    projection=PROJECTIONS["version"],
+                    return_document=ReturnDocument.AFTER,
+                    session=session,
+                )
+                if updated and messages:
+                    await self.collection.insert_many([dict(message) for message in messages], session=session)
+        # Recorded once committed, so an aborted share leaves no event
+        if updated:
+            self.audit.record(audit_event(transmittal_id, updated["version"], "share", {"set": fields}))
+        return updated
+
+    async def enqueue_reminders(self, transmittal_ids, now, fields, compose):
+        query = {"id": {"$in": list(transmittal_ids)}, "next_reminder_at": {"$type": "date", "$lte": now}}
+        if not self.transactions:
+            return await self._enqueue_reminders_held(query, fields, compose)
+        async with await self.client.start_session() as session:
+            async with session.start_transaction():
+                due = await self.transmittals.find(query, PROJECTIONS["summary"], session=session).to_list(None)
+                if not due:
+                    return []
+                await self.transmittals.update_many(
+                    {"id": {"$in": [transmittal["id"] for transmittal in due]}},
+                    {"$set": fields, "$inc": {"version": 1}},
+                    session=session,
+                )
+                messages = compose(due)
+                if messages:
+                    await self.collection.insert_many([dict(message) for message in messages], session=session)
+        for transmittal in due:
+            self.audit.record(audit_event(transmittal["id"], transmittal["version"] + 1, "remind", {"set": fields}))
+        return [transmittal["id"] for transmittal in due]
+
+    async def _enqueue_reminders_held(self, query, fields, compose):
+        due = await self.transmittals.find(query, PROJECTIONS["summary"]).to_list(None)
+        if not due:
+            return []
+        held = await self._hold(compose(due), [{"id": t["id"], "version": t["version"] + 1} for t in due])
+        # Each update is pinned to the version read, so a concurrent
+        # acknowledgement or another scanner wins over this reminder
+        results = await asyncio.gather(*(
+            self.transmittals.update_one(
+                {**query, "id": transmittal["id"], "version": transmittal["version"]},
+                {"$set": fields, "$inc": {"version": 1}},
+            )
+            for transmittal in due
+        ))
+        reminded = [transmittal for transmittal, result in zip(due, results) if result.modified_count]
+        if len(reminded) == len(due):
+            await self._settle(held, True)
+        else:
+            # The held messages list transmittals that were not updated
+            await self._settle(held, False)
+            messages = compose(reminded) if reminded else []
+            if messages:
+                await self.collection.insert_many([dict(message) for message in messages])
+        for transmittal in reminded:
+            self.audit.record(audit_event(transmittal["id"], transmittal["version"] + 1, "remind", {"set": fields}))
+        return [transmittal["id"] for transmittal in reminded]
+
+    @staticmethod
+    def _due(now) -> dict:
+        return {"$or": [
+            {"state": "pending", "next_attempt_at": {"$lte": now}},
+            {"state": "sending", "leased_until": {"$lte": now}},
+        ]}
+
+    async def claim(self, now, limit, lease_seconds):
+        if not self.transactions:
+            await self._settle_stale(now, lease_seconds)
+        candidates = await self.collection.find(self._due(now), {"_id": 0, "id": 1}) \
+            .sort("next_attempt_at", ASCENDING).limit(limit).to_list(limit)
+        if not candidates:
+            return []
+        # Re-check the due condition so two dispatchers never lease the same
+        # message, then read back what this lease actually won
+        lease = uuid.uuid4().hex
+        await self.collection.update_many(
+            {"id": {"$in": [candidate["id"] for candidate in candidates]}, **self._due(now)},
+            {
+                "$set": {"state": "sending", "lease": lease, "leased_until": now + timedelta(seconds=lease_seconds)},
+                "$inc": {"attempts": 1},
+            },
+        )
+        cursor = self.collection.find({"lease": lease}, {"_id": 0})
+        return await cursor.sort("next_attempt_at", ASCENDING).to_list(limit)
+
+    async def mark_sent(self, message_ids, sent_at):
+        await self.collection.update_many(
+            {"id": {"$in": list(message_ids)}},
+            {"$set": {"state": "sent", "sent_at": sent_at}, "$unset": {"lease": "", "leased_until": ""}},
+        )
+
+    async def mark_failed(self, message_id, error, next_attempt_at):
+        update = {"last_error": error}
+        if next_attempt_at is None:
+            update["state"] = "dead"
+        else:
+            update.update(state="pending", next_attempt_at=next_attempt_at)
+        await self.collection.update_one(
+            {"id": message_id},
+            {"$set": update, "$unset": {"lease": "", "leased_until": ""}},
+        )
+
+    async def list(self, transmittal_id):
+        cursor = self.collection.find({"transmittal_id": transmittal_id}, {"_id": 0, "lease": 0, "held_for": 0})
+        return await cursor.sort("created_at", ASCENDING).to_list(None)
+
+    async def initialize(self):
+        await self.collection.create_indexes(OUTBOX_INDEXES)
+        hello = await self.client.admin.command("hello")
+        # Replica set members report setName, mongos reports isdbgrid
+        self.transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        if not self.transactions:
+            logger.warning("MongoDB server is standalone; outbox messages are written without transactions")
+
+
+class MongoDocumentIssueRepository(DocumentIssueRepository):
+
+    def __init__(self, db):
+        self.collection = db.document_issues
+        self.transmittals = db.transmittals
+
+    async def index(self, transmittal):
+        await self.collection.bulk_write(
+            [DeleteMany({"transmittal_id": transmittal["id"]})]
+            + [InsertOne(row) for row in document_issue_rows(transmittal)]
+        )
+
+    async def update_transmittal(self, transmittal_id, fields):
+        row_fields = document_issue_fields(fields)
+        if row_fields:
+            await self.collection.update_many({"transmittal_id": transmittal_id}, {"$set": row_fields})
+
+    async def list(self, document_no):
+        cursor = self.collection.find({"document_no": document_no}, {"_id": 0})
+        return await cursor.sort([("revision", DESCENDING), ("issued_at", DESCENDING)]).to_list(None)
+
+    async def rebuild(self):
+        # Server side, the same rows as document_issue_rows (one per
+        # document number, highest revision then last listed); $out swaps
+        # the collection in atomically and keeps its indexes
+        await self.transmittals.aggregate([
+            {"$match": {"status": {"$ne": "draft"}}},
+            {"$unwind": {"path": "$documents", "includeArrayIndex": "position"}},
+            {"$sort": {"id": ASCENDING, "documents.revision": DESCENDING, "position": DESCENDING}},
+            {"$group": {
+                "_id": {"transmittal_id": "$id", "document_no": "$documents.document_no"},
+                "transmittal": {"$first": "$$ROOT"},
+            }},
+            {"$replaceWith": "$transmittal"},
+            {"$project": {
+                "_id": 0,
+                "document_no": "$documents.document_no",
+                "revision": "$documents.revision",
+                "title": "$documents.title",
+                **{column: f"${path}" for column, path in DOCUMENT_ISSUE_FIELDS.items()},
+                "transmittal_id": "$id",
+                "issued_at": {"$ifNull": ["$generated_date", "$updated_at"]},
+            }},
+            {"$out": self.collection.name},
+        ], allowDiskUse=True).to_list(None)
+        return await self.collection.count_documents({})
+
+    async def initialize(self):
+        await self.collection.create_indexes(DOCUMENT_ISSUE_INDEXES)
+        # Transmittals issued before the index existed
+        if not await self.collection.find_one({}, {"_id": 1}) and \
+                await self.transmittals.find_one({"status": {"$ne": "draft"}}, {"_id": 1}):
+            await self.rebuild()
+
+
+class MongoAuditRepository(AuditRepository):
+    """Audit events and snapshots.
+
+    record() only appends to an in-memory buffer, so the request that made
+    the change pays no extra round trip; a background task inserts the
+    buffer in batches. Events still buffered are written on close, but a
+    crashed worker loses its last AUDIT_FLUSH_SECONDS of events, and other
+    workers see them that much later. Snapshots of transmittals whose full
+    document the write did not return are read back by the background task.
+    """
+
+    def __init__(self, db):
+        self.events_collection = db.transmittal_events
+        self.snapshots = db.transmittal_snapshots
+        self.transmittals = db.transmittals
+        self._pending: List[dict] = []
+        self._pending_snapshots: List[dict] = []
+        self._snapshot_ids: Set[str] = set()
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.listeners = []
+
+    def record(self, event: dict, transmittal: Optional[dict] = None) -> None:
+        """Buffer event; transmittal is the full state it produced, if known"""
+        self._pending.append(event)
+        if event["action"] not in ("create", "delete") and snapshot_due(event["version"]):
+            if transmittal is not None:
+                self._pending_snapshots.append(audit_snapshot(transmittal, event["at"]))
+            else:
+                self._snapshot_ids.add(event["transmittal_id"])
+        if len(self._pending) >= AUDIT_BATCH_SIZE:
+            self._wake.set()
+        self._notify(event)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), AUDIT_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write audit events, will retry")
+
+    @staticmethod
+    async def _insert(collection, documents: List[dict]) -> None:
+        """Insert, ignoring documents a retried batch already wrote"""
+        if not documents:
+            return
+        try:
+            await collection.insert_many([dict(document) for document in documents], ordered=False)
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors") or any(
+                error["code"] != 11000 for error in e.details.get("writeErrors", [])
+            ):
+                raise
+
+    async def _first_seen(self, events: List[dict]) -> Set[str]:
+        """Ids of transmittals created before the audit log existed that
+        have no earlier event, so they get a snapshot to replay from"""
+        first_versions = {}
+        for event in events:
+            if event["action"] not in ("create", "delete"):
+                current = first_versions.get(event["transmittal_id"], event["version"])
+                first_versions[event["transmittal_id"]] = min(current, event["version"])
+        if not first_versions:
+            return set()
+        seen = await self.events_collection.distinct("transmittal_id", {"$or": [
+            {"transmittal_id": transmittal_id, "version": {"$lt": version}}
+            for transmittal_id, version in first_versions.items()
+        ]})
+        created = {event["transmittal_id"] for event in events if event["action"] == "create"}
+        return set(first_versions) - set(seen) - created
+
+    async def flush(self):
+        async with self._flush_lock:
+            events, self._pending = self._pending, []
+            snapshots, self._pending_snapshots = self._pending_snapshots, []
+            snapshot_ids, self._snapshot_ids = self._snapshot_ids, set()
+            try:
+                await self._insert(self.events_collection, events)
+                snapshot_ids |= await self._first_seen(events)
+                snapshot_ids -= {snapshot["transmittal_id"] for snapshot in snapshots}
+                if snapshot_ids:
+                    # Whatever version they are at now; events past it replay on top
+                    current = await self.transmittals.find(
+                        {"id": {"$in": list(snapshot_ids)}},
+                        {"_id": 0, **{f"receive_details.{field}": 0 for field in AUDIT_OMITTED_FIELDS}},
+                    ).to_list(None)
+                    snapshots += [audit_snapshot(transmittal) for transmittal in current]
+                    snapshot_ids = set()
+                await self._insert(self.snapshots, snapshots)
+            except BaseException:
+                self._pending = (events + self._pending)[-AUDIT_BUFFER_LIMIT:]
+                self._pending_snapshots = snapshots + self._pending_snapshots
+                self._snapshot_ids |= snapshot_ids
+                raise
+
+    async def events(self, transmittal_id, after_version, until_version, limit):
+        version = {"$gt": after_version}
+        if until_version is not None:
+            version["$lte"] = until_version
+        cursor = self.events_collection.find({"transmittal_id": transmittal_id, "version": version}, {"_id": 0})
+        cursor = cursor.sort("version", ASCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(None)
+
+    async def snapshot(self, transmittal_id, version):
+        return await self.snapshots.find_one(
+            {"transmittal_id": transmittal_id, "version": {"$lte": version}},
+            {"_id": 0},
+            sort=[("version", DESCENDING)],
+        )
+
+    async def version_at(self, transmittal_id, at):
+        event = await self.events_collection.find_one(
+            {"transmittal_id": transmittal_id, "at": {"$lte": at}},
+            {"_id": 0, "version": 1},
+            sort=[("version", DESCENDING)],
+        )
+        return event["version"] if event else None
+
+    async def initialize(self):
+        await self.events_collection.create_indexes(AUDIT_EVENT_INDEXES)
+        await self.snapshots.create_indexes(AUDIT_SNAPSHOT_INDEXES)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception(f"Lost {len(self._pending)} audit event(s) on shutdown")
+
+
+class MongoStorage(Storage):
+
+    def __init__(self, mongo_url: str, db_name: str, **client_options):
+        self.pool_monitor = PoolMonitor()
+        client_options["event_listeners"] = [*client_options.get("event_listeners", ()), self.pool_monitor]
+        self.client = AsyncIOMotorClient(mongo_url, **client_options)
+        self.db = self.client[db_name]
+        self.audit = MongoAuditRepository(self.db)
+        self.transmittals = MongoTransmittalRepository(self.db, self.audit)
+        self.status_checks = MongoStatusCheckRepository(self.db)
+        self.idempotency_keys = MongoIdempotencyKeyRepository(self.db)
+        self.outbox = MongoOutboxRepository(self.client, self.db, self.audit)
+        self.document_issues = MongoDocumentIssueRepository(self.db)
+
+    async def initialize(self):
+        await self.transmittals.initialize()
+        await self.status_checks.initialize()
+        await self.idempotency_keys.initialize()
+        await self.outbox.initialize()
+        await self.document_issues.initialize()
+        await self.audit.initialize()
+
+    async def close(self):
+        await self.audit.close()
+        self.client.close()
+
+    async def ping(self):
+        await self.client.admin.command("ping")
+
+    async def warm_up(self, connections):
+        # Concurrent commands each check out a connection of their own, so
+        # the pool grows to connections (within maxPoolSize). The list index
+        # read pulls the newest page into the server's cache.
+        await asyncio.gather(*(self.ping() for _ in range(max(connections - 1, 0))),
+                             self.transmittals.list({}, 0, 1, view="version"))
+
+    async def missing_indexes(self):
+        missing = []
+        for collection, indexes in COLLECTION_INDEXES.items():
+            existing = {index["name"] async for index in self.db[collection].list_indexes()}
+            missing += [f"{collection}.{index.document['name']}" for index in indexes
+                        if index.document["name"] not in existing]
+        return missing
+
+    def pool_stats(self):
+        return {
+            "backend": "mongo",
+            "max_pool_size": self.client.options.pool_options.max_pool_size,
+            "min_pool_size": self.client.options.pool_options.min_pool_size,
+            "transactions": self.outbox.transactions,
+            "servers": self.pool_monitor.stats(),
+        }
@@ -0,0 +1,1004 @@
+"""Embedded SQLite storage backend.
+
+For single-office deployments, CI and benchmarks that should not need a
+MongoDB server. Uses the standard library sqlite3 module in WAL mode on a
+single connection; every operation runs in a worker thread and holds the
+connection lock for its whole transaction, so reads and writes from the
+event loop never block it and compound updates stay atomic. Writes use
+BEGIN IMMEDIATE so several uvicorn workers can share one database file.
+
+Transmittals are stored as JSON with the filterable fields copied into
+indexed columns. The documents array lives in its own column so list and
+summary reads never parse it. SQLite has no TTL indexes; expired status
+checks, tombstones and idempotency keys are purged from the write path at
+most once a minute. Audit events are written in the transaction of the
+change they record.
+"""
+
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional, Sequence
+
+from .audit import audit_event, audit_snapshot, get_path, set_path, snapshot_due, without_blobs
+from .base import (
+    ACK_DUE_DAYS,
+    FILTER_FIELDS,
+    IDEMPOTENCY_KEY_TTL_HOURS,
+    OUTBOX_RETENTION_DAYS,
+    RECEIPT_BLOB_FIELDS,
+    STATUS_CHECK_RETENTION_DAYS,
+    TOMBSTONE_RETENTION_DAYS,
+    AuditRepository,
+    DocumentIssueRepository,
+    IdempotencyKeyRepository,
+    OutboxRepository,
+    StatusCheckRepository,
+    Storage,
+    TransmittalRepository,
+    document_issue_fields,
+    document_issue_rows,
+    facet_groups,
+    normalize_filters,
+)
+
+PURGE_INTERVAL_SECONDS = 60
+
+# Columns copied out of the transmittal JSON so they can be indexed
+TRANSMITTAL_COLUMNS = FILTER_FIELDS + (
+    "created_date", "updated_at", "version", "document_count", "ack_due_at", "next_reminder_at",
+)
+
+SCHEMA = [
+    f"""CREATE TABLE IF NOT EXISTS transmittals (
+        id TEXT PRIMARY KEY,
+        {", ".join(f"{column} {'INTEGER' if column in ('version', 'document_count') else 'TEXT'}" for column in TRANSMITTAL_COLUMNS)},
+        data TEXT NOT NULL,
+        documents TEXT NOT NULL DEFAULT '[]'
+    )""",
+    # Same shape as the Mongo TRANSMITTAL_INDEXES
+    "CREATE INDEX IF NOT EXISTS transmittals_created ON transmittals (created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_status_created ON transmittals (status, created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_department_created ON transmittals (department, created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_department_status_created ON transmittals (department, status, created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_project_created ON transmittals (project_name, created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_project_status_created ON transmittals (project_name, status, created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_type_created ON transmittals (transmittal_type, created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_type_department_created ON transmittals (transmittal_type, department, created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_send_to_created ON transmittals (send_to, created_date DESC)",
+    "CREATE INDEX IF NOT EXISTS transmittals_updated_at_id ON transmittals (updated_at, id)",
+    # Partial, like the Mongo ack_due_partial index
+    "CREATE INDEX IF NOT EXISTS transmittals_ack_due ON transmittals (ack_due_at) WHERE ack_due_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS transmittals_next_reminder ON transmittals (next_reminder_at) "
+    "WHERE next_reminder_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS transmittals_receipt_pending ON transmittals (id) "
+    "WHERE json_extract(data, '$.receive_details.receipt_status') = 'pending'",
+    """CREATE TABLE IF NOT EXISTS transmittal_tombstones (
+        id TEXT NOT NULL,
+        deleted_at TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS transmittal_tombstones_deleted_at ON transmittal_tombstones (deleted_at)",
+    """CREATE TABLE IF NOT EXISTS status_checks (
+        id TEXT NOT NULL,
+        client_name TEXT,
+        timestamp TEXT NOT NULL,
+        data TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS status_checks_timestamp_id ON status_checks (timestamp DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS status_checks_client_timestamp ON status_checks (client_name, timestamp DESC)",
+    """CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        data TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idempotency_keys_created_at ON idempotency_keys (created_at)",
+    """CREATE TABLE IF NOT EXISTS outbox (
+        id TEXT PRIMARY KEY,
+        transmittal_id TEXT NOT NULL,
+        state TEXT NOT NULL,
+        next_attempt_at TEXT,
+        leased_until TEXT,
+        created_at TEXT NOT NULL,
+        sent_at TEXT,
+        data TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS outbox_state_next_attempt ON outbox (state, next_attempt_at)",
+    "CREATE INDEX IF NOT EXISTS outbox_state_leased_until ON outbox (state, leased_until)",
+    "CREATE INDEX IF NOT EXISTS outbox_transmittal_created ON outbox (transmittal_id, created_at)",
+    """CREATE TABLE IF NOT EXISTS transmittal_events (
+        id TEXT PRIMARY KEY,
+        transmittal_id TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        at TEXT NOT NULL,
+        data TEXT NOT NULL
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS transmittal_events_version ON transmittal_events (transmittal_id, version)",
+    "CREATE INDEX IF NOT EXISTS transmittal_events_at ON transmittal_events (transmittal_id, at)",
+    """CREATE TABLE IF NOT EXISTS transmittal_snapshots (
+        transmittal_id TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        at TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (transmittal_id, version)
+    )""",
+    """CREATE TABLE IF NOT EXISTS document_issues (
+        transmittal_id TEXT NOT NULL,
+        document_no TEXT NOT NULL,
+        revision INTEGER,
+        issued_at TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (transmittal_id, document_no)
+    )""",
+    # Same shape as the Mongo document_revision_issued index
+    "CREATE INDEX IF NOT EXISTS document_issues_document ON document_issues (document_no, revision DESC, issued_at DESC)",
+]
+
+# Checked by missing_indexes once initialize has run the schema
+SCHEMA_INDEXES = [re.search(r"INDEX IF NOT EXISTS (\w+)", statement).group(1)
+                  for statement in SCHEMA if " INDEX " in statement]
+
+# Columns copied out of the outbox message JSON
+OUTBOX_COLUMNS = ("transmittal_id", "state", "next_attempt_at", "leased_until", "created_at", "sent_at")
+
+
+def _ts(value: Optional[datetime]) -> Optional[str]:
+    """Fixed-width ISO text, so string order matches time order"""
+    return value.isoformat(timespec="microseconds") if isinstance(value, datetime) else value
+
+
+def _encode(value) -> str:
+    def default(obj):
+        if isinstance(obj, datetime):
+            return {"$date": _ts(obj)}
+        raise TypeError(f"Cannot store {type(obj).__name__}")
+    return json.dumps(value, default=default)
+
+
+def _decode(text: str):
+    def object_hook(obj):
+        if len(obj) == 1 and "$date" in obj:
+            return datetime.fromisoformat(obj["$date"])
+        return obj
+    return json.loads(text, object_hook=object_hook)
+
+
+def _where(filters) -> tuple:
+    clauses, params = [], []
+    for field, values in normalize_filters(filters).items():
+        clauses.append(f"{field} IN ({', '.join('?' * len(values))})")
+        params.extend(values)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def _after_cursor(column: str, since: datetime, after_id: Optional[str]) -> tuple:
+    """Rows after (since, after_id) in (column, id) order"""
+    if after_id is None:
+        return f"{column} > ?", [_ts(since)]
+    return f"({column} > ? OR ({column} = ? AND id > ?))", [_ts(since), _ts(since), after_id]
+
+
+class SQLiteTransmittalRepository(TransmittalRepository):
+
+    def __init__(self, storage: "SQLiteStorage"):
+        self.storage = storage
+
+    @staticmethod
+    def _row_values(transmittal: dict) -> list:
+        data = {k: v for k, v in transmittal.items() if k != "documents"}
+        return [transmittal["id"]] + [_ts(transmittal.get(column)) for column in TRANSMITTAL_COLUMNS] + [
+            _encode(data),
+            _encode(transmittal.get("documents") or []),
+        ]
+
+    def _store(self, conn, transmittal: dict) -> None:
+        columns = ("id",) + TRANSMITTAL_COLUMNS + ("data", "documents")
+        conn.execute(
+            f"INSERT OR REPLACE INTO transmittals ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            self._row_values(transmittal),
+        )
+
+    @staticmethod
+    def _load(conn, transmittal_id: str) -> Optional[dict]:
+        row = conn.execute("SELECT data, documents FROM transmittals WHERE id = ?", (transmittal_id,)).fetchone()
+        if not row:
+            return None
+        transmittal = _decode(row[0])
+        transmittal["documents"] = _decode(row[1])
+        return transmittal
+
+    @staticmethod
+    def _view(transmittal: dict, view: str) -> dict:
+        if view == "version":
+            return {k: transmittal.get(k) for k in ("id", "version", "status")}
+        if view == "summary":
+            transmittal = {k: v for k, v in transmittal.items() if k != "documents"}
+            if isinstance(transmittal.get("receive_details"), dict):
+                transmittal["receive_details"] = {
+                    k: v for k, v in transmittal["receive_details"].items() if k not in RECEIPT_BLOB_FIELDS
+                }
+        return transmittal
+
+    @classmethod
+    def _select(cls, view: str) -> str:
+        return "SELECT data, '[]'" if view != "full" else "SELECT data, documents"
+
+    @classmethod
+    def _from_row(cls, row, view: str) -> dict:
+        transmittal = _decode(row[0])
+        if view == "full":
+            transmittal["documents"] = _decode(row[1])
+        return cls._view(transmittal, view)
+
+    async def insert(self, transmittal):
+        def insert(conn):
+            self._store(conn, transmittal)
+            self.storage.audit._record(conn, audit_event(
+                transmittal["id"], transmittal.get("version") or 1, "create",
+                {"state": without_blobs(transmittal)}, transmittal.get("updated_at"),
+            ))
+        await self.storage.write(insert)
+
+    async def get(self, transmittal_id, view="full"):
+        def get(conn):
+            row = conn.execute(f"{self._select(view)} FROM transmittals WHERE id = ?", (transmittal_id,)).fetchone()
+            return self._from_row(row, view) if row else None
+        return await self.storage.read(get)
+
+    async def get_many(self, transmittal_ids, view="full"):
+        ids = list(transmittal_ids)
+        if not ids:
+            return []
+        def get_many(conn):
+            rows = conn.execute(
+                f"{self._select(view)} FROM transmittals WHERE id IN ({', '.join('?' * len(ids))})", ids
+            ).fetchall()
+            return [self._from_row(row, view) for row in rows]
+        return await self.storage.read(get_many)
+
+    async def list(self, filters, skip, limit, view="full"):
+        where, params = _where(filters)
+        def list_page(conn):
+            rows = conn.execute(
+                f"{self._select(view)} FROM transmittals{where} ORDER BY created_date DESC LIMIT ? OFFSET ?",
+                params + [limit, skip],
+            ).fetchall()
+            return [self._from_row(row, view) for row in rows]
+        return await self.storage.read(list_page)
+
+    async def iterate(self, filters, skip, limit, view="full"):
+        where, params = _where(filters)
+        def page(conn, after, offset, batch_size):
+            # Keyset on (created_date, id) after the first batch, so later
+            # batches cost the same as the first
+            page_where, page_params = where, list(params)
+            if after:
+                page_where += (" AND " if page_where else " WHERE ") + "(created_date, id) < (?, ?)"
+                page_params.extend(after)
+            return conn.execute(
+                f"{self._select(view)}, created_date, id FROM transmittals{page_where} "
+                "ORDER BY created_date DESC, id DESC LIMIT ? OFFSET ?",
+                page_params + [batch_size, offset],
+            ).fetchall()
+
+        after, offset, remaining = None, skip, limit
+        while remaining is None or remaining > 0:
+            batch_size = 500 if remaining is None else min(500, remaining)
+            rows = await self.storage.read(page, after, offset, batch_size)
+            for row in rows:
+                yield self._from_row(row, view)
+            if len(rows) < batch_size:
+                return
+            after, offset = (rows[-1][2], rows[-1][3]), 0
+            if remaining is not None:
+                remaining -= len(rows)
+
+    async def count(self, filters):
+        where, params = _where(filters)
+        return await self.storage.read(
+            lambda conn: conn.execute(f"SELECT COUNT(*) FROM transmittals{where}", params).fetchone()[0]
+        )
+
+    async def facets(self, filters):
+        def facets(conn):
+            where, params = _where(filters)
+            total = conn.execute(f"SELECT COUNT(*) FROM transmittals{where}", params).fetchone()[0]
+            counts = {}
+            for group_filters, fields in facet_groups(filters):
+                where, params = _where(group_filters)
+                for field in fields:
+                    counts[field] = conn.execute(
+                        f"SELECT {field}, COUNT(*) AS n FROM transmittals{where} GROUP BY {field} ORDER BY n DESC",
+                        params,
+                    ).fetchall()
+            return total, {field: counts[field] for field in FILTER_FIELDS}
+        return await self.storage.read(facets)
+
+    async def count_issued(self):
+        return await self.storage.read(
+            lambda conn: conn.execute("SELECT COUNT(*) FROM transmittals WHERE status IS NOT 'draft'").fetchone()[0]
+        )
+
+    def _update(
+        self, conn, transmittal_id: str, fields: dict, expected_version: Optional[int], action: str,
+        match: Optional[dict] = None,
+    ) -> Optional[dict]:
+        transmittal = self._load(conn, transmittal_id)
+        if not transmittal:
+            return None
+        if expected_version is not None and transmittal.get("version") != expected_version:
+            return None
+        if any(get_path(transmittal, path) != value for path, value in (match or {}).items()):
+            return None
+        for path, value in fields.items():
+            set_path(transmittal, path, value)
+        transmittal["version"] = (transmittal.get("version") or 0) + 1
+        self._store(conn, transmittal)
+        self.storage.audit._record(
+            conn, audit_event(transmittal_id, transmittal["version"], action, {"set": fields}), transmittal
+        )
+        return transmittal
+
+    async def update(self, transmittal_id, fields, expected_version=None, view="full", action="update", match=None):
+        def update(conn):
+            transmittal = self._update(conn, transmittal_id, fields, expected_version, action, match)
+            return self._view(transmittal, view) if transmittal else None
+        return await self.storage.write(update)
+
+    async def delete(self, transmittal_id, deleted_at):
+        def delete(conn):
+            row = conn.execute("SELECT version FROM transmittals WHERE id = ?", (transmittal_id,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM transmittals WHERE id = ?", (transmittal_id,))
+                self.storage.audit._record(
+                    conn, audit_event(transmittal_id, (row[0] or 0) + 1, "delete", {}, deleted_at)
+                )
+            conn.execute(
+                "INSERT INTO transmittal_tombstones (id, deleted_at) VALUES (?, ?)", (transmittal_id, _ts(deleted_at))
+            )
+        await self.storage.write(delete)
+
+    async def changed_since(self, since, limit, after_id=None):
+        def changed(conn):
+            where, params = _after_cursor("updated_at", since, after_id)
+            rows = conn.execute(
+                f"SELECT data, documents FROM transmittals WHERE {where} ORDER BY updated_at, id LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+            return [self._from_row(row, "full") for row in rows]
+        return await self.storage.read(changed)
+
+    async def deleted_since(self, since, limit, after_id=None):
+        def deleted(conn):
+            where, params = _after_cursor("deleted_at", since, after_id)
+            rows = conn.execute(
+                f"SELECT id, deleted_at FROM transmittal_tombstones WHERE {where} ORDER BY deleted_at, id LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+            return [{"id": row[0], "deleted_at": datetime.fromisoformat(row[1])} for row in rows]
+        return await self.storage.read(deleted)
+
+    async def overdue(self, now, skip, limit):
+        def overdue(conn):
+            # The IS NOT NULL term lets SQLite pick the partial index
+            rows = conn.execute(
+                f"{self._select('summary')} FROM transmittals WHERE ack_due_at IS NOT NULL AND ack_due_at <= ? "
+                "ORDER BY ack_due_at LIMIT ? OFFSET ?",
+                (_ts(now), limit, skip),
+            ).fetchall()
+            return [self._from_row(row, "summary") for row in rows]
+        return await self.storage.read(overdue)
+
+    async def pending_receipts(self, limit):
+        def pending_receipts(conn):
+            # Same expression as the partial index's filter
+            return [tuple(row) for row in conn.execute(
+                "SELECT id, json_extract(data, '$.receive_details.receipt_id') FROM transmittals "
+                "WHERE json_extract(data, '$.receive_details.receipt_status') = 'pending' LIMIT ?",
+                (limit,),
+            )]
+        return await self.storage.read(pending_receipts)
+
+    async def reminders_due(self, now, skip, limit, addressed_only=False):
+        def reminders_due(conn):
+            addressed = " AND IFNULL(json_extract(data, '$.recipient_email'), '') != ''" if addressed_only else ""
+            rows = conn.execute(
+                f"{self._select('summary')} FROM transmittals WHERE next_reminder_at IS NOT NULL "
+                f"AND next_reminder_at <= ?{addressed} ORDER BY next_reminder_at LIMIT ? OFFSET ?",
+                (_ts(now), limit, skip),
+            ).fetchall()
+            return [self._from_row(row, "summary") for row in rows]
+        return await self.storage.read(reminders_due)
+
+    async def get_documents(self, transmittal_id, skip, limit):
+        def get_documents(conn):
+            row = conn.execute(
+                "SELECT document_count, documents FROM transmittals WHERE id = ?", (transmittal_id,)
+            ).fetchone()
+            if not row:
+                return None
+            return row[0] or 0, _decode(row[1])[skip:skip + limit]
+        return await self.storage.read(get_documents)
+
+    async def has_document(self, transmittal_id, document_no):
+        def has_document(conn):
+            row = conn.execute(
+                "SELECT 1 FROM transmittals, json_each(transmittals.documents) "
+                "WHERE transmittals.id = ? AND json_extract(json_each.value, '$.document_no') = ? LIMIT 1",
+                (transmittal_id, document_no),
+            ).fetchone()
+            return row is not None
+        return await self.storage.read(has_document)
+
+    def _modify_draft(self, transmittal_id, updated_at, change, action, changes):
+        """Run change(transmittal) on a draft inside one write transaction.
+
+        change returns a result or None to abort without writing; changes
+        describe it for the audit log.
+        """
+        def modify(conn):
+            transmittal = self._load(conn, transmittal_id)
+            if not transmittal or transmittal.get("status") != "draft":
+                return None
+            result = change(transmittal)
+            if result is None:
+                return None
+            transmittal["version"] = (transmittal.get("version") or 0) + 1
+            transmittal["updated_at"] = updated_at
+            self._store(conn, transmittal)
+            self.storage.audit._record(conn, audit_event(
+                transmittal_id, transmittal["version"], action, {"set": {"updated_at": updated_at}, **changes}
+            ), transmittal)
+            return self._view(transmittal, "version"), result
+        return self.storage.write(modify)
+
+    async def push_documents(self, transmittal_id, documents, updated_at):
+        def push(transmittal):
+            existing = {document["document_no"] for document in transmittal["documents"]}
+            if existing & {document["document_no"] for document in documents}:
+                return None
+            transmittal["documents"].extend(documents)
+            transmittal["document_count"] = (transmittal.get("document_count") or 0) + len(documents)
+            return True
+        result = await self._modify_draft(
+            transmittal_id, updated_at, push, "add_documents", {"push_documents": documents}
+        )
+        return result[0] if result else None
+
+    async def update_document(self, transmittal_id, document_no, fields, updated_at):
+        def update(transmittal):
+            by_no = {document["document_no"]: document for document in transmittal["documents"]}
+            new_document_no = fields.get("document_no", document_no)
+            if document_no not in by_no or (new_document_no != document_no and new_document_no in by_no):
+                return None
+            by_no[document_no].update(fields)
+            return dict(by_no[document_no])
+        return await self._modify_draft(
+            transmittal_id, updated_at, update, "update_document",
+            {"update_document": {"document_no": document_no, "set": fields}},
+        )
+
+    async def pull_document(self, transmittal_id, document_no, updated_at):
+        def pull(transmittal):
+            remaining = [d for d in transmittal["documents"] if d["document_no"] != document_no]
+            if len(remaining) == len(transmittal["documents"]):
+                return None
+            transmittal["document_count"] = (transmittal.get("document_count") or 0) - (
+                len(transmittal["documents"]) - len(remaining)
+            )
+            transmittal["documents"] = remaining
+            return True
+        result = await self._modify_draft(
+            transmittal_id, updated_at, pull, "remove_document", {"pull_document": document_no}
+        )
+        return result[0] if result else None
+
+
+class SQLiteStatusCheckRepository(StatusCheckRepository):
+
+    def __init__(self, storage: "SQLiteStorage"):
+        self.storage = storage
+
+    async def insert(self, status_check):
+        await self.storage.write(lambda conn: conn.execute(
+            "INSERT INTO status_checks (id, client_name, timestamp, data) VALUES (?, ?, ?, ?)",
+            (status_check["id"], status_check.get("client_name"), _ts(status_check["timestamp"]), _encode(status_check)),
+        ))
+
+    def _page(self, conn, client_name, before, limit):
+        clauses, params = [], []
+        if before:
+            timestamp, status_id = before
+            clauses.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params.extend([_ts(timestamp), _ts(timestamp), status_id])
+        if client_name:
+            clauses.append("client_name = ?")
+            params.append(client_name)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        rows = conn.execute(
+            f"SELECT data FROM status_checks{where} ORDER BY timestamp DESC, id DESC LIMIT ?", params + [limit]
+        ).fetchall()
+        return [_decode(row[0]) for row in rows]
+
+    async def list(self, client_name, before, limit):
+        return await self.storage.read(self._page, client_name, before, limit)
+
+    async def iterate(self, client_name, before, limit):
+        remaining = limit
+        while remaining is None or remaining > 0:
+            batch_size = 500 if remaining is None else min(500, remaining)
+            batch = await self.storage.read(self._page, client_name, before, batch_size)
+            for status_check in batch:
+                yield status_check
+            if len(batch) < batch_size:
+                return
+            before = (batch[-1]["timestamp"], batch[-1]["id"])
+            if remaining is not None:
+                remaining -= len(batch)
+
+    async def rates(self, since, until, window, client_name):
+        params = [window, window, _ts(since), _ts(until)]
+        client_clause = ""
+        if client_name:
+            client_clause = " AND client_name = ?"
+            params.append(client_name)
+        def rates(conn):
+            rows = conn.execute(
+                "SELECT client_name, (CAST(strftime('%s', timestamp) AS INTEGER) / ?) * ? AS bucket, COUNT(*) "
+                f"FROM status_checks WHERE timestamp >= ? AND timestamp < ?{client_clause} "
+                "GROUP BY client_name, bucket ORDER BY bucket, client_name",
+                params,
+            ).fetchall()
+            return [(row[0], datetime.utcfromtimestamp(row[1]), row[2]) for row in rows]
+        return await self.storage.read(rates)
+
+
+class SQLiteIdempotencyKeyRepository(IdempotencyKeyRepository):
+
+    def __init__(self, storage: "SQLiteStorage"):
+        self.storage = storage
+
+    async def claim(self, record):
+        def claim(conn):
+            expired = _ts(datetime.utcnow() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS))
+            conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND created_at < ?", (record["key"], expired))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO idempotency_keys (key, created_at, data) VALUES (?, ?, ?)",
+                (record["key"], _ts(record["created_at"]), _encode(record)),
+            )
+            if cursor.rowcount == 1:
+                return True
+            row = conn.execute("SELECT data FROM idempotency_keys WHERE key = ?", (record["key"],)).fetchone()
+            existing = _decode(row[0])
+            if (
+                existing["state"] != "pending"
+                or (existing["scope"], existing["request_hash"]) != (record["scope"], record["request_hash"])
+                or not existing.get("locked_until")
+                or existing["locked_until"] >= record["created_at"]
+            ):
+                return False
+            conn.execute(
+                "UPDATE idempotency_keys SET created_at = ?, data = ? WHERE key = ?",
+                (_ts(record["created_at"]), _encode(record), record["key"]),
+            )
+            return True
+        return await self.storage.write(claim)
+
+    async def get(self, key):
+        def get(conn):
+            row = conn.execute("SELECT data FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+            return _decode(row[0]) if row else None
+        return await self.storage.read(get)
+
+    async def complete(self, key, status_code, response, headers):
+        def complete(conn):
+            row = conn.execute("SELECT data FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return
+            record = _decode(row[0])
+            record.update(state="done", status_code=status_code, response=response, headers=headers)
+            conn.execute("UPDATE idempotency_keys SET data = ? WHERE key = ?", (_encode(record), key))
+        await self.storage.write(complete)
+
+    async def release(self, key, lease_id=None):
+        query = "DELETE FROM idempotency_keys WHERE key = ? AND json_extract(data, '$.state') = 'pending'"
+        params = (key,)
+        if lease_id is not None:
+            query += " AND json_extract(data, '$.lease_id') = ?"
+            params += (lease_id,)
+        await self.storage.write(lambda conn: conn.execute(query, params))
+
+
+class SQLiteOutboxRepository(OutboxRepository):
+
+    def __init__(self, storage: "SQLiteStorage"):
+        self.storage = storage
+
+    @staticmethod
+    def _store(conn, message: dict) -> None:
+        columns = ("id",) + OUTBOX_COLUMNS + ("data",)
+        conn.execute(
+            f"INSERT OR REPLACE INTO outbox ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [message["id"]] + [_ts(message.get(column)) for column in OUTBOX_COLUMNS] + [_encode(message)],
+        )
+
+    async def enqueue(self, transmittal_id, fields, messages, expected_version=None):
+        def enqueue(conn):
+            transmittal = self.storage.transmittals._update(conn, transmittal_id, fields, expected_version, "share")
+            if not transmittal:
+                return None
+            for message in messages:
+                self._store(conn, message)
+            return self.storage.transmittals._view(transmittal, "version")
+        return await self.storage.write(enqueue)
+
+    async def enqueue_reminders(self, transmittal_ids, now, fields, compose):
+        ids = list(transmittal_ids)
+        if not ids:
+            return []
+        transmittals = self.storage.transmittals
+        def enqueue_reminders(conn):
+            rows = conn.execute(
+                f"SELECT id FROM transmittals WHERE id IN ({', '.join('?' * len(ids))}) "
+                "AND next_reminder_at IS NOT NULL AND next_reminder_at <= ?",
+                ids + [_ts(now)],
+            ).fetchall()
+            due = [transmittals._view(transmittals._load(conn, row[0]), "summary") for row in rows]
+            for transmittal in due:
+                transmittals._update(conn, transmittal["id"], fields, None, "remind")
+            for message in compose(due) if due else []:
+                self._store(conn, message)
+            return [transmittal["id"] for transmittal in due]
+        return await self.storage.write(enqueue_reminders)
+
+    async def claim(self, now, limit, lease_seconds):
+        def claim(conn):
+            rows = conn.execute(
+                "SELECT data FROM outbox WHERE (state = 'pending' AND next_attempt_at <= ?) "
+                "OR (state = 'sending' AND leased_until <= ?) ORDER BY next_attempt_at LIMIT ?",
+                (_ts(now), _ts(now), limit),
+            ).fetchall()
+            # The write transaction already excludes other dispatchers
+            lease, leased_until = uuid.uuid4().hex, now + timedelta(seconds=lease_seconds)
+            messages = []
+            for row in rows:
+                message = _decode(row[0])
+                message.update(
+                    state="sending", lease=lease, leased_until=leased_until, attempts=message.get("attempts", 0) + 1
+                )
+                self._store(conn, message)
+                messages.append(message)
+            return messages
+        return await self.storage.write(claim)
+
+    def _modify(self, conn, message_id: str, changes: dict) -> None:
+        row = conn.execute("SELECT data FROM outbox WHERE id = ?", (message_id,)).fetchone()
+        if not row:
+            return
+        message = _decode(row[0])
+        message.pop("lease", None)
+        message.pop("leased_until", None)
+        message.update(changes)
+        self._store(conn, message)
+
+    async def mark_sent(self, message_ids, sent_at):
+        def mark_sent(conn):
+            for message_id in message_ids:
+                self._modify(conn, message_id, {"state": "sent", "sent_at": sent_at})
+        await self.storage.write(mark_sent)
+
+    async def mark_failed(self, message_id, error, next_attempt_at):
+        changes = {"last_error": error}
+        if next_attempt_at is None:
+            changes["state"] = "dead"
+        else:
+            changes.update(state="pending", next_attempt_at=next_attempt_at)
+        await self.storage.write(self._modify, message_id, changes)
+
+    async def list(self, transmittal_id):
+        def list_messages(conn):
+            rows = conn.execute(
+                "SELECT data FROM outbox WHERE transmittal_id = ? ORDER BY created_at", (transmittal_id,)
+            ).fetchall()
+            messages = [_decode(row[0]) for row in rows]
+            for message in messages:
+                message.pop("lease", None)
+            return messages
+        return await self.storage.read(list_messages)
+
+
+class SQLiteDocumentIssueRepository(DocumentIssueRepository):
+
+    def __init__(self, storage: "SQLiteStorage"):
+        self.storage = storage
+
+    @staticmethod
+    def _store(conn, row: dict) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO document_issues (transmittal_id, document_no, revision, issued_at, data) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (row["transmittal_id"], row["document_no"], row.get("revision"), _ts(row.get("issued_at")), _encode(row)),
+        )
+
+    def _index(self, conn, transmittal: dict) -> int:
+        conn.execute("DELETE FROM document_issues WHERE transmittal_id = ?", (transmittal["id"],))
+        rows = document_issue_rows(transmittal)
+        for row in rows:
+            self._store(conn, row)
+        return len(rows)
+
+    async def index(self, transmittal):
+        await self.storage.write(self._index, transmittal)
+
+    async def update_transmittal(self, transmittal_id, fields):
+        row_fields = document_issue_fields(fields)
+        if not row_fields:
+            return
+        def update_transmittal(conn):
+            rows = conn.execute("SELECT data FROM document_issues WHERE transmittal_id = ?", (transmittal_id,)).fetchall()
+            for (data,) in rows:
+                self._store(conn, {**_decode(data), **row_fields})
+        await self.storage.write(update_transmittal)
+
+    async def list(self, document_no):
+        def list_issues(conn):
+            rows = conn.execute(
+                "SELECT data FROM document_issues WHERE document_no = ? ORDER BY revision DESC, issued_at DESC",
+                (document_no,),
+            ).fetchall()
+            return [_decode(row[0]) for row in rows]
+        return await self.storage.read(list_issues)
+
+    def _rebuild(self, conn) -> int:
+        conn.execute("DELETE FROM document_issues")
+        transmittals = self.storage.transmittals
+        rows = conn.execute("SELECT id FROM transmittals WHERE status IS NOT 'draft'").fetchall()
+        return sum(self._index(conn, transmittals._load(conn, transmittal_id)) for (transmittal_id,) in rows)
+
+    async def rebuild(self):
+        return await self.storage.write(self._rebuild)
+
+
+class SQLiteAuditRepository(AuditRepository):
+
+    def __init__(self, storage: "SQLiteStorage"):
+        self.storage = storage
+        self.listeners = []
+
+    def _record(self, conn, event: dict, transmittal: Optional[dict] = None) -> None:
+        """Insert event in the caller's transaction; transmittal is the state
+        it produced, snapshotted when due or when this is the first event of
+        a transmittal created before the audit log existed"""
+        first = event["action"] != "create" and conn.execute(
+            "SELECT 1 FROM transmittal_events WHERE transmittal_id = ? LIMIT 1", (event["transmittal_id"],)
+        ).fetchone() is None
+        conn.execute(
+            "INSERT OR IGNORE INTO transmittal_events (id, transmittal_id, version, at, data) VALUES (?, ?, ?, ?, ?)",
+            (event["id"], event["transmittal_id"], event["version"], _ts(event["at"]), _encode(event)),
+        )
+        if transmittal is not None and event["action"] != "create" and (first or snapshot_due(event["version"])):
+            snapshot = audit_snapshot(transmittal, event["at"])
+            conn.execute(
+                "INSERT OR REPLACE INTO transmittal_snapshots (transmittal_id, version, at, state) VALUES (?, ?, ?, ?)",
+                (snapshot["transmittal_id"], snapshot["version"], _ts(snapshot["at"]), _encode(snapshot["state"])),
+            )
+        # Reads queue behind this transaction for the connection lock
+        self._notify(event)
+
+    async def events(self, transmittal_id, after_version, until_version, limit):
+        clauses, params = ["transmittal_id = ?", "version > ?"], [transmittal_id, after_version]
+        if until_version is not None:
+            clauses.append("version <= ?")
+            params.append(until_version)
+        def events(conn):
+            rows = conn.execute(
+                f"SELECT data FROM transmittal_events WHERE {' AND '.join(clauses)} ORDER BY version LIMIT ?",
+                params + [-1 if limit is None else limit],
+            ).fetchall()
+            return [_decode(row[0]) for row in rows]
+        return await self.storage.read(events)
+
+    async def snapshot(self, transmittal_id, version):
+        def snapshot(conn):
+            row = conn.execute(
+                "SELECT version, at, state FROM transmittal_snapshots WHERE transmittal_id = ? AND version <= ? "
+                "ORDER BY version DESC LIMIT 1",
+                (transmittal_id, version),
+            ).fetchone()
+            if not row:
+                return None
+            return {
+                "transmittal_id": transmittal_id,
+                "version": row[0],
+                "at": datetime.fromisoformat(row[1]),
+                "state": _decode(row[2]),
+            }
+        return await self.storage.read(snapshot)
+
+    async def version_at(self, transmittal_id, at):
+        return await self.storage.read(lambda conn: conn.execute(
+            "SELECT MAX(version) FROM transmittal_events WHERE transmittal_id = ? AND at <= ?",
+            (transmittal_id, _ts(at)),
+        ).fetchone()[0])
+
+    async def flush(self):
+        pass
+
+
+class SQLiteStorage(Storage):
+
+    def __init__(self, path: str, listeners: Sequence = ()):
+        self.path = path
+        # Objects with call_finished(name, write, duration, statements),
+        # told about every read and write once it is done
+        self.listeners = list(listeners)
+        self.statements = 0
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.last_purge = 0.0
+        self.transmittals = SQLiteTransmittalRepository(self)
+        self.status_checks = SQLiteStatusCheckRepository(self)
+        self.idempotency_keys = SQLiteIdempotencyKeyRepository(self)
+        self.outbox = SQLiteOutboxRepository(self)
+        self.audit = SQLiteAuditRepository(self)
+        self.document_issues = SQLiteDocumentIssueRepository(self)
+
+    def _run(self, fn, args, write: bool):
+        if not self.listeners:
+            return self._call(fn, args, write)
+        # Includes the wait for the lock: that is part of the round trip
+        start = time.perf_counter()
+        statements = 0
+        try:
+            with self.lock:
+                self.statements = 0
+                try:
+                    return self._call_locked(fn, args, write)
+                finally:
+                    statements = self.statements
+        finally:
+            duration = time.perf_counter() - start
+            for listener in self.listeners:
+                listener.call_finished(fn.__name__, write, duration, statements)
+
+    def _call(self, fn, args, write: bool):
+        with self.lock:
+            return self._call_locked(fn, args, write)
+
+    def _call_locked(self, fn, args, write: bool):
+        if not write:
+            return fn(self.conn, *args)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(self.conn, *args)
+            if time.monotonic() - self.last_purge > PURGE_INTERVAL_SECONDS:
+                self._purge_expired()
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return result
+
+    async def read(self, fn, *args):
+        return await asyncio.to_thread(self._run, fn, args, False)
+
+    async def write(self, fn, *args):
+        return await asyncio.to_thread(self._run, fn, args, True)
+
+    def _purge_expired(self):
+        now = datetime.utcnow()
+        self.conn.execute(
+            "DELETE FROM status_checks WHERE timestamp < ?",
+            (_ts(now - timedelta(days=STATUS_CHECK_RETENTION_DAYS)),),
+        )
+        self.conn.execute(
+            "DELETE FROM transmittal_tombstones WHERE deleted_at < ?",
+            (_ts(now - timedelta(days=TOMBSTONE_RETENTION_DAYS)),),
+        )
+        self.conn.execute(
+            "DELETE FROM idempotency_keys WHERE created_at < ?",
+            (_ts(now - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)),),
+        )
+        self.conn.execute(
+            "DELETE FROM outbox WHERE state = 'sent' AND sent_at < ?",
+            (_ts(now - timedelta(days=OUTBOX_RETENTION_DAYS)),),
+        )
+        self.last_purge = time.monotonic()
+
+    def _count_statement(self, statement: str) -> None:
+        self.statements += 1
+
+    def _backfill_ack_due(self):
+        """Give transmittals sent before acknowledgement tracking an
+        ack_due_at, take it from any an earlier backfill gave one without
+        their having been sent, and start the reminders of those awaiting
+        acknowledgement from before next_reminder_at existed"""
+        due = self.conn.execute(
+            "SELECT id FROM transmittals WHERE status IN ('sent', 'received') AND ack_due_at IS NULL "
+            "AND json_type(data, '$.ack_due_at') IS NULL "
+            "AND json_extract(data, '$.sent_status') = 'Sent' "
+            "AND IFNULL(json_extract(data, '$.received_status'), '') != 'Received'"
+        ).fetchall()
+        not_sent = self.conn.execute(
+            "SELECT id FROM transmittals WHERE ack_due_at IS NOT NULL "
+            "AND IFNULL(json_extract(data, '$.sent_status'), '') != 'Sent'"
+        ).fetchall()
+        unscheduled = self.conn.execute(
+            "SELECT id FROM transmittals WHERE ack_due_at IS NOT NULL "
+            "AND json_type(data, '$.next_reminder_at') IS NULL"
+        ).fetchall()
+        if not due and not not_sent and not unscheduled:
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        for (transmittal_id,) in due:
+            transmittal = self.transmittals._load(self.conn, transmittal_id)
+            transmittal["ack_due_at"] = transmittal["updated_at"] + timedelta(days=ACK_DUE_DAYS)
+            transmittal["next_reminder_at"] = transmittal["ack_due_at"]
+            self.transmittals._store(self.conn, transmittal)
+        for (transmittal_id,) in not_sent:
+            transmittal = self.transmittals._load(self.conn, transmittal_id)
+            transmittal["ack_due_at"] = transmittal["next_reminder_at"] = None
+            self.transmittals._store(self.conn, transmittal)
+        for (transmittal_id,) in unscheduled:
+            transmittal = self.transmittals._load(self.conn, transmittal_id)
+            if transmittal.get("ack_due_at") and "next_reminder_at" not in transmittal:
+                transmittal["next_reminder_at"] = transmittal["ack_due_at"]
+                self.transmittals._store(self.conn, transmittal)
+        self.conn.execute("COMMIT")
+
+    async def initialize(self):
+        def initialize():
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA busy_timeout=5000")
+            if self.listeners:
+                self.conn.set_trace_callback(self._count_statement)
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(transmittals)")}
+            for column in ("ack_due_at", "next_reminder_at"):
+                if columns and column not in columns:
+                    self.conn.execute(f"ALTER TABLE transmittals ADD COLUMN {column} TEXT")
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+            # Superseded by transmittals_updated_at_id
+            self.conn.execute("DROP INDEX IF EXISTS transmittals_updated_at")
+            self._backfill_ack_due()
+            # Transmittals issued before the document issue index existed
+            if not self.conn.execute("SELECT 1 FROM document_issues LIMIT 1").fetchone() and \
+                    self.conn.execute("SELECT 1 FROM transmittals WHERE status IS NOT 'draft' LIMIT 1").fetchone():
+                self._call_locked(self.document_issues._rebuild, (), True)
+        await asyncio.to_thread(initialize)
+
+    async def close(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            await asyncio.to_thread(conn.close)
+
+    async def ping(self):
+        def ping(conn):
+            conn.execute("SELECT 1").fetchone()
+        await self.read(ping)
+
+    async def warm_up(self, connections):
+        # One connection whatever the count; reading the newest page of the
+        # list index brings its pages into the page cache
+        def warm_up(conn):
+            conn.execute("SELECT id FROM transmittals ORDER BY created_date DESC LIMIT 100").fetchall()
+        await self.read(warm_up)
+
+    async def missing_indexes(self):
+        def index_names(conn):
+            return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        existing = await self.read(index_names)
+        return [name for name in SCHEMA_INDEXES if name not in existing]
+
+    def pool_stats(self):
+        return {
+            "backend": "sqlite",
+            "connections": int(self.conn is not None),
+            "in_use": self.lock.locked(),
+        }
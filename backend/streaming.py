@@ -0,0 +1,101 @@
+"""
+Streamed NDJSON responses.
+
+Documents are read from an async iterator (a storage cursor), encoded one
+line at a time and sent in chunks of about NDJSON_CHUNK_BYTES, so memory use
+stays flat however many documents match. StreamingResponse only asks for
+the next chunk once the server has handed the previous one to the socket,
+which waits while a slow client's send buffer is full; the cursor is not
+advanced until then, which gives backpressure all the way to the database.
+
+The stream is compressed incrementally when the client accepts it: brotli
+(if the optional Brotli package is installed) or gzip.
+"""
+
+import json
+import os
+import zlib
+from typing import AsyncIterator, Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+NDJSON_CHUNK_BYTES = int(os.environ.get('NDJSON_CHUNK_BYTES', '65536'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '4'))
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Best supported content coding in an Accept-Encoding header, or None
+    for identity"""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            accepted[coding.lower()] = quality
+
+    supported = (["br"] if brotli is not None else []) + ["gzip"]
+    candidates = [c for c in supported if accepted.get(c, accepted.get("*", 0)) > 0]
+    if not candidates:
+        return None
+    # Server preference breaks ties between equal q-values
+    return max(candidates, key=lambda c: accepted.get(c, accepted.get("*", 0)))
+
+
+async def ndjson_chunks(documents: AsyncIterator[dict], model) -> AsyncIterator[bytes]:
+    """Documents validated through model, as NDJSON in chunks"""
+    buffer = []
+    size = 0
+    async for document in documents:
+        line = (json.dumps(jsonable_encoder(model(**document))) + "\n").encode()
+        buffer.append(line)
+        size += len(line)
+        if size >= NDJSON_CHUNK_BYTES:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+async def compressed(chunks: AsyncIterator[bytes], encoding: Optional[str]) -> AsyncIterator[bytes]:
+    if encoding is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+        compress, finish = compressor.compress, compressor.flush
+    async for chunk in chunks:
+        output = compress(chunk)
+        if output:
+            yield output
+    yield finish()
+
+
+def ndjson_response(documents: AsyncIterator[dict], model, accept_encoding: Optional[str] = None) -> StreamingResponse:
+    encoding = negotiate_encoding(accept_encoding)
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(
+        compressed(ndjson_chunks(documents, model), encoding),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
@@ -0,0 +1,317 @@
+"""
+Request-scoped tracing.
+
+Every request gets a Trace held in a context variable. Spans are recorded
+for the route (split into validation, handler and serialization by
+TracedRoute), for each MongoDB command (MongoCommandTracer, a pymongo
+command listener; Motor runs pymongo in a thread pool but copies the
+context, so the listener sees the request's trace) and for each SQLite call
+(SQLiteCallTracer). With TRACE_SERVER_TIMING=true each response also
+carries a Server-Timing header with the database round-trip count and the
+time split; it is off by default, since it tells any client how its request
+was served.
+
+Finished traces are exported as JSON lines to TRACE_EXPORT_PATH and/or
+POSTed in batches to TRACE_COLLECTOR_URL, from a background thread so export
+never delays a response. TRACE_SAMPLE_RATE limits the share exported.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, Optional
+
+from fastapi.routing import APIRoute
+
+try:
+    from pymongo import monitoring
+except ImportError:  # pragma: no cover - only the SQLite backend in use
+    monitoring = None
+
+logger = logging.getLogger(__name__)
+
+TRACE_SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING', 'false').lower() == 'true'
+TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH')
+TRACE_COLLECTOR_URL = os.environ.get('TRACE_COLLECTOR_URL')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1.0'))
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[str]] = ContextVar("current_span", default=None)
+
+
+class Trace:
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.spans: List[dict] = []
+        self.db_round_trips = 0
+        self.db_seconds = 0.0
+        # Database spans are recorded from driver threads
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, kind: str, start: float, duration: float,
+                 parent_id: Optional[str], span_id: Optional[str] = None, **attributes) -> str:
+        span_id = span_id or uuid.uuid4().hex[:16]
+        with self._lock:
+            self.spans.append({
+                "span_id": span_id,
+                "parent_id": parent_id,
+                "name": name,
+                "kind": kind,
+                "start_ms": round((start - self.started) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+                **attributes,
+            })
+            if kind == "db":
+                self.db_round_trips += 1
+                self.db_seconds += duration
+        return span_id
+
+    def phase_seconds(self, name: str) -> float:
+        return sum(s["duration_ms"] for s in self.spans if s["name"] == name) / 1000
+
+    def server_timing(self) -> str:
+        """Server-Timing header value (durations in milliseconds)"""
+        entries = [
+            f'db;dur={self.db_seconds * 1000:.2f};desc="{self.db_round_trips} round trips"',
+        ]
+        for phase in ("validate", "handler", "serialize"):
+            entries.append(f"{phase};dur={self.phase_seconds(phase) * 1000:.2f}")
+        entries.append(f"total;dur={self.duration * 1000:.2f}")
+        return ", ".join(entries)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "db_round_trips": self.db_round_trips,
+            "db_ms": round(self.db_seconds * 1000, 3),
+            "spans": self.spans,
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(name: str):
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.duration = time.perf_counter() - trace.started
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """Record a span under the current one; a no-op outside a trace"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent_id = _current_span.get()
+    span_id = uuid.uuid4().hex[:16]
+    token = _current_span.set(span_id)
+    start = time.perf_counter()
+    try:
+        yield span_id
+    finally:
+        _current_span.reset(token)
+        trace.add_span(name, kind, start, time.perf_counter() - start, parent_id, span_id, **attributes)
+
+
+def record_db_call(name: str, duration: float, **attributes) -> None:
+    """Record one database round trip that ended just now"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, "db", time.perf_counter() - duration, duration, _current_span.get(), **attributes)
+
+
+class TracedRoute(APIRoute):
+    """APIRoute that splits each request into validate, handler and
+    serialize spans.
+
+    FastAPI validates parameters before calling the endpoint and validates
+    and serializes its result afterwards; the time around the endpoint span
+    is attributed to those two steps.
+    """
+
+    def get_route_handler(self) -> Callable:
+        endpoint = self.dependant.call
+        marks: ContextVar[Optional[Dict[str, float]]] = ContextVar(f"marks_{id(self)}", default=None)
+
+        if asyncio.iscoroutinefunction(endpoint) and not getattr(endpoint, "__traced__", False):
+            @wraps(endpoint)
+            async def traced_endpoint(*args, **kwargs):
+                route_marks = marks.get()
+                if route_marks is not None:
+                    route_marks["handler_start"] = time.perf_counter()
+                try:
+                    with span("handler", endpoint=endpoint.__name__):
+                        return await endpoint(*args, **kwargs)
+                finally:
+                    if route_marks is not None:
+                        route_marks["handler_end"] = time.perf_counter()
+            traced_endpoint.__traced__ = True
+            self.dependant.call = traced_endpoint
+
+        handler = super().get_route_handler()
+        route_path = self.path
+
+        async def traced_handler(request):
+            trace = _current_trace.get()
+            if trace is None:
+                return await handler(request)
+            route_marks = {}
+            token = marks.set(route_marks)
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                end = time.perf_counter()
+                marks.reset(token)
+                parent_id = _current_span.get()
+                handler_start = route_marks.get("handler_start", end)
+                handler_end = route_marks.get("handler_end", end)
+                trace.add_span("validate", "internal", start, handler_start - start, parent_id, route=route_path)
+                trace.add_span("serialize", "internal", handler_end, end - handler_end, parent_id, route=route_path)
+
+        return traced_handler
+
+
+if monitoring is not None:
+    class MongoCommandTracer(monitoring.CommandListener):
+        """Records every MongoDB command as a db span of the current trace"""
+
+        def __init__(self):
+            self._collections: Dict[int, str] = {}
+
+        def started(self, event):
+            if _current_trace.get() is not None:
+                command = event.command.get(event.command_name)
+                self._collections[event.request_id] = command if isinstance(command, str) else ""
+
+        def _finish(self, event, **attributes):
+            collection = self._collections.pop(event.request_id, "")
+            if _current_trace.get() is not None:
+                record_db_call(
+                    f"mongo.{event.command_name}",
+                    event.duration_micros / 1_000_000,
+                    collection=collection,
+                    **attributes,
+                )
+
+        def succeeded(self, event):
+            self._finish(event)
+
+        def failed(self, event):
+            self._finish(event, error=str(event.failure.get("errmsg", event.failure)))
+
+
+else:
+    MongoCommandTracer = None
+
+
+class SQLiteCallTracer:
+    """Records every SQLite storage call as a db span of the current trace.
+    Calls run in a worker thread that inherits the request's context."""
+
+    def call_finished(self, name: str, write: bool, duration: float, statements: int) -> None:
+        record_db_call(f"sqlite.{'write' if write else 'read'}", duration, call=name, statements=statements)
+
+
+def storage_listeners() -> dict:
+    """Keyword arguments for storage.create_storage that enable tracing"""
+    return {
+        "mongo_listeners": [MongoCommandTracer()] if MongoCommandTracer else [],
+        "sqlite_listeners": [SQLiteCallTracer()],
+    }
+
+
+class SpanExporter:
+    """Writes finished traces from a background thread.
+
+    Traces are queued without blocking; when the queue is full (the sink is
+    slower than the request rate) traces are dropped and counted.
+    """
+
+    def __init__(self, path: Optional[str] = TRACE_EXPORT_PATH, collector_url: Optional[str] = TRACE_COLLECTOR_URL,
+                 sample_rate: float = TRACE_SAMPLE_RATE, max_queue: int = 10000, batch_size: int = 200):
+        self.path = path
+        self.collector_url = collector_url
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[dict]]" = queue.Queue(max_queue)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path or self.collector_url)
+
+    def export(self, trace: Trace) -> None:
+        if not self.enabled or random.random() >= self.sample_rate:
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(trace.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self) -> None:
+        session = None
+        if self.collector_url:
+            import requests
+            session = requests.Session()
+        while True:
+            item = self._queue.get()
+            batch = [item] if item is not None else []
+            while item is not None and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    batch.append(item)
+            if batch:
+                self._write(batch, session)
+            if item is None:
+                if session is not None:
+                    session.close()
+                return
+
+    def _write(self, batch: List[dict], session) -> None:
+        try:
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write("".join(json.dumps(trace) + "\n" for trace in batch))
+            if session is not None:
+                session.post(self.collector_url, json={"traces": batch}, timeout=10)
+        except Exception:
+            logger.exception(f"Failed to export {len(batch)} trace(s)")
@@ -1,3 +1,4 @@
+import { useState } from "react";
 import {
   Dialog,
   DialogContent,
@@ -6,36 +7,51 @@ import {
   DialogTitle,
 } from "@/components/ui/dialog";
 import { Button } from "@/components/ui/button";
+import { Label } from "@/components/ui/label";
+import { Textarea } from "@/components/ui/textarea";
 import { Mail, MessageSquare } from "lucide-react";
 import { useToast } from "@/hooks/use-toast";
+import { transmittalApi, ShareChannel } from "@/services/transmittalApi";
 
 interface ShareModalProps {
   open: boolean;
   onOpenChange: (open: boolean) => void;
+  transmittalId?: string;
   transmittalTitle: string;
 }
 
 export function ShareModal({
   open,
   onOpenChange,
+  transmittalId,
   transmittalTitle,
 }: ShareModalProps) {
   const { toast } = useToast();
+  const [recipients, setRecipients] = useState("");
+  const [sharing, setSharing] = useState(false);
 
-  const handleShareViaTeams = () => {
-    toast({
-      title: "Sharing via Teams",
-      description: `"${transmittalTitle}" will be shared via Microsoft Teams.`,
-    });
-    onOpenChange(false);
-  };
-
-  const handleShareViaMail = () => {
-    toast({
-      title: "Sharing via Mail",
-      description: `"${transmittalTitle}" will be shared via email.`,
-    });
-    onOpenChange(false);
+  const share = async (channel: ShareChannel) => {
+    if (!transmittalId) return;
+    const recipientList = recipients.split(/[\s,;]+/).filter(Boolean);
+    setSharing(true);
+    try {
+      // Only queues the messages; delivery happens on the server
+      const { queued } = await transmittalApi.shareTransmittal(transmittalId, channel, recipientList);
+      toast({
+        title: channel === "teams" ? "Sharing via Teams" : "Sharing via Mail",
+        description: `"${transmittalTitle}" is queued for ${queued} ${queued === 1 ? "recipient" : "recipients"}.`,
+      });
+      setRecipients("");
+      onOpenChange(false);
+    } catch (error) {
+      toast({
+        title: "Share failed",
+        description: error instanceof Error ? error.message : "Could not share the transmittal.",
+        variant: "destructive",
+      });
+    } finally {
+      setSharing(false);
+    }
   };
 
   return (
@@ -48,11 +64,23 @@ export function ShareModal({
           </DialogDescription>
         </DialogHeader>
 
+        <div className="space-y-2 pt-4">
+          <Label htmlFor="share-recipients">Recipients</Label>
+          <Textarea
+            id="share-recipients"
+            placeholder="Email addresses, separated by commas or new lines"
+            value={recipients}
+            onChange={(e) => setRecipients(e.target.value)}
+            rows={3}
+          />
+        </div>
+
         <div className="space-y-3 py-4">
           <Button
             variant="outline"
             className="w-full justify-start h-auto py-4"
-            onClick={handleShareViaTeams}
+            onClick={() => share("teams")}
+            disabled={sharing}
           >
             <MessageSquare className="mr-3 h-5 w-5" />
             <div className="text-left">
@@ -66,7 +94,8 @@ export function ShareModal({
           <Button
             variant="outline"
             className="w-full justify-start h-auto py-4"
-            onClick={handleShareViaMail}
+            onClick={() => share("email")}
+            disabled={sharing || !recipients.trim()}
           >
             <Mail className="mr-3 h-5 w-5" />
             <div className="text-left">
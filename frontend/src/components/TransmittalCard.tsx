@@ -21,6 +21,7 @@ interface TransmittalCardProps {
   sentStatus?: string; // For sent tab: "Sent" | "Not Sent"
   receivedStatus?: string; // For received tab: "Received" | "Not Received"
   sendMode?: string; // "Hardcopy" | "Softcopy"
+  receiptThumbnailUrl?: string; // receipt endpoint, thumbnail variant
   onView: () => void;
   onEdit?: () => void;
   onDelete?: () => void;
@@ -60,6 +61,7 @@ export function TransmittalCard({
   sentStatus,
   receivedStatus,
   sendMode,
+  receiptThumbnailUrl,
   onView,
   onEdit,
   onDelete,
@@ -166,6 +168,15 @@ export function TransmittalCard({
           <Calendar className="h-4 w-4" />
           <span>{createdDate}</span>
         </div>
+
+        {receiptThumbnailUrl && (
+          <img
+            src={receiptThumbnailUrl}
+            alt="Receipt"
+            loading="lazy"
+            className="h-20 w-auto rounded border object-cover"
+          />
+        )}
       </CardContent>
       
       <CardFooter className="pt-3 border-t gap-2">
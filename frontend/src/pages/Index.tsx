@@ -7,6 +7,8 @@ import { TransmittalCard } from "@/components/TransmittalCard";
 import { CreateTransmittalModal } from "@/components/CreateTransmittalModal";
 import { ShareModal } from "@/components/ShareModal";
 import { useToast } from "@/hooks/use-toast";
+import { useInfiniteQuery, useQuery } from "@tanstack/react-query";
+import { transmittalApi, TransmittalFilters, TransmittalSummary } from "@/services/transmittalApi";
 import {
   AlertDialog,
   AlertDialogAction,
@@ -19,106 +21,26 @@ import {
 } from "@/components/ui/alert-dialog";
 import logo from "@/assets/hosmac-logo.jpg";
 
-// Mock data - will be replaced with actual database
-const mockTransmittals = [
-  {
-    id: "1",
-    transmittalNumber: "TRN-2024-001",
-    title: "Architectural Drawings - Level 1 & 2",
-    status: "received" as const,
-    recipient: "John Smith",
-    documentCount: 5,
-    createdDate: "2024-10-01",
-    sendMode: "Softcopy",
-    receivedStatus: "Received",
-  },
-  {
-    id: "2",
-    transmittalNumber: "TRN-2024-002",
-    title: "MEP Systems - HVAC & Electrical",
-    status: "sent" as const,
-    recipient: "Sarah Johnson",
-    documentCount: 8,
-    createdDate: "2024-10-05",
-    sendMode: "Hardcopy",
-    sentStatus: "Sent",
-  },
-  {
-    id: "3",
-    transmittalNumber: "TRN-2024-003",
-    title: "Interior Design Package",
-    status: "generated" as const,
-    recipient: "Mike Chen",
-    documentCount: 12,
-    createdDate: "2024-10-07",
-    sendMode: "Softcopy",
-  },
-  {
-    id: "4",
-    title: "Structural Drawings - Draft",
-    status: "draft" as const,
-    documentCount: 3,
-    createdDate: "2024-10-09",
-    sendMode: "Hardcopy",
-  },
-  {
-    id: "5",
-    title: "Site Plan Updates",
-    status: "draft" as const,
-    documentCount: 2,
-    createdDate: "2024-10-09",
-    sendMode: "Softcopy",
-  },
-  // Additional mock data for pagination testing
-  {
-    id: "6",
-    transmittalNumber: "TRN-2024-004",
-    title: "Foundation Details",
-    status: "generated" as const,
-    recipient: "Alex Brown",
-    documentCount: 4,
-    createdDate: "2024-10-08",
-    sendMode: "Hardcopy",
-  },
-  {
-    id: "7",
-    transmittalNumber: "TRN-2024-005",
-    title: "Electrical Layout",
-    status: "sent" as const,
-    recipient: "Lisa Wang",
-    documentCount: 6,
-    createdDate: "2024-10-06",
-    sendMode: "Softcopy",
-    sentStatus: "Not Sent",
-  },
-  {
-    id: "8",
-    title: "Plumbing Drawings - Draft",
-    status: "draft" as const,
-    documentCount: 3,
-    createdDate: "2024-10-08",
-    sendMode: "Hardcopy",
-  },
-  {
-    id: "9",
-    transmittalNumber: "TRN-2024-006",
-    title: "Landscape Plan",
-    status: "received" as const,
-    recipient: "Tom Wilson",
-    documentCount: 2,
-    createdDate: "2024-10-04",
-    sendMode: "Softcopy",
-    receivedStatus: "Not Received",
-  },
-  {
-    id: "10",
-    title: "Fire Safety Plan",
-    status: "draft" as const,
-    documentCount: 5,
-    createdDate: "2024-10-07",
-    sendMode: "Hardcopy",
-  },
-];
+// Cards page through the summary view, which leaves out the documents and
+// the receipt images: the first page, then "Load More" pages
+const FIRST_PAGE = 9;
+const MORE_PAGE = 6;
+
+const toCardProps = (transmittal: TransmittalSummary) => ({
+  id: transmittal.id,
+  transmittalNumber: transmittal.transmittal_number,
+  title: transmittal.title,
+  status: transmittal.status as "draft" | "generated" | "sent" | "received",
+  recipient: transmittal.recipient_name,
+  documentCount: transmittal.document_count,
+  createdDate: transmittal.created_date.slice(0, 10),
+  sendMode: transmittal.send_mode,
+  sentStatus: transmittal.sent_status,
+  receivedStatus: transmittal.received_status,
+  receiptThumbnailUrl: transmittal.has_receipt_thumbnail
+    ? transmittalApi.getReceiptUrl(transmittal.id, "thumbnail")
+    : undefined,
+});
 
 const Index = () => {
   const [searchQuery, setSearchQuery] = useState("");
@@ -129,37 +51,52 @@ const Index = () => {
   const [deleteDialogOpen, setDeleteDialogOpen] = useState(false);
   const [generateDialogOpen, setGenerateDialogOpen] = useState(false);
   const [modalMode, setModalMode] = useState<"create" | "edit" | "view">("create");
-  const [itemsToShow, setItemsToShow] = useState(9);
   const { toast } = useToast();
 
-  // Using mock data - replace with API calls later
-  const [transmittals] = useState(mockTransmittals);
-
-  // Filter transmittals based on search and active tab
-  const filteredTransmittals = transmittals.filter((t) => {
-    const matchesSearch = t.title.toLowerCase().includes(searchQuery.toLowerCase()) ||
-      t.transmittalNumber?.toLowerCase().includes(searchQuery.toLowerCase()) ||
-      t.recipient?.toLowerCase().includes(searchQuery.toLowerCase());
-    
-    const matchesTab = activeTab === "all" || t.status === activeTab;
-    
-    return matchesSearch && matchesTab;
+  // The tab is a server-side status filter, so each tab pages on its own
+  const filters: TransmittalFilters = { status: activeTab };
+  const { data, fetchNextPage, hasNextPage } = useInfiniteQuery({
+    queryKey: ["transmittals", "summary", filters],
+    queryFn: ({ pageParam }) =>
+      transmittalApi.getTransmittalSummaries({
+        ...filters,
+        skip: pageParam,
+        limit: pageParam === 0 ? FIRST_PAGE : MORE_PAGE,
+      }),
+    initialPageParam: 0,
+    getNextPageParam: (lastPage, _pages, lastPageParam) => {
+      const requested = lastPageParam === 0 ? FIRST_PAGE : MORE_PAGE;
+      return lastPage.length < requested ? undefined : lastPageParam + lastPage.length;
+    },
   });
+  const transmittals = (data?.pages.flat() ?? []).map(toCardProps);
 
-  // Calculate status counts
+  // Tab counts come from the status facet rather than from loaded pages
+  const { data: facets } = useQuery({
+    queryKey: ["transmittals", "facets"],
+    queryFn: () => transmittalApi.getTransmittalFacets(),
+  });
+  const countOf = (status: string) =>
+    facets?.facets.status?.find((facet) => facet.value === status)?.count ?? 0;
   const statusCounts = {
-    all: transmittals.length,
-    draft: transmittals.filter(t => t.status === "draft").length,
-    generated: transmittals.filter(t => t.status === "generated").length,
-    sent: transmittals.filter(t => t.status === "sent" && t.sentStatus === "Sent").length,
-    received: transmittals.filter(t => t.status === "received" && t.receivedStatus === "Received").length,
+    all: facets?.total ?? 0,
+    draft: countOf("draft"),
+    generated: countOf("generated"),
+    sent: countOf("sent"),
+    received: countOf("received"),
   };
 
-  const displayedTransmittals = filteredTransmittals.slice(0, itemsToShow);
-  const hasMore = filteredTransmittals.length > itemsToShow;
+  // Search narrows the pages loaded so far; the API has no text search
+  const query = searchQuery.toLowerCase();
+  const displayedTransmittals = transmittals.filter((t) =>
+    t.title.toLowerCase().includes(query) ||
+    t.transmittalNumber?.toLowerCase().includes(query) ||
+    t.recipient?.toLowerCase().includes(query)
+  );
+  const hasMore = !!hasNextPage;
 
   const handleLoadMore = () => {
-    setItemsToShow(prev => prev + 6);
+    fetchNextPage();
   };
 
   const handleCreateTransmittal = () => {
@@ -302,7 +239,7 @@ const Index = () => {
             </TabsList>
 
             <TabsContent value={activeTab} className="mt-6">
-              {filteredTransmittals.length === 0 ? (
+              {displayedTransmittals.length === 0 ? (
                 <div className="text-center py-12">
                   <p className="text-muted-foreground mb-4">
                     {searchQuery
@@ -389,6 +326,7 @@ const Index = () => {
       <ShareModal
         open={shareModalOpen}
         onOpenChange={setShareModalOpen}
+        transmittalId={selectedTransmittal?.id}
         transmittalTitle={selectedTransmittal?.title || ""}
       />
 
@@ -8,6 +8,13 @@ export interface DocumentItem {
   action: string;
 }
 
+export interface DocumentPage {
+  total: number;
+  skip: number;
+  limit: number;
+  documents: DocumentItem[];
+}
+
 export interface TransmittalCreate {
   transmittal_type: string;
   department: string;
@@ -16,6 +23,7 @@ export interface TransmittalCreate {
   send_to: string;
   salutation: string;
   recipient_name: string;
+  recipient_email?: string;
   sender_name: string;
   sender_designation: string;
   send_mode: string;
@@ -32,6 +40,8 @@ export interface Transmittal extends TransmittalCreate {
   status: string;
   document_count: number;
   created_date: string;
+  updated_at?: string;
+  version: number;
   generated_date?: string;
   send_details?: {
     delivery_person?: string;
@@ -39,30 +49,126 @@ export interface Transmittal extends TransmittalCreate {
   };
   receive_details?: {
     receipt_file?: string;
+    receipt_content_type?: string;
     received_date?: string;
     received_time?: string;
+    receipt_status?: 'pending' | 'ready' | 'unsupported' | 'failed';
+    receipt_optimized?: string;
+    receipt_thumbnail?: string;
   };
   sent_status?: string;
   received_status?: string;
+  last_shared_at?: string;
+  last_shared_via?: ShareChannel;
+  ack_due_at?: string;
+  next_reminder_at?: string;
+  last_reminded_at?: string;
+}
+
+export type TransmittalView = 'full' | 'summary';
+
+export type ShareChannel = 'email' | 'teams';
+
+export interface ShareMessage {
+  id: string;
+  channel: ShareChannel;
+  recipient: string;
+  subject: string;
+  state: 'pending' | 'sending' | 'sent' | 'dead';
+  attempts: number;
+  created_at: string;
+  next_attempt_at?: string;
+  sent_at?: string;
+  last_error?: string;
+}
+
+// Summary views omit `documents` and the receipt images; cards load the
+// thumbnail from getReceiptUrl(id, 'thumbnail') when has_receipt_thumbnail
+export type TransmittalSummary = Omit<Transmittal, 'documents'> & {
+  has_receipt_thumbnail: boolean;
+};
+
+export interface TransmittalBatch {
+  transmittals: (Transmittal | TransmittalSummary)[];
+  missing: string[];
 }
 
+export interface TransmittalChanges {
+  changed: Transmittal[];
+  deleted: string[];
+  checkpoint: string;
+  checkpoint_id: string | null;
+  has_more: boolean;
+}
+
+export interface TransmittalFilters {
+  status?: string;
+  department?: string[];
+  transmittal_type?: string[];
+  design_stage?: string[];
+  send_to?: string[];
+  send_mode?: string[];
+  project_name?: string[];
+}
+
+export interface FacetValue {
+  value: string | null;
+  count: number;
+}
+
+export interface TransmittalFacets {
+  total: number;
+  facets: Record<string, FacetValue[]>;
+}
+
+const appendFilters = (queryParams: URLSearchParams, filters?: TransmittalFilters) => {
+  if (filters?.status && filters.status !== 'all') {
+    queryParams.append('status', filters.status);
+  }
+  const multiValueFields = ['department', 'transmittal_type', 'design_stage', 'send_to', 'send_mode', 'project_name'] as const;
+  for (const field of multiValueFields) {
+    filters?.[field]?.forEach((value) => queryParams.append(field, value));
+  }
+};
+
+// Send a mutating request with an Idempotency-Key and retry it with the same
+// key on network errors, so the server applies it at most once
+const fetchIdempotent = async (url: string, init: RequestInit, retries = 2): Promise<Response> => {
+  const headers = new Headers(init.headers);
+  headers.set('Idempotency-Key', crypto.randomUUID());
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const response = await fetch(url, { ...init, headers });
+      if (attempt >= retries || (response.status !== 409 && response.status < 500)) {
+        return response;
+      }
+    } catch (error) {
+      if (attempt >= retries) {
+        throw error;
+      }
+    }
+    await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt));
+  }
+};
+
 export const transmittalApi = {
   // Get all transmittals with pagination and filtering
-  async getTransmittals(params?: {
-    status?: string;
+  async getTransmittals(params?: TransmittalFilters & {
     skip?: number;
     limit?: number;
+    view?: TransmittalView;
   }): Promise<Transmittal[]> {
     const queryParams = new URLSearchParams();
-    if (params?.status && params.status !== 'all') {
-      queryParams.append('status', params.status);
-    }
+    appendFilters(queryParams, params);
     if (params?.skip !== undefined) {
       queryParams.append('skip', params.skip.toString());
     }
     if (params?.limit !== undefined) {
       queryParams.append('limit', params.limit.toString());
     }
+    if (params?.view) {
+      queryParams.append('view', params.view);
+    }
 
     const response = await fetch(`${API_BASE_URL}/api/transmittals?${queryParams}`);
     if (!response.ok) {
@@ -71,12 +177,19 @@ export const transmittalApi = {
     return response.json();
   },
 
+  // One page of the summary view, for cards and lists
+  async getTransmittalSummaries(params?: TransmittalFilters & {
+    skip?: number;
+    limit?: number;
+  }): Promise<TransmittalSummary[]> {
+    const summaries = await transmittalApi.getTransmittals({ ...params, view: 'summary' });
+    return summaries as unknown as TransmittalSummary[];
+  },
+
   // Get transmittals count
-  async getTransmittalsCount(status?: string): Promise<{ count: number }> {
+  async getTransmittalsCount(filters?: string | TransmittalFilters): Promise<{ count: number }> {
     const queryParams = new URLSearchParams();
-    if (status && status !== 'all') {
-      queryParams.append('status', status);
-    }
+    appendFilters(queryParams, typeof filters === 'string' ? { status: filters } : filters);
 
     const response = await fetch(`${API_BASE_URL}/api/transmittals/count?${queryParams}`);
     if (!response.ok) {
@@ -85,6 +198,60 @@ export const transmittalApi = {
     return response.json();
   },
 
+  // Sent transmittals whose acknowledgement is overdue, most overdue first
+  async getOverdueTransmittals(skip: number = 0, limit: number = 100): Promise<TransmittalSummary[]> {
+    const response = await fetch(`${API_BASE_URL}/api/transmittals/overdue?skip=${skip}&limit=${limit}`);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch overdue transmittals: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
+  // Get facet counts for every filterable field
+  async getTransmittalFacets(filters?: TransmittalFilters): Promise<TransmittalFacets> {
+    const queryParams = new URLSearchParams();
+    appendFilters(queryParams, filters);
+
+    const response = await fetch(`${API_BASE_URL}/api/transmittals/facets?${queryParams}`);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch facets: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
+  // Get transmittals changed or deleted since a checkpoint (checkpoint, checkpoint_id)
+  async getChanges(since?: string, sinceId?: string | null, limit?: number): Promise<TransmittalChanges> {
+    const queryParams = new URLSearchParams();
+    if (since) {
+      queryParams.append('since', since);
+    }
+    if (sinceId) {
+      queryParams.append('since_id', sinceId);
+    }
+    if (limit !== undefined) {
+      queryParams.append('limit', limit.toString());
+    }
+
+    const response = await fetch(`${API_BASE_URL}/api/transmittals/changes?${queryParams}`);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch changes: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
+  // Get many transmittals by id in one request
+  async getTransmittalsBatch(ids: string[], view: TransmittalView = 'full'): Promise<TransmittalBatch> {
+    const queryParams = new URLSearchParams();
+    ids.forEach((id) => queryParams.append('ids', id));
+    queryParams.append('view', view);
+
+    const response = await fetch(`${API_BASE_URL}/api/transmittals/batch?${queryParams}`);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch transmittals: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
   // Get single transmittal
   async getTransmittal(id: string): Promise<Transmittal> {
     const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}`);
@@ -96,7 +263,7 @@ export const transmittalApi = {
 
   // Create new transmittal
   async createTransmittal(data: TransmittalCreate): Promise<Transmittal> {
-    const response = await fetch(`${API_BASE_URL}/api/transmittals`, {
+    const response = await fetchIdempotent(`${API_BASE_URL}/api/transmittals`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
@@ -124,6 +291,55 @@ export const transmittalApi = {
     return response.json();
   },
 
+  // Get one page of a transmittal's documents
+  async getTransmittalDocuments(id: string, skip = 0, limit = 50): Promise<DocumentPage> {
+    const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}/documents?skip=${skip}&limit=${limit}`);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch documents: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
+  // Append documents to a draft transmittal
+  async addTransmittalDocuments(id: string, documents: DocumentItem[]): Promise<DocumentItem[]> {
+    const response = await fetchIdempotent(`${API_BASE_URL}/api/transmittals/${id}/documents`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify(documents),
+    });
+    if (!response.ok) {
+      throw new Error(`Failed to add documents: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
+  // Update a single document of a draft transmittal
+  async updateTransmittalDocument(id: string, documentNo: string, data: Partial<DocumentItem>): Promise<DocumentItem> {
+    const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}/documents/${encodeURIComponent(documentNo)}`, {
+      method: 'PATCH',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify(data),
+    });
+    if (!response.ok) {
+      throw new Error(`Failed to update document: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
+  // Remove a single document from a draft transmittal
+  async deleteTransmittalDocument(id: string, documentNo: string): Promise<void> {
+    const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}/documents/${encodeURIComponent(documentNo)}`, {
+      method: 'DELETE',
+    });
+    if (!response.ok) {
+      throw new Error(`Failed to delete document: ${response.statusText}`);
+    }
+  },
+
   // Delete transmittal
   async deleteTransmittal(id: string): Promise<void> {
     const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}`, {
@@ -136,7 +352,7 @@ export const transmittalApi = {
 
   // Generate transmittal
   async generateTransmittal(id: string): Promise<Transmittal> {
-    const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}/generate`, {
+    const response = await fetchIdempotent(`${API_BASE_URL}/api/transmittals/${id}/generate`, {
       method: 'POST',
     });
     if (!response.ok) {
@@ -147,7 +363,7 @@ export const transmittalApi = {
 
   // Duplicate transmittal
   async duplicateTransmittal(id: string, mode: 'opposite' | 'same' = 'opposite'): Promise<Transmittal> {
-    const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}/duplicate?mode=${mode}`, {
+    const response = await fetchIdempotent(`${API_BASE_URL}/api/transmittals/${id}/duplicate?mode=${mode}`, {
       method: 'POST',
     });
     if (!response.ok) {
@@ -158,7 +374,7 @@ export const transmittalApi = {
 
   // Update send status
   async updateSendStatus(id: string, sendDetails: any, sentStatus: string): Promise<void> {
-    const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}/send?sent_status=${sentStatus}`, {
+    const response = await fetchIdempotent(`${API_BASE_URL}/api/transmittals/${id}/send?sent_status=${sentStatus}`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
@@ -170,9 +386,33 @@ export const transmittalApi = {
     }
   },
 
+  // Queue a share; messages are delivered in the background
+  async shareTransmittal(id: string, channel: ShareChannel, recipients: string[], note?: string): Promise<{ queued: number }> {
+    const response = await fetchIdempotent(`${API_BASE_URL}/api/transmittals/${id}/share`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ channel, recipients, note }),
+    });
+    if (!response.ok) {
+      throw new Error(`Failed to share transmittal: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
+  // Delivery state of the messages queued for a transmittal
+  async getTransmittalShares(id: string): Promise<ShareMessage[]> {
+    const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}/shares`);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch shares: ${response.statusText}`);
+    }
+    return response.json();
+  },
+
   // Update receive status
   async updateReceiveStatus(id: string, receiveDetails: any, receivedStatus: string): Promise<void> {
-    const response = await fetch(`${API_BASE_URL}/api/transmittals/${id}/receive?received_status=${receivedStatus}`, {
+    const response = await fetchIdempotent(`${API_BASE_URL}/api/transmittals/${id}/receive?received_status=${receivedStatus}`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
@@ -184,6 +424,12 @@ export const transmittalApi = {
     }
   },
 
+  // URL of a stored receipt; "optimized" falls back to the original until
+  // the server has processed it
+  getReceiptUrl(id: string, variant: 'original' | 'optimized' | 'thumbnail' = 'optimized'): string {
+    return `${API_BASE_URL}/api/transmittals/${id}/receipt?variant=${variant}`;
+  },
+
   // Upload receipt file
   async uploadReceipt(file: File): Promise<{ filename: string; content_type: string; base64_content: string }> {
     const formData = new FormData();
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+
+def controller(**overrides) -> AdmissionController:
+    options = {"max_concurrency": 1, "class_limits": {"export": 1, "batch": 1}, "queue_limit": 10,
+               "queue_timeout_ms": 1000}
+    options.update(overrides)
+    return AdmissionController(**options)
+
+
+def test_freed_slots_go_to_the_highest_class_first():
+    async def main():
+        admission = controller()
+        order = []
+
+        async def request(priority_class, name):
+            await admission.acquire(priority_class)
+            order.append(name)
+            await asyncio.sleep(0)
+            admission.release(priority_class, 0.01)
+
+        await admission.acquire("interactive")
+        waiting = [
+            asyncio.create_task(request("batch", "batch")),
+            asyncio.create_task(request("export", "export")),
+            asyncio.create_task(request("interactive", "interactive-1")),
+            asyncio.create_task(request("interactive", "interactive-2")),
+        ]
+        await asyncio.sleep(0)
+        assert admission.metrics()["queue_depth"] == 4
+        admission.release("interactive", 0.01)
+        await asyncio.gather(*waiting)
+        return order, admission.metrics()
+
+    order, metrics = asyncio.run(main())
+    assert order == ["interactive-1", "interactive-2", "export", "batch"]
+    assert metrics["active"] == 0 and metrics["queue_depth"] == 0
+    assert metrics["classes"]["interactive"]["queued"] == 2
+
+
+def test_class_limit_keeps_exports_from_taking_every_slot():
+    async def main():
+        admission = controller(max_concurrency=4, class_limits={"export": 2})
+        await admission.acquire("export")
+        await admission.acquire("export")
+        third = asyncio.create_task(admission.acquire("export"))
+        await asyncio.sleep(0)
+        assert not third.done()
+        # Interactive requests still start at once
+        await asyncio.wait_for(admission.acquire("interactive"), 0.1)
+        admission.release("export", 0.01)
+        await asyncio.wait_for(third, 0.1)
+        return admission.metrics()
+
+    metrics = asyncio.run(main())
+    assert metrics["active"] == 3
+    assert metrics["classes"]["export"]["active"] == 2
+
+
+def test_full_queue_sheds_lower_classes_then_rejects():
+    async def main():
+        admission = controller(queue_limit=1)
+        await admission.acquire("interactive")
+        batch = asyncio.create_task(admission.acquire("batch"))
+        await asyncio.sleep(0)
+
+        # An interactive request makes room by shedding the batch waiter
+        interactive = asyncio.create_task(admission.acquire("interactive"))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as shed:
+            await batch
+        assert shed.value.status_code == 503
+
+        # Nothing of lower priority left to shed
+        with pytest.raises(Overloaded) as rejected:
+            await admission.acquire("interactive")
+        assert rejected.value.status_code == 429
+        assert rejected.value.retry_after >= 1
+
+        admission.release("interactive", 0.01)
+        await interactive
+        return admission.metrics()
+
+    metrics = asyncio.run(main())
+    assert metrics["classes"]["batch"]["evicted"] == 1
+    assert metrics["classes"]["interactive"]["rejected"] == 1
+    assert metrics["classes"]["interactive"]["rejection_rate"] == pytest.approx(1 / 3, abs=1e-4)
+
+
+def test_wait_timeout_and_cancelled_waiters_give_up_their_place():
+    async def main():
+        admission = controller(queue_timeout_ms=20)
+        await admission.acquire("interactive")
+        with pytest.raises(Overloaded) as timed_out:
+            await admission.acquire("interactive")
+        assert timed_out.value.status_code == 503
+
+        cancelled = asyncio.create_task(admission.acquire("interactive"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert admission.queued == 0
+
+        admission.release("interactive", 0.01)
+        await admission.acquire("interactive")
+        return admission.metrics()
+
+    metrics = asyncio.run(main())
+    assert metrics["active"] == 1
+    assert metrics["classes"]["interactive"]["timed_out"] == 1
@@ -0,0 +1,319 @@
+import asyncio
+import base64
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import Response
+from fastapi.testclient import TestClient
+
+TRANSMITTAL = {
+    "transmittal_type": "Drawing",
+    "department": "Architecture",
+    "design_stage": "Schematic Design",
+    "transmittal_date": "2024-01-15",
+    "send_to": "Client",
+    "salutation": "Mr",
+    "recipient_name": "John Anderson",
+    "sender_name": "Sarah Wilson",
+    "sender_designation": "Project Architect",
+    "send_mode": "Softcopy",
+    "title": "Ground floor plans",
+    "project_name": "Greenfield",
+    "documents": [
+        {"document_no": f"A-{i:03d}", "title": f"Sheet {i}", "revision": 1, "copies": 1, "action": "for approval"}
+        for i in range(3)
+    ],
+}
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("STORAGE_BACKEND", "sqlite")
+        monkeypatch.setenv("SQLITE_PATH", str(tmp_path_factory.mktemp("api") / "api.db"))
+        monkeypatch.setenv("OUTBOX_TRANSPORT", "local")
+        import server
+        with TestClient(server.app) as client:
+            yield client
+
+
+def create(client, **overrides) -> dict:
+    response = client.post("/api/transmittals", json={**TRANSMITTAL, **overrides})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_duplicate_document_numbers_are_rejected(client):
+    duplicated = TRANSMITTAL["documents"] + TRANSMITTAL["documents"][:1]
+    assert client.post("/api/transmittals", json={**TRANSMITTAL, "documents": duplicated}).status_code == 422
+
+    transmittal = create(client)
+    response = client.put(f"/api/transmittals/{transmittal['id']}", json={"documents": duplicated})
+    assert response.status_code == 422
+
+
+def test_documents_sub_resource(client):
+    transmittal = create(client)
+    url = f"/api/transmittals/{transmittal['id']}/documents"
+
+    page = client.get(url, params={"skip": 1, "limit": 1}).json()
+    assert page["total"] == 3
+    assert [d["document_no"] for d in page["documents"]] == ["A-001"]
+
+    added = {"document_no": "A-100", "title": "Section", "revision": 1, "copies": 2, "action": "for review"}
+    assert client.post(url, json=[added]).status_code == 200
+    assert client.post(url, json=[added]).status_code == 409
+    assert client.post(url, json=[{**added, "document_no": "A-101"}] * 2).status_code == 400
+
+    patched = client.patch(f"{url}/A-100", json={"revision": 2})
+    assert patched.status_code == 200
+    assert patched.json()["revision"] == 2
+    assert client.patch(f"{url}/A-999", json={"revision": 2}).status_code == 404
+
+    assert client.delete(f"{url}/A-000").status_code == 200
+    assert client.delete(f"{url}/A-000").status_code == 404
+
+    current = client.get(f"/api/transmittals/{transmittal['id']}").json()
+    assert current["document_count"] == 3
+    assert [d["document_no"] for d in current["documents"]] == ["A-001", "A-002", "A-100"]
+    assert current["version"] == 4
+
+
+def test_reminded_transmittals_stay_overdue_from_their_due_date(client):
+    import server
+
+    now = datetime.utcnow().replace(microsecond=0)
+    due = now - timedelta(days=4)
+    row = server.Transmittal(**TRANSMITTAL, document_count=3).dict()
+    row.update(
+        id="overdue-1", transmittal_date="2024-01-15", status="sent", sent_status="Sent",
+        recipient_email="john@example.com", ack_due_at=due, next_reminder_at=due,
+    )
+    client.portal.call(server.storage.transmittals.insert, row)
+
+    reminded = client.post("/api/transmittals/overdue/remind").json()["reminded"]
+    assert reminded >= 1
+    assert client.post("/api/transmittals/overdue/remind").json()["reminded"] == 0
+
+    overdue = {t["id"]: t for t in client.get("/api/transmittals/overdue").json()}
+    assert datetime.fromisoformat(overdue["overdue-1"]["ack_due_at"]) == due
+    assert overdue["overdue-1"]["last_reminded_at"] is not None
+    assert datetime.fromisoformat(overdue["overdue-1"]["next_reminder_at"]) > now
+
+
+def test_receipt_optimization_survives_intervening_writes(client):
+    import server
+
+    receipt = base64.b64encode(b"not an image").decode()
+    received = create(client)
+    url = f"/api/transmittals/{received['id']}"
+    client.portal.call(
+        server.storage.transmittals.update, received["id"],
+        {"receive_details": {"receipt_file": receipt, "receipt_status": "pending", "receipt_id": "r-1"}},
+    )
+    # An unrelated edit lands before the job runs
+    assert client.put(url, json={"title": "Edited meanwhile"}).status_code == 200
+    client.portal.call(server.optimize_receipt, received["id"], "r-1")
+    assert client.get(url).json()["receive_details"]["receipt_status"] == "unsupported"
+
+    # A job for a receipt that has since been replaced leaves the new one alone
+    client.portal.call(
+        server.storage.transmittals.update, received["id"],
+        {"receive_details": {"receipt_file": receipt, "receipt_status": "pending", "receipt_id": "r-2"}},
+    )
+    client.portal.call(server.optimize_receipt, received["id"], "r-1")
+    assert client.get(url).json()["receive_details"]["receipt_status"] == "pending"
+
+    # Left pending, e.g. by a restart, it is picked up by the sweep
+    assert client.portal.call(server.receipt_sweeper.sweep_once) >= 1
+    assert client.get(url).json()["receive_details"]["receipt_status"] == "unsupported"
+
+
+def test_summary_flags_the_receipt_thumbnail_instead_of_embedding_it(client):
+    import server
+
+    received = create(client)
+    thumbnail = base64.b64encode(b"\xff\xd8\xff thumbnail").decode()
+    client.portal.call(
+        server.storage.transmittals.update, received["id"],
+        {"receive_details": {
+            "receipt_file": thumbnail, "receipt_status": "ready", "receipt_id": "r-1", "receipt_thumbnail": thumbnail,
+        }},
+    )
+
+    summary = client.get(f"/api/transmittals/{received['id']}", params={"view": "summary"}).json()
+    assert summary["has_receipt_thumbnail"] is True
+    assert summary["receive_details"]["receipt_thumbnail"] is None
+    response = client.get(f"/api/transmittals/{received['id']}/receipt", params={"variant": "thumbnail"})
+    assert response.status_code == 200
+    assert response.content == base64.b64decode(thumbnail)
+
+    without = create(client)
+    summary = client.get(f"/api/transmittals/{without['id']}", params={"view": "summary"}).json()
+    assert summary["has_receipt_thumbnail"] is False
+
+
+def test_idempotency_key_replays_and_rejects_a_different_body(client):
+    headers = {"Idempotency-Key": "create-1"}
+    first = client.post("/api/transmittals", json=TRANSMITTAL, headers=headers)
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+
+    replay = client.post("/api/transmittals", json=TRANSMITTAL, headers=headers)
+    assert replay.status_code == 200
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.json()["id"] == first.json()["id"]
+    assert replay.headers["ETag"] == first.headers["ETag"]
+
+    reused = client.post("/api/transmittals", json={**TRANSMITTAL, "title": "Other"}, headers=headers)
+    assert reused.status_code == 422
+
+
+def test_etag_preconditions(client):
+    transmittal = create(client)
+    url = f"/api/transmittals/{transmittal['id']}"
+    etag = client.get(url).headers["ETag"]
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    updated = client.put(url, json={"title": "Renamed"}, headers={"If-Match": etag})
+    assert updated.status_code == 200
+    assert updated.headers["ETag"] != etag
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+    stale = client.put(url, json={"title": "Lost update"}, headers={"If-Match": etag})
+    assert stale.status_code == 412
+    assert client.get(url).json()["title"] == "Renamed"
+
+
+def test_changes_page_through_rows_sharing_a_timestamp(client):
+    import server
+
+    stamped = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    ids = [f"changes-{n}" for n in range(5)]
+    for transmittal_id in ids:
+        row = server.Transmittal(**TRANSMITTAL, document_count=3).dict()
+        row.update(id=transmittal_id, transmittal_date="2024-01-15", created_date=stamped, updated_at=stamped)
+        client.portal.call(server.storage.transmittals.insert, row)
+    # Written just now, so held back until it has settled
+    recent = create(client)
+
+    seen, params = [], {"limit": 2}
+    while True:
+        page = client.get("/api/transmittals/changes", params=params).json()
+        # Other tests' rows are written just now, so only these have settled
+        seen += [t["id"] for t in page["changed"] if t["id"].startswith("changes-")]
+        params = {"limit": 2, "since": page["checkpoint"], "since_id": page["checkpoint_id"]}
+        if not page["has_more"]:
+            break
+    assert seen == ids
+    assert recent["id"] not in seen
+
+    caught_up = client.get("/api/transmittals/changes", params=params).json()
+    assert caught_up["changed"] == [] and not caught_up["has_more"]
+    assert caught_up["checkpoint_id"] == ids[-1]
+
+
+def test_batch_get_reports_missing_ids(client):
+    transmittal = create(client)
+    response = client.get(
+        "/api/transmittals/batch", params={"ids": [transmittal["id"], "nope", transmittal["id"]], "view": "summary"}
+    )
+    assert response.status_code == 200
+    batch = response.json()
+    assert [t["id"] for t in batch["transmittals"]] == [transmittal["id"]]
+    assert "documents" not in batch["transmittals"][0]
+    assert batch["missing"] == ["nope"]
+
+
+def test_status_cursor_pages_round_trip(client):
+    posted = [client.post("/api/status", json={"client_name": "probe-paging"}).json()["id"] for _ in range(5)]
+
+    seen, params = [], {"client_name": "probe-paging", "limit": 2}
+    while True:
+        response = client.get("/api/status", params=params)
+        assert response.status_code == 200
+        seen += [check["id"] for check in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert seen == posted[::-1]
+
+    assert client.get("/api/status", params={"cursor": "not-a-cursor"}).status_code == 400
+
+
+@pytest.mark.parametrize("accept_encoding", ["identity", "gzip"])
+def test_status_streams_ndjson(client, accept_encoding):
+    client_name = f"probe-stream-{accept_encoding}"
+    posted = [client.post("/api/status", json={"client_name": client_name}).json()["id"] for _ in range(3)]
+
+    response = client.get(
+        "/api/status", params={"client_name": client_name, "format": "ndjson"},
+        headers={"Accept-Encoding": accept_encoding},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert response.headers.get("content-encoding") == (None if accept_encoding == "identity" else "gzip")
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == posted[::-1]
+
+
+def test_cancelled_request_releases_its_idempotency_key(client):
+    import server
+
+    async def cancel_mid_request():
+        started = asyncio.Event()
+
+        async def operation():
+            started.set()
+            await asyncio.sleep(3600)
+
+        request = asyncio.create_task(
+            server.run_idempotent("cancel-1", "POST /transmittals", TRANSMITTAL, Response(), operation)
+        )
+        await started.wait()
+        assert (await server.storage.idempotency_keys.get("cancel-1"))["state"] == "pending"
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+        return await server.storage.idempotency_keys.get("cancel-1")
+
+    assert client.portal.call(cancel_mid_request) is None
+    assert client.post("/api/transmittals", json=TRANSMITTAL, headers={"Idempotency-Key": "cancel-1"}).status_code == 200
+
+
+def test_generate_is_pinned_to_the_version_it_checked(client, monkeypatch):
+    import server
+
+    stale = create(client)
+    url = f"/api/transmittals/{stale['id']}"
+    etag = client.get(url).headers["ETag"]
+    assert client.put(url, json={"title": "Renamed"}).status_code == 200
+    assert client.post(f"{url}/generate", headers={"If-Match": etag}).status_code == 412
+
+    # A write lands between the status check and the update
+    raced = create(client)
+    count_issued = server.storage.transmittals.count_issued
+
+    async def count_issued_after_a_write():
+        await server.storage.transmittals.update(raced["id"], {"title": "Renamed meanwhile"})
+        return await count_issued()
+
+    monkeypatch.setattr(server.storage.transmittals, "count_issued", count_issued_after_a_write)
+    assert client.post(f"/api/transmittals/{raced['id']}/generate").status_code == 409
+    monkeypatch.undo()
+    assert client.get(f"/api/transmittals/{raced['id']}").json()["status"] == "draft"
+
+    fresh = client.get(url)
+    generated = client.post(f"{url}/generate", headers={"If-Match": fresh.headers["ETag"]})
+    assert generated.status_code == 200
+    assert generated.json()["status"] == "generated"
+    assert client.post("/api/transmittals/missing/generate").status_code == 404
+
+
+def test_server_timing_is_off_unless_enabled(client, monkeypatch):
+    import server
+
+    assert "Server-Timing" not in client.get("/api/transmittals").headers
+    monkeypatch.setattr(server, "TRACE_SERVER_TIMING", True)
+    assert "db;dur=" in client.get("/api/transmittals").headers["Server-Timing"]
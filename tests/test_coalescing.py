@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from coalescing import QueryCoalescer, filters_key
+from storage.sqlite import SQLiteStorage
+from .test_storage_conformance import make_transmittal
+
+
+class CountingQuery:
+
+    def __init__(self, result="page", delay=0.01):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def test_concurrent_identical_queries_share_one_call():
+    async def main():
+        coalescer = QueryCoalescer(ttl_ms=0)
+        query, other = CountingQuery("a"), CountingQuery("b")
+        results = await asyncio.gather(
+            *[coalescer.run(("list", 0), query) for _ in range(10)],
+            coalescer.run(("list", 9), other),
+        )
+        assert results == ["a"] * 10 + ["b"]
+        assert (query.calls, other.calls) == (1, 1)
+        metrics = coalescer.metrics()
+        assert (metrics["calls"], metrics["executed"], metrics["joined"]) == (11, 2, 9)
+        assert metrics["coalescing_ratio"] == round(9 / 11, 4)
+
+        # Nothing in flight and no TTL window: the next call runs again
+        await coalescer.run(("list", 0), query)
+        assert query.calls == 2
+    asyncio.run(main())
+
+
+def test_results_are_reused_until_the_ttl_or_a_write():
+    async def main():
+        coalescer = QueryCoalescer(ttl_ms=50)
+        query = CountingQuery()
+        await coalescer.run("count", query)
+        await coalescer.run("count", query)
+        assert query.calls == 1
+        assert coalescer.stats["cached"] == 1
+
+        coalescer.invalidate()
+        await coalescer.run("count", query)
+        assert query.calls == 2
+
+        await asyncio.sleep(0.06)
+        await coalescer.run("count", query)
+        assert query.calls == 3
+    asyncio.run(main())
+
+
+def test_a_write_during_a_query_is_not_hidden_from_later_callers():
+    async def main():
+        coalescer = QueryCoalescer(ttl_ms=1000)
+        query = CountingQuery(delay=0.05)
+        first = asyncio.ensure_future(coalescer.run("count", query))
+        await asyncio.sleep(0.01)
+        coalescer.invalidate()
+        # Started after the write, so it must not join the earlier call
+        await coalescer.run("count", query)
+        await first
+        assert query.calls == 2
+        # The earlier call's result was not cached for the new generation
+        await coalescer.run("count", query)
+        assert query.calls == 2
+    asyncio.run(main())
+
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    async def main():
+        coalescer = QueryCoalescer(ttl_ms=1000)
+        query = CountingQuery(RuntimeError("down"))
+        results = await asyncio.gather(*[coalescer.run("count", query) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        with pytest.raises(RuntimeError):
+            await coalescer.run("count", query)
+        assert query.calls == 2
+    asyncio.run(main())
+
+
+def test_a_cancelled_caller_does_not_cancel_the_shared_query():
+    async def main():
+        coalescer = QueryCoalescer(ttl_ms=0)
+        query = CountingQuery(delay=0.02)
+        leader = asyncio.ensure_future(coalescer.run("count", query))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(coalescer.run("count", query))
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await follower == "page"
+        assert query.calls == 1
+    asyncio.run(main())
+
+
+def test_filters_key_ignores_value_order_and_empty_fields():
+    assert filters_key({"department": ["B", "A"], "status": None}) == filters_key({"department": ["A", "B"]})
+
+
+def test_storage_writes_start_a_new_generation(tmp_path):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / "coalescing.db"))
+        await storage.initialize()
+        coalescer = QueryCoalescer(ttl_ms=10000)
+        storage.audit.add_listener(coalescer.invalidate)
+        try:
+            count = lambda: coalescer.run("count", lambda: storage.transmittals.count({}))
+            assert await count() == 0
+            await storage.transmittals.insert(make_transmittal(1))
+            assert await count() == 1
+            await storage.transmittals.delete("t-1", make_transmittal(1)["updated_at"])
+            assert await count() == 0
+        finally:
+            await storage.close()
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import time
+
+from lifecycle import DrainMiddleware, Lifecycle
+
+
+def test_drain_file_only_drains_workers_started_before_it(tmp_path):
+    drain_file = tmp_path / "drain"
+    old_worker = Lifecycle(str(drain_file))
+    old_worker.started_at = time.time() - 60
+    old_worker.mark_ready()
+    assert old_worker.ready
+    assert old_worker.status()["status"] == "ready"
+
+    drain_file.touch()
+    new_worker = Lifecycle(str(drain_file))
+    new_worker.started_at = time.time() + 60
+    new_worker.mark_ready()
+    old_worker._drain_checked = 0.0
+    assert old_worker.draining and not old_worker.ready
+    assert old_worker.status()["status"] == "draining"
+    assert new_worker.ready
+
+    os.remove(drain_file)
+    old_worker._drain_checked = 0.0
+    assert old_worker.ready
+
+
+def test_not_ready_until_startup_finishes():
+    lifecycle = Lifecycle(None)
+    assert not lifecycle.ready
+    assert lifecycle.status()["status"] == "starting"
+    lifecycle.mark_ready()
+    assert lifecycle.ready
+
+
+def test_middleware_counts_requests_and_closes_connections_while_draining():
+    lifecycle = Lifecycle(None)
+    lifecycle.mark_ready()
+    release = asyncio.Event()
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(lifecycle.in_flight)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await release.wait()
+        await send({"type": "http.response.body", "body": b""})
+
+    middleware = DrainMiddleware(app, lifecycle)
+
+    async def main():
+        starts = []
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                starts.append(message)
+
+        request = asyncio.create_task(middleware({"type": "http"}, None, send))
+        await asyncio.sleep(0)
+        assert lifecycle.in_flight == 1
+        # The response has started but its body is still being sent
+        assert not await lifecycle.drain(timeout=0.1)
+        release.set()
+        assert await lifecycle.drain(timeout=1)
+        await request
+
+        await middleware({"type": "http"}, None, send)
+        return starts
+
+    starts = asyncio.run(main())
+    assert seen == [1, 1]
+    assert (b"connection", b"close") not in starts[0]["headers"]
+    assert (b"connection", b"close") in starts[1]["headers"]
+    assert lifecycle.in_flight == 0
+    assert not lifecycle.ready
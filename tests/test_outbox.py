@@ -0,0 +1,128 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from outbox import LocalTransport, OutboxDispatcher, SMTPTransport, TeamsWebhookTransport, compose_share_messages
+from storage.sqlite import SQLiteStorage
+
+TRANSMITTAL = {
+    "id": "t-1",
+    "transmittal_number": "ARC-0001",
+    "title": "Ground floor plans",
+    "salutation": "Ms",
+    "recipient_name": "Jane Doe",
+    "sender_name": "Sarah Wilson",
+    "sender_designation": "Project Architect",
+    "project_name": "Greenfield",
+    "document_count": 4,
+    "status": "generated",
+    "version": 1,
+    "created_date": datetime(2024, 1, 15),
+    "updated_at": datetime(2024, 1, 15),
+    "documents": [],
+}
+
+
+def run_with_outbox(tmp_path, scenario):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / "outbox.db"))
+        await storage.initialize()
+        try:
+            await storage.transmittals.insert(dict(TRANSMITTAL))
+            await scenario(storage)
+        finally:
+            await storage.close()
+    asyncio.run(main())
+
+
+def test_compose_share_messages():
+    now = datetime.utcnow()
+    messages = compose_share_messages(TRANSMITTAL, "email", ["a@example.com", "b@example.com"], "See rev B", now)
+    assert [m["recipient"] for m in messages] == ["a@example.com", "b@example.com"]
+    assert messages[0]["subject"] == "Transmittal ARC-0001: Ground floor plans"
+    assert "See rev B" in messages[0]["body"]
+    assert messages[0]["state"] == "pending"
+    assert messages[0]["next_attempt_at"] == now
+    assert messages[0]["id"] != messages[1]["id"]
+
+
+def test_dispatcher_delivers_in_batches(tmp_path):
+    async def scenario(storage):
+        recipients = [f"r{n}@example.com" for n in range(250)]
+        messages = compose_share_messages(TRANSMITTAL, "email", recipients, None, datetime.utcnow())
+        await storage.outbox.enqueue("t-1", {"status": "sent"}, messages, expected_version=1)
+
+        transport = LocalTransport()
+        dispatcher = OutboxDispatcher(storage.outbox, {"email": transport}, batch_size=100, rate_per_second=10000)
+        assert [await dispatcher.dispatch_once() for _ in range(4)] == [100, 100, 50, 0]
+
+        assert sorted(m["recipient"] for m in transport.sent) == sorted(recipients)
+        assert dispatcher.stats == {"sent": 250, "retried": 0, "dead": 0}
+        assert {m["state"] for m in await storage.outbox.list("t-1")} == {"sent"}
+    run_with_outbox(tmp_path, scenario)
+
+
+def test_dispatcher_retries_then_gives_up(tmp_path):
+    async def scenario(storage):
+        messages = compose_share_messages(
+            TRANSMITTAL, "email", ["flaky@example.com", "gone@example.com"], None, datetime.utcnow()
+        )
+        await storage.outbox.enqueue("t-1", {}, messages)
+
+        transport = LocalTransport()
+        transport.failing = {"flaky@example.com": False, "gone@example.com": True}
+        dispatcher = OutboxDispatcher(storage.outbox, {"email": transport}, max_attempts=2)
+
+        assert await dispatcher.dispatch_once() == 2
+        states = {m["recipient"]: m for m in await storage.outbox.list("t-1")}
+        assert states["gone@example.com"]["state"] == "dead"
+        assert states["flaky@example.com"]["state"] == "pending"
+        assert states["flaky@example.com"]["next_attempt_at"] > datetime.utcnow() + timedelta(seconds=20)
+
+        # Not due yet
+        assert await dispatcher.dispatch_once() == 0
+
+        await storage.outbox.mark_failed(states["flaky@example.com"]["id"], "retry now", datetime.utcnow())
+        assert await dispatcher.dispatch_once() == 1
+        states = {m["recipient"]: m for m in await storage.outbox.list("t-1")}
+        assert states["flaky@example.com"]["state"] == "dead"
+        assert dispatcher.stats == {"sent": 0, "retried": 1, "dead": 2}
+    run_with_outbox(tmp_path, scenario)
+
+
+def test_unknown_channel_is_not_retried(tmp_path):
+    async def scenario(storage):
+        messages = compose_share_messages(TRANSMITTAL, "teams", ["https://example.com/hook"], None, datetime.utcnow())
+        await storage.outbox.enqueue("t-1", {}, messages)
+        dispatcher = OutboxDispatcher(storage.outbox, {"email": LocalTransport()})
+        assert await dispatcher.dispatch_once() == 1
+        assert (await storage.outbox.list("t-1"))[0]["state"] == "dead"
+    run_with_outbox(tmp_path, scenario)
+
+
+def test_smtp_failures_stay_with_their_message():
+    class FakeSMTP:
+        sent = []
+
+        def send_message(self, email):
+            if email["To"] == "flaky@example.com":
+                raise RuntimeError("connection hiccup")
+            self.sent.append(email["To"])
+
+    transport = SMTPTransport("localhost", 25, "noreply@example.com")
+    transport._connection = FakeSMTP
+    recipients = ["a@example.com", "bad\nBcc: x@example.com", "flaky@example.com", "b@example.com"]
+    messages = compose_share_messages(TRANSMITTAL, "email", recipients, None, datetime.utcnow())
+    results = asyncio.run(transport.send_batch(messages))
+
+    assert FakeSMTP.sent == ["a@example.com", "b@example.com"]
+    errors = [results[m["id"]] for m in messages]
+    assert errors[0] is None and errors[3] is None
+    assert errors[1].permanent
+    assert not errors[2].permanent
+
+
+def test_teams_refuses_urls_outside_the_allowlist():
+    transport = TeamsWebhookTransport(allowed=frozenset())
+    messages = compose_share_messages(TRANSMITTAL, "teams", ["http://169.254.169.254/latest"], None, datetime.utcnow())
+    results = asyncio.run(transport.send_batch(messages))
+    assert results[messages[0]["id"]].permanent
@@ -0,0 +1,40 @@
+import base64
+import io
+
+import pytest
+
+from receipts import UnsupportedReceipt, decode_receipt, process_receipt, sniff_content_type
+
+
+def test_decode_receipt_accepts_data_urls():
+    assert decode_receipt(base64.b64encode(b"%PDF-1.7").decode()) == b"%PDF-1.7"
+    assert decode_receipt("data:application/pdf;base64," + base64.b64encode(b"%PDF-1.7").decode()) == b"%PDF-1.7"
+
+
+def test_sniff_content_type():
+    assert sniff_content_type(b"%PDF-1.7\n") == "application/pdf"
+    assert sniff_content_type(b"\xff\xd8\xff\xe0rest") == "image/jpeg"
+    assert sniff_content_type(b"\x89PNG\r\n\x1a\nrest") == "image/png"
+    assert sniff_content_type(b"plain text") is None
+
+
+def test_unknown_types_are_unsupported():
+    with pytest.raises(UnsupportedReceipt):
+        process_receipt(b"plain text", "text/plain")
+
+
+def test_images_are_bounded_and_thumbnailed(monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    import receipts
+    monkeypatch.setattr(receipts, "RECEIPT_MAX_DIMENSION", 400)
+    monkeypatch.setattr(receipts, "RECEIPT_THUMBNAIL_SIZE", 100)
+
+    buffer = io.BytesIO()
+    Image.effect_noise((1200, 800), 64).convert("RGBA").save(buffer, "PNG")
+    result = process_receipt(buffer.getvalue(), "image/png")
+
+    optimized = Image.open(io.BytesIO(result["optimized"]))
+    assert optimized.format == "JPEG"
+    assert optimized.size == (400, 267)
+    thumbnail = Image.open(io.BytesIO(result["thumbnail"]))
+    assert max(thumbnail.size) == 100
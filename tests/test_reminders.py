@@ -0,0 +1,137 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import reminders
+from reminders import AcknowledgementScanner, compose_reminders
+from storage import ACK_DUE_DAYS
+from storage.sqlite import SQLiteStorage
+
+NOW = datetime(2024, 3, 1, 9, 0)
+
+
+def sent_transmittal(n: int, days_overdue: int, **overrides) -> dict:
+    transmittal = {
+        "id": f"t-{n}",
+        "transmittal_number": f"ARC-{n:04d}",
+        "title": f"Transmittal {n}",
+        "salutation": "Mr",
+        "recipient_name": "John Anderson",
+        "recipient_email": "john@example.com",
+        "status": "sent",
+        "sent_status": "Sent",
+        "version": 1,
+        "created_date": NOW - timedelta(days=30),
+        "updated_at": NOW - timedelta(days=30),
+        "ack_due_at": NOW - timedelta(days=days_overdue),
+        "next_reminder_at": NOW - timedelta(days=days_overdue),
+        "documents": [],
+    }
+    transmittal.update(overrides)
+    return transmittal
+
+
+def test_compose_reminders_groups_per_recipient(monkeypatch):
+    monkeypatch.setattr(reminders, "ACK_REMINDER_FALLBACK", None)
+    messages = compose_reminders([
+        sent_transmittal(1, 2),
+        sent_transmittal(2, 9),
+        sent_transmittal(3, 4, recipient_email="jane@example.com"),
+        sent_transmittal(4, 4, recipient_email=None),
+    ], NOW)
+
+    by_recipient = {m["recipient"]: m for m in messages}
+    assert set(by_recipient) == {"john@example.com", "jane@example.com"}
+    john = by_recipient["john@example.com"]
+    assert john["transmittal_ids"] == ["t-2", "t-1"]
+    assert john["transmittal_id"] == "t-2"
+    assert "ARC-0002: Transmittal 2 (due 2024-02-21, 9 day(s) overdue)" in john["body"]
+    assert john["subject"] == "Acknowledgement overdue for 2 transmittal(s)"
+
+
+def test_scanner_reminds_once_per_interval(tmp_path, monkeypatch):
+    monkeypatch.setattr(reminders, "ACK_REMINDER_FALLBACK", "doc-control@example.com")
+
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / "reminders.db"))
+        await storage.initialize()
+        try:
+            await storage.transmittals.insert(sent_transmittal(1, 2))
+            await storage.transmittals.insert(sent_transmittal(2, 1, recipient_email=None))
+            await storage.transmittals.insert(sent_transmittal(3, -1))
+
+            woken = []
+            scanner = AcknowledgementScanner(storage, on_queued=lambda: woken.append(True))
+            assert await scanner.scan_once(NOW) == 2
+            assert woken == [True]
+            queued = await storage.outbox.claim(NOW, 10, 60)
+            assert sorted(m["recipient"] for m in queued) == ["doc-control@example.com", "john@example.com"]
+
+            # Reminded transmittals are not chased again until the interval passes
+            assert await scanner.scan_once(NOW + timedelta(hours=1)) == 0
+            # but stay overdue from the date acknowledgement was due
+            overdue = await storage.transmittals.overdue(NOW + timedelta(hours=1), 0, 10)
+            assert [(t["id"], t["ack_due_at"]) for t in overdue] == [
+                ("t-1", NOW - timedelta(days=2)), ("t-2", NOW - timedelta(days=1)),
+            ]
+
+            later = NOW + timedelta(days=reminders.ACK_REMINDER_INTERVAL_DAYS)
+            assert await scanner.scan_once(later) == 3
+            bodies = [m["body"] for m in await storage.outbox.claim(later, 10, 60) if m["recipient"] == "john@example.com"]
+            assert any("ARC-0001: Transmittal 1 (due 2024-02-28, 5 day(s) overdue)" in body for body in bodies)
+        finally:
+            await storage.close()
+    asyncio.run(main())
+
+
+def test_scanner_without_fallback_reads_only_addressed_transmittals(tmp_path, monkeypatch):
+    monkeypatch.setattr(reminders, "ACK_REMINDER_FALLBACK", None)
+
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / "reminders.db"))
+        await storage.initialize()
+        try:
+            await storage.transmittals.insert(sent_transmittal(1, 2))
+            await storage.transmittals.insert(sent_transmittal(2, 1, recipient_email=None))
+
+            read = []
+            reminders_due = storage.transmittals.reminders_due
+
+            async def counting_reminders_due(*args):
+                page = await reminders_due(*args)
+                read.extend(t["id"] for t in page)
+                return page
+            storage.transmittals.reminders_due = counting_reminders_due
+
+            assert await AcknowledgementScanner(storage).scan_once(NOW) == 1
+            assert read == ["t-1"]
+        finally:
+            await storage.close()
+    asyncio.run(main())
+
+
+def test_backfill_gives_a_due_date_only_to_sent_transmittals(tmp_path):
+    path = str(tmp_path / "reminders.db")
+
+    async def main():
+        storage = SQLiteStorage(path)
+        await storage.initialize()
+        # Written before acknowledgement tracking, so without ack_due_at
+        for transmittal in (sent_transmittal(1, 0), sent_transmittal(2, 0, sent_status="Not Sent")):
+            del transmittal["ack_due_at"]
+            del transmittal["next_reminder_at"]
+            await storage.transmittals.insert(transmittal)
+        # Left behind by a backfill that did not check sent_status
+        await storage.transmittals.insert(sent_transmittal(3, 5, sent_status="Not Sent"))
+        await storage.close()
+
+        storage = SQLiteStorage(path)
+        await storage.initialize()
+        try:
+            due = {t: (await storage.transmittals.get(t)).get("ack_due_at") for t in ("t-1", "t-2", "t-3")}
+        finally:
+            await storage.close()
+        return due
+
+    due = asyncio.run(main())
+    assert due["t-1"] == NOW - timedelta(days=30) + timedelta(days=ACK_DUE_DAYS)
+    assert due["t-2"] is None and due["t-3"] is None
@@ -0,0 +1,608 @@
+"""
+Conformance tests every storage backend must pass.
+
+The SQLite backend always runs. The Mongo backend runs when MONGO_URL is
+set, against a throwaway database that is dropped afterwards.
+"""
+
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from storage import transmittal_as_of, transmittal_history
+from storage.sqlite import SQLiteStorage
+
+BASE_TIME = datetime(2024, 1, 15, 9, 0, 0)
+
+
+def at(minutes: float) -> datetime:
+    # Millisecond precision, which is what BSON datetimes keep
+    return BASE_TIME + timedelta(milliseconds=int(minutes * 60000))
+
+
+def recent(minutes: float) -> datetime:
+    # Status checks expire, so they need timestamps inside the retention
+    # window; aligned to a 3 minute boundary so rate buckets are predictable
+    now = int(datetime.utcnow().timestamp()) // 180 * 180 - 3600
+    return datetime.utcfromtimestamp(now) + timedelta(milliseconds=int(minutes * 60000))
+
+
+def make_transmittal(n: int, **overrides) -> dict:
+    transmittal = {
+        "id": f"t-{n}",
+        "transmittal_number": None,
+        "transmittal_type": "Drawing",
+        "department": "Architecture",
+        "design_stage": "Schematic Design",
+        "transmittal_date": "2024-01-15",
+        "send_to": "Client",
+        "salutation": "Mr",
+        "recipient_name": "John Anderson",
+        "sender_name": "Sarah Wilson",
+        "sender_designation": "Project Architect",
+        "send_mode": "Softcopy",
+        "documents": [
+            {"document_no": f"A-{i:03d}", "title": f"Sheet {i}", "revision": 1, "copies": 1, "action": "for approval"}
+            for i in range(3)
+        ],
+        "title": f"Transmittal {n}",
+        "project_name": "Greenfield",
+        "status": "draft",
+        "document_count": 3,
+        "created_date": at(n),
+        "updated_at": at(n),
+        "version": 1,
+        "send_details": None,
+        "receive_details": None,
+    }
+    transmittal.update(overrides)
+    return transmittal
+
+
+@pytest.fixture(params=["sqlite", "mongo"])
+def make_storage(request, tmp_path):
+    if request.param == "sqlite":
+        yield lambda: SQLiteStorage(str(tmp_path / "conformance.db"))
+        return
+
+    mongo_url = os.environ.get("MONGO_URL")
+    if not mongo_url:
+        pytest.skip("MONGO_URL not set")
+    from pymongo import MongoClient
+    from storage.mongo import MongoStorage
+
+    db_name = f"conformance_{uuid.uuid4().hex[:12]}"
+    yield lambda: MongoStorage(mongo_url, db_name)
+    MongoClient(mongo_url).drop_database(db_name)
+
+
+def run(make_storage, scenario):
+    async def main():
+        storage = make_storage()
+        await storage.initialize()
+        try:
+            await scenario(storage)
+        finally:
+            await storage.close()
+    asyncio.run(main())
+
+
+def test_get_views(make_storage):
+    async def scenario(storage):
+        await storage.transmittals.insert(make_transmittal(
+            1, receive_details={"receipt_file": "aGVsbG8=", "received_date": "2024-01-20", "received_time": "10:00"}
+        ))
+
+        full = await storage.transmittals.get("t-1")
+        assert full["title"] == "Transmittal 1"
+        assert full["created_date"] == at(1)
+        assert len(full["documents"]) == 3
+        assert "_id" not in full
+
+        summary = await storage.transmittals.get("t-1", view="summary")
+        assert "documents" not in summary
+        assert summary["receive_details"] == {"received_date": "2024-01-20", "received_time": "10:00"}
+
+        await storage.transmittals.update("t-1", {
+            "receive_details.receipt_optimized": "b3B0aW1pemVk",
+            "receive_details.receipt_thumbnail": "dGh1bWI=",
+        })
+        summary = await storage.transmittals.get("t-1", view="summary")
+        assert summary["receive_details"] == {"received_date": "2024-01-20", "received_time": "10:00"}
+        full = await storage.transmittals.get("t-1")
+        assert full["receive_details"]["receipt_file"] == "aGVsbG8="
+        assert full["receive_details"]["receipt_optimized"] == "b3B0aW1pemVk"
+        assert full["receive_details"]["receipt_thumbnail"] == "dGh1bWI="
+
+        version = await storage.transmittals.get("t-1", view="version")
+        assert version == {"id": "t-1", "version": 2, "status": "draft"}
+
+        assert await storage.transmittals.get("missing") is None
+    run(make_storage, scenario)
+
+
+def test_list_filters_and_order(make_storage):
+    async def scenario(storage):
+        await storage.transmittals.insert(make_transmittal(1))
+        await storage.transmittals.insert(make_transmittal(2, department="MEP"))
+        await storage.transmittals.insert(make_transmittal(3, status="sent"))
+        await storage.transmittals.insert(make_transmittal(4, department="MEP", status="sent"))
+
+        page = await storage.transmittals.list({}, 0, 10)
+        assert [t["id"] for t in page] == ["t-4", "t-3", "t-2", "t-1"]
+        page = await storage.transmittals.list({}, 1, 2, view="summary")
+        assert [t["id"] for t in page] == ["t-3", "t-2"]
+        assert all("documents" not in t for t in page)
+
+        page = await storage.transmittals.list({"department": ["MEP"], "status": ["all"]}, 0, 10)
+        assert [t["id"] for t in page] == ["t-4", "t-2"]
+        page = await storage.transmittals.list({"department": ["MEP", "Architecture"], "status": ["sent"]}, 0, 10)
+        assert [t["id"] for t in page] == ["t-4", "t-3"]
+
+        assert await storage.transmittals.count({}) == 4
+        assert await storage.transmittals.count({"status": ["sent"], "department": ["MEP"]}) == 1
+        assert await storage.transmittals.count_issued() == 2
+    run(make_storage, scenario)
+
+
+def test_facets(make_storage):
+    async def scenario(storage):
+        await storage.transmittals.insert(make_transmittal(1))
+        await storage.transmittals.insert(make_transmittal(2, department="MEP", design_stage=None))
+        await storage.transmittals.insert(make_transmittal(3, department="MEP", status="sent"))
+
+        total, facets = await storage.transmittals.facets({})
+        assert total == 3
+        assert dict(facets["department"]) == {"MEP": 2, "Architecture": 1}
+        assert facets["department"][0] == ("MEP", 2)
+        assert dict(facets["design_stage"]) == {"Schematic Design": 2, None: 1}
+
+        # A field's counts ignore its own filter but apply the others
+        total, facets = await storage.transmittals.facets({"status": ["draft"]})
+        assert total == 2
+        assert dict(facets["status"]) == {"draft": 2, "sent": 1}
+        assert dict(facets["department"]) == {"MEP": 1, "Architecture": 1}
+
+        total, facets = await storage.transmittals.facets({"department": ["MEP"], "status": ["sent"]})
+        assert total == 1
+        assert dict(facets["department"]) == {"MEP": 1}
+        assert dict(facets["status"]) == {"draft": 1, "sent": 1}
+        assert dict(facets["design_stage"]) == {"Schematic Design": 1}
+
+        total, facets = await storage.transmittals.facets({"department": ["Landscape"]})
+        assert total == 0
+        assert dict(facets["department"]) == {"MEP": 2, "Architecture": 1}
+        assert facets["status"] == []
+    run(make_storage, scenario)
+
+
+def test_get_many(make_storage):
+    async def scenario(storage):
+        for n in range(1, 4):
+            await storage.transmittals.insert(make_transmittal(n))
+        found = await storage.transmittals.get_many(["t-3", "missing", "t-1"], view="summary")
+        assert sorted(t["id"] for t in found) == ["t-1", "t-3"]
+        assert await storage.transmittals.get_many([]) == []
+    run(make_storage, scenario)
+
+
+def test_update_bumps_version_and_honours_expected_version(make_storage):
+    async def scenario(storage):
+        await storage.transmittals.insert(make_transmittal(1))
+
+        updated = await storage.transmittals.update("t-1", {"title": "Renamed", "updated_at": at(10)})
+        assert updated["title"] == "Renamed"
+        assert updated["version"] == 2
+        assert len(updated["documents"]) == 3
+
+        assert await storage.transmittals.update("t-1", {"title": "Stale"}, expected_version=1) is None
+        pinned = await storage.transmittals.update("t-1", {"status": "generated"}, expected_version=2, view="version")
+        assert pinned == {"id": "t-1", "version": 3, "status": "generated"}
+
+        assert await storage.transmittals.update("missing", {"title": "x"}) is None
+        assert (await storage.transmittals.get("t-1"))["title"] == "Renamed"
+    run(make_storage, scenario)
+
+
+
+def test_update_matching_fields_and_pending_receipts(make_storage):
+    async def scenario(storage):
+        pending = {"receipt_file": "eA==", "receipt_status": "pending", "receipt_id": "r-1"}
+        await storage.transmittals.insert(make_transmittal(1, receive_details=pending))
+        await storage.transmittals.insert(make_transmittal(2, receive_details={**pending, "receipt_status": "ready"}))
+        await storage.transmittals.insert(make_transmittal(3))
+        assert await storage.transmittals.pending_receipts(10) == [("t-1", "r-1")]
+
+        await storage.transmittals.update("t-1", {"title": "Renamed"})
+        match = {"receive_details.receipt_id": "r-1", "receive_details.receipt_status": "pending"}
+        assert await storage.transmittals.update(
+            "t-1", {"receive_details.receipt_status": "ready"}, match={**match, "receive_details.receipt_id": "r-0"}
+        ) is None
+        updated = await storage.transmittals.update("t-1", {"receive_details.receipt_status": "ready"}, match=match)
+        assert updated["version"] == 3
+        assert updated["receive_details"]["receipt_status"] == "ready"
+        assert await storage.transmittals.pending_receipts(10) == []
+    run(make_storage, scenario)
+
+def test_changes_and_tombstones(make_storage):
+    async def scenario(storage):
+        for n in range(1, 4):
+            await storage.transmittals.insert(make_transmittal(n))
+        await storage.transmittals.update("t-1", {"title": "Touched", "updated_at": at(20)})
+        await storage.transmittals.delete("t-2", at(15))
+
+        assert await storage.transmittals.get("t-2") is None
+        changed = await storage.transmittals.changed_since(at(2), 10)
+        assert [t["id"] for t in changed] == ["t-3", "t-1"]
+        assert changed[1]["updated_at"] == at(20)
+        assert [t["id"] for t in await storage.transmittals.changed_since(datetime.min, 1)] == ["t-3"]
+
+        deleted = await storage.transmittals.deleted_since(at(10), 10)
+        assert deleted == [{"id": "t-2", "deleted_at": at(15)}]
+        assert await storage.transmittals.deleted_since(at(15), 10) == []
+
+        # Rows sharing a timestamp page on id, so none are skipped
+        for n in range(4, 8):
+            await storage.transmittals.insert(make_transmittal(n, updated_at=at(30)))
+        await storage.transmittals.delete("t-6", at(30))
+        await storage.transmittals.delete("t-9", at(30))
+        page = await storage.transmittals.changed_since(at(30), 2, "t-4")
+        assert [t["id"] for t in page] == ["t-5", "t-7"]
+        assert await storage.transmittals.changed_since(at(30), 2, "t-7") == []
+        assert [t["id"] for t in await storage.transmittals.changed_since(at(20), 10)] == ["t-4", "t-5", "t-7"]
+        deleted = await storage.transmittals.deleted_since(at(30), 10, "t-6")
+        assert deleted == [{"id": "t-9", "deleted_at": at(30)}]
+    run(make_storage, scenario)
+
+
+def test_document_subresource(make_storage):
+    async def scenario(storage):
+        await storage.transmittals.insert(make_transmittal(1))
+        await storage.transmittals.insert(make_transmittal(2, status="generated"))
+
+        total, page = await storage.transmittals.get_documents("t-1", 1, 5)
+        assert total == 3
+        assert [d["document_no"] for d in page] == ["A-001", "A-002"]
+        assert await storage.transmittals.get_documents("missing", 0, 5) is None
+
+        new_document = {"document_no": "B-001", "title": "Detail", "revision": 0, "copies": 2, "action": "for info"}
+        pushed = await storage.transmittals.push_documents("t-1", [new_document], at(30))
+        assert pushed["version"] == 2
+        assert await storage.transmittals.push_documents("t-1", [new_document], at(31)) is None
+        assert await storage.transmittals.push_documents("t-2", [new_document], at(31)) is None
+        assert await storage.transmittals.has_document("t-1", "B-001")
+        assert not await storage.transmittals.has_document("t-1", "Z-999")
+
+        updated, document = await storage.transmittals.update_document("t-1", "B-001", {"revision": 1}, at(32))
+        assert updated["version"] == 3
+        assert document == dict(new_document, revision=1)
+        assert await storage.transmittals.update_document("t-1", "B-001", {"document_no": "A-000"}, at(33)) is None
+        assert await storage.transmittals.update_document("t-1", "Z-999", {"revision": 1}, at(33)) is None
+        _, renamed = await storage.transmittals.update_document("t-1", "B-001", {"document_no": "B-002"}, at(33))
+        assert renamed["document_no"] == "B-002"
+
+        pulled = await storage.transmittals.pull_document("t-1", "A-000", at(34))
+        assert pulled["version"] == 5
+        assert await storage.transmittals.pull_document("t-1", "A-000", at(35)) is None
+
+        transmittal = await storage.transmittals.get("t-1")
+        assert transmittal["document_count"] == 3
+        assert [d["document_no"] for d in transmittal["documents"]] == ["A-001", "A-002", "B-002"]
+        assert transmittal["updated_at"] == at(34)
+    run(make_storage, scenario)
+
+
+def test_status_checks(make_storage):
+    async def scenario(storage):
+        for n in range(5):
+            await storage.status_checks.insert({"id": f"s-{n}", "client_name": "probe-a", "timestamp": recent(n)})
+        # Two checks sharing a timestamp must still page cleanly
+        await storage.status_checks.insert({"id": "s-9", "client_name": "probe-b", "timestamp": recent(4)})
+
+        first = await storage.status_checks.list(None, None, 3)
+        assert [s["id"] for s in first] == ["s-9", "s-4", "s-3"]
+        assert first[0]["timestamp"] == recent(4)
+        rest = await storage.status_checks.list(None, (first[-1]["timestamp"], first[-1]["id"]), 10)
+        assert [s["id"] for s in rest] == ["s-2", "s-1", "s-0"]
+
+        only_b = await storage.status_checks.list("probe-b", None, 10)
+        assert [s["id"] for s in only_b] == ["s-9"]
+
+        streamed = [s["id"] async for s in storage.status_checks.iterate(None, None, None)]
+        assert streamed == ["s-9", "s-4", "s-3", "s-2", "s-1", "s-0"]
+        limited = [s["id"] async for s in storage.status_checks.iterate("probe-a", None, 2)]
+        assert limited == ["s-4", "s-3"]
+
+        rates = await storage.status_checks.rates(recent(0), recent(10), 180, None)
+        assert rates == [
+            ("probe-a", recent(0), 3),
+            ("probe-a", recent(3), 2),
+            ("probe-b", recent(3), 1),
+        ]
+        assert await storage.status_checks.rates(recent(0), recent(10), 180, "probe-b") == [("probe-b", recent(3), 1)]
+    run(make_storage, scenario)
+
+
+def test_idempotency_keys(make_storage):
+    async def scenario(storage):
+        record = {"key": "k-1", "scope": "POST /transmittals", "request_hash": "abc",
+                  "state": "pending", "created_at": datetime.utcnow()}
+        assert await storage.idempotency_keys.claim(record)
+        assert not await storage.idempotency_keys.claim(dict(record, request_hash="other"))
+        assert (await storage.idempotency_keys.get("k-1"))["state"] == "pending"
+
+        await storage.idempotency_keys.complete("k-1", 200, {"id": "t-1"}, {"ETag": '"t-1-1"'})
+        stored = await storage.idempotency_keys.get("k-1")
+        assert stored["state"] == "done"
+        assert stored["response"] == {"id": "t-1"}
+        assert stored["headers"] == {"ETag": '"t-1-1"'}
+
+        # Completed keys are kept; only pending ones can be released
+        await storage.idempotency_keys.release("k-1")
+        assert await storage.idempotency_keys.get("k-1") is not None
+        assert await storage.idempotency_keys.claim(dict(record, key="k-2"))
+        await storage.idempotency_keys.release("k-2")
+        assert await storage.idempotency_keys.get("k-2") is None
+
+        # An expired lease on a pending key is taken over by the same request only
+        now = datetime.utcnow()
+        leased = dict(record, key="k-3", lease_id="l-1", locked_until=now + timedelta(minutes=5), created_at=now)
+        assert await storage.idempotency_keys.claim(leased)
+        retry = dict(leased, lease_id="l-2", locked_until=now + timedelta(minutes=10), created_at=now + timedelta(minutes=1))
+        assert not await storage.idempotency_keys.claim(retry)
+        later = now + timedelta(minutes=6)
+        assert not await storage.idempotency_keys.claim(dict(retry, request_hash="other", created_at=later))
+        assert await storage.idempotency_keys.claim(dict(retry, created_at=later))
+        assert (await storage.idempotency_keys.get("k-3"))["lease_id"] == "l-2"
+        # The request that lost the lease cannot release the key from under the new one
+        await storage.idempotency_keys.release("k-3", "l-1")
+        assert await storage.idempotency_keys.get("k-3") is not None
+        await storage.idempotency_keys.release("k-3", "l-2")
+        assert await storage.idempotency_keys.get("k-3") is None
+    run(make_storage, scenario)
+
+
+def test_outbox(make_storage):
+    async def scenario(storage):
+        await storage.transmittals.insert(make_transmittal(1, status="generated"))
+        now = datetime.utcnow().replace(microsecond=0)
+        messages = [
+            {"id": f"m-{n}", "transmittal_id": "t-1", "channel": "email", "recipient": f"r{n}@example.com",
+             "subject": "Transmittal", "body": "...", "state": "pending", "attempts": 0,
+             "next_attempt_at": now + timedelta(seconds=n), "created_at": now + timedelta(seconds=n)}
+            for n in range(3)
+        ]
+
+        # A stale version queues nothing and changes nothing
+        assert await storage.outbox.enqueue("t-1", {"status": "sent"}, messages, expected_version=7) is None
+        assert await storage.outbox.list("t-1") == []
+        updated = await storage.outbox.enqueue("t-1", {"status": "sent"}, messages, expected_version=1)
+        assert updated == {"id": "t-1", "version": 2, "status": "sent"}
+
+        claimed = await storage.outbox.claim(now + timedelta(seconds=1), 10, 60)
+        assert [m["id"] for m in claimed] == ["m-0", "m-1"]
+        assert all(m["state"] == "sending" and m["attempts"] == 1 for m in claimed)
+        # Leased messages are not handed out twice
+        assert [m["id"] for m in await storage.outbox.claim(now + timedelta(seconds=5), 10, 60)] == ["m-2"]
+
+        await storage.outbox.mark_sent(["m-0"], now + timedelta(seconds=6))
+        await storage.outbox.mark_failed("m-1", "mailbox busy", now + timedelta(seconds=30))
+        await storage.outbox.mark_failed("m-2", "no such user", None)
+
+        states = {m["id"]: m for m in await storage.outbox.list("t-1")}
+        assert states["m-0"]["state"] == "sent"
+        assert states["m-0"]["sent_at"] == now + timedelta(seconds=6)
+        assert states["m-1"]["state"] == "pending"
+        assert states["m-1"]["last_error"] == "mailbox busy"
+        assert states["m-2"]["state"] == "dead"
+
+        assert await storage.outbox.claim(now + timedelta(seconds=29), 10, 60) == []
+        retried = await storage.outbox.claim(now + timedelta(seconds=30), 10, 60)
+        assert [(m["id"], m["attempts"]) for m in retried] == [("m-1", 2)]
+        # An expired lease makes the message claimable again
+        reclaimed = await storage.outbox.claim(now + timedelta(seconds=91), 10, 60)
+        assert [(m["id"], m["attempts"]) for m in reclaimed] == [("m-1", 3)]
+    run(make_storage, scenario)
+
+
+def test_overdue_and_reminders(make_storage):
+    async def scenario(storage):
+        now = datetime.utcnow().replace(microsecond=0)
+
+        def awaiting(n, days_overdue, **overrides):
+            due = now - timedelta(days=days_overdue)
+            return make_transmittal(n, status="sent", ack_due_at=due, next_reminder_at=due, **overrides)
+        await storage.transmittals.insert(awaiting(1, 2))
+        await storage.transmittals.insert(awaiting(2, 5, recipient_email="john@example.com"))
+        await storage.transmittals.insert(awaiting(3, -1))
+        await storage.transmittals.insert(make_transmittal(4, status="received", ack_due_at=None))
+        await storage.transmittals.insert(make_transmittal(5))
+
+        overdue = await storage.transmittals.overdue(now, 0, 10)
+        assert [t["id"] for t in overdue] == ["t-2", "t-1"]
+        assert "documents" not in overdue[0]
+        assert [t["id"] for t in await storage.transmittals.overdue(now, 1, 10)] == ["t-1"]
+        assert [t["id"] for t in await storage.transmittals.reminders_due(now, 0, 10)] == ["t-2", "t-1"]
+        assert [t["id"] for t in await storage.transmittals.reminders_due(now, 0, 10, addressed_only=True)] == ["t-2"]
+
+        composed = []
+        def compose(due):
+            composed.append(sorted(t["id"] for t in due))
+            return [{"id": "r-1", "transmittal_id": due[0]["id"], "channel": "email", "recipient": "a@example.com",
+                     "subject": "Reminder", "body": "...", "state": "pending", "attempts": 0,
+                     "next_attempt_at": now, "created_at": now}]
+
+        later = now + timedelta(days=3)
+        reminded = await storage.outbox.enqueue_reminders(
+            ["t-1", "t-2", "t-3"], now, {"next_reminder_at": later, "last_reminded_at": now}, compose
+        )
+        assert sorted(reminded) == ["t-1", "t-2"]
+        assert composed == [["t-1", "t-2"]]
+        reminded_about = await storage.transmittals.get("t-1")
+        assert reminded_about["next_reminder_at"] == later
+        assert reminded_about["ack_due_at"] == now - timedelta(days=2)
+        assert (await storage.transmittals.get("t-2", view="version"))["version"] == 2
+        assert (await storage.transmittals.get("t-3", view="version"))["version"] == 1
+        assert len(await storage.outbox.claim(now, 10, 60)) == 1
+        assert await storage.transmittals.reminders_due(now, 0, 10) == []
+        # Still overdue, by the date acknowledgement was due
+        assert [t["id"] for t in await storage.transmittals.overdue(now, 0, 10)] == ["t-2", "t-1"]
+
+        # A second scanner arriving late finds nothing to remind about
+        assert await storage.outbox.enqueue_reminders(["t-1", "t-2"], now, {"last_reminded_at": now}, compose) == []
+        assert len(composed) == 1
+    run(make_storage, scenario)
+
+
+def test_audit_history_and_as_of(make_storage, monkeypatch):
+    monkeypatch.setattr("storage.audit.AUDIT_SNAPSHOT_INTERVAL", 3)
+
+    async def scenario(storage):
+        await storage.transmittals.insert(make_transmittal(1))
+        await storage.transmittals.push_documents(
+            "t-1", [{"document_no": "A-100", "title": "Sheet 100", "revision": 1, "copies": 1}], at(2)
+        )
+        await storage.transmittals.update_document("t-1", "A-000", {"title": "Cover"}, at(3))
+        await storage.transmittals.pull_document("t-1", "A-001", at(4))
+        await storage.transmittals.update(
+            "t-1", {"status": "generated", "updated_at": at(5)}, view="version", action="generate"
+        )
+        await storage.transmittals.update("t-1", {
+            "receive_details": {"receipt_file": "aGVsbG8=", "received_date": "2024-01-20"},
+            "updated_at": at(6),
+        }, view="version", action="receive")
+        await storage.transmittals.delete("t-1", at(7))
+
+        events = await transmittal_history(storage.audit, "t-1", 0, 100)
+        assert [(e["version"], e["action"]) for e in events] == [
+            (1, "create"), (2, "add_documents"), (3, "update_document"), (4, "remove_document"),
+            (5, "generate"), (6, "receive"), (7, "delete"),
+        ]
+        assert events[0]["diff"]["title"] == {"from": None, "to": "Transmittal 1"}
+        assert events[1]["diff"]["documents"] == {"added": ["A-100"], "removed": [], "changed": []}
+        assert events[2]["diff"]["documents"] == {"added": [], "removed": [], "changed": ["A-000"]}
+        assert events[3]["diff"]["document_count"] == {"from": 4, "to": 3}
+        assert events[4]["diff"] == {
+            "status": {"from": "draft", "to": "generated"},
+            "updated_at": {"from": at(4), "to": at(5)},
+        }
+        assert events[5]["changes"]["set"]["receive_details"] == {"received_date": "2024-01-20"}
+
+        # A later page still gets diffs, replayed from the nearest snapshot
+        page = await transmittal_history(storage.audit, "t-1", 3, 2)
+        assert [e["version"] for e in page] == [4, 5]
+        assert page[0]["diff"]["documents"]["removed"] == ["A-001"]
+        assert (await storage.audit.snapshot("t-1", 5))["version"] == 3
+        assert (await storage.audit.snapshot("t-1", 7))["version"] == 6
+
+        assert await transmittal_as_of(storage.audit, "t-1", at(0)) is None
+        edited = await transmittal_as_of(storage.audit, "t-1", at(4.5))
+        assert (edited["version"], edited["status"], edited["document_count"]) == (4, "draft", 3)
+        assert [d["document_no"] for d in edited["documents"]] == ["A-000", "A-002", "A-100"]
+        assert edited["documents"][0]["title"] == "Cover"
+        received = await transmittal_as_of(storage.audit, "t-1", at(6))
+        assert (received["version"], received["status"]) == (6, "generated")
+        assert received["receive_details"] == {"received_date": "2024-01-20"}
+        assert await transmittal_as_of(storage.audit, "t-1", at(8)) is None
+    run(make_storage, scenario)
+
+
+def test_document_issues(make_storage):
+    async def scenario(storage):
+        def issued(n, revision, **overrides):
+            transmittal = make_transmittal(n, **{
+                "status": "generated", "generated_date": at(n), "transmittal_number": f"TRN-{n}",
+                "recipient_email": f"r{n}@example.com", **overrides,
+            })
+            transmittal["documents"][0]["revision"] = revision
+            return transmittal
+
+        first, second = issued(1, 1), issued(2, 2, recipient_email="R1@example.com")
+        for transmittal in (first, second, make_transmittal(3)):
+            await storage.transmittals.insert(transmittal)
+        await storage.document_issues.index(first)
+        await storage.document_issues.index(second)
+
+        issues = await storage.document_issues.list("A-000")
+        assert [(i["transmittal_id"], i["revision"]) for i in issues] == [("t-2", 2), ("t-1", 1)]
+        assert issues[1]["recipient_email"] == "r1@example.com"
+        assert issues[1]["issued_at"] == at(1)
+        assert issues[1]["status"] == "generated"
+        assert len(await storage.document_issues.list("A-001")) == 2
+        assert await storage.document_issues.list("missing") == []
+
+        await storage.document_issues.update_transmittal("t-1", {
+            "status": "sent", "sent_status": "Sent", "send_details": {"send_date": "2024-01-16T09:00:00"},
+            "updated_at": at(10),
+        })
+        await storage.document_issues.update_transmittal("t-2", {"receive_details.received_date": "2024-01-20"})
+        issues = await storage.document_issues.list("A-000")
+        assert (issues[1]["status"], issues[1]["sent_status"], issues[1]["sent_date"]) == (
+            "sent", "Sent", "2024-01-16T09:00:00"
+        )
+        assert issues[0]["received_date"] == "2024-01-20"
+
+        # Indexing again replaces rather than duplicates
+        await storage.document_issues.index(first)
+        assert len(await storage.document_issues.list("A-000")) == 2
+
+        # Rebuild reads the transmittals; only the issued ones count
+        await storage.transmittals.update("t-1", {"status": "sent"})
+        assert await storage.document_issues.rebuild() == 6
+        issues = await storage.document_issues.list("A-000")
+        assert [(i["transmittal_id"], i["status"]) for i in issues] == [("t-2", "generated"), ("t-1", "sent")]
+        assert issues[0]["title"] == "Sheet 0"
+
+        # Saved before repeated numbers were rejected: one row per number,
+        # the highest revision, from index and rebuild alike
+        legacy = issued(4, 1)
+        legacy["documents"] += [
+            {"document_no": "A-000", "title": "Reissued", "revision": 3, "copies": 1, "action": "for approval"},
+            {"document_no": "A-000", "title": "Older", "revision": 2, "copies": 1, "action": "for approval"},
+        ]
+        await storage.transmittals.insert(legacy)
+        await storage.document_issues.index(legacy)
+        for _ in range(2):
+            rows = [i for i in await storage.document_issues.list("A-000") if i["transmittal_id"] == "t-4"]
+            assert [(i["revision"], i["title"]) for i in rows] == [(3, "Reissued")]
+            assert await storage.document_issues.rebuild() == 9
+    run(make_storage, scenario)
+
+
+def test_iterate_transmittals(make_storage):
+    async def scenario(storage):
+        # Pairs share a created_date, so batches must not split or repeat ties
+        for n in range(1, 1201):
+            await storage.transmittals.insert(make_transmittal(
+                n, created_date=at(n // 2), department="Civil" if n % 3 == 0 else "Architecture"
+            ))
+
+        expected = [t["id"] for t in await storage.transmittals.list({}, 0, 2000, view="version")]
+        streamed = [t async for t in storage.transmittals.iterate({}, 0, None, view="summary")]
+        assert len(streamed) == 1200
+        assert len({t["id"] for t in streamed}) == 1200
+        assert "documents" not in streamed[0]
+        dates = [t["created_date"] for t in streamed]
+        assert dates == sorted(dates, reverse=True)
+        assert {t["id"] for t in streamed} == set(expected)
+
+        civil = [t async for t in storage.transmittals.iterate({"department": ["Civil"]}, 10, 550)]
+        assert len(civil) == 390
+        assert all(t["department"] == "Civil" and len(t["documents"]) == 3 for t in civil)
+
+        limited = [t async for t in storage.transmittals.iterate({}, 5, 501, view="version")]
+        assert len({t["id"] for t in limited}) == 501
+        assert limited[0]["id"] != streamed[0]["id"]
+    run(make_storage, scenario)
+
+
+def test_readiness_checks(make_storage):
+    async def scenario(storage):
+        await storage.ping()
+        await storage.warm_up(3)
+        assert await storage.missing_indexes() == []
+        assert isinstance(storage.pool_stats(), dict)
+    run(make_storage, scenario)
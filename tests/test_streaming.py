@@ -0,0 +1,60 @@
+import asyncio
+import json
+import zlib
+
+import pytest
+from pydantic import BaseModel
+
+import streaming
+from streaming import compressed, ndjson_chunks, negotiate_encoding
+
+
+class Item(BaseModel):
+    id: str
+    n: int
+
+
+async def items(count):
+    for n in range(count):
+        yield {"id": f"i-{n}", "n": n, "ignored": True}
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_negotiate_encoding(monkeypatch):
+    monkeypatch.setattr(streaming, "brotli", None)
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("br, gzip;q=0.5") == "gzip"
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("*") == "gzip"
+
+    monkeypatch.setattr(streaming, "brotli", object())
+    assert negotiate_encoding("gzip, br") == "br"
+    assert negotiate_encoding("br;q=0.4, gzip;q=0.8") == "gzip"
+
+
+def test_ndjson_chunks_are_bounded_and_validated(monkeypatch):
+    monkeypatch.setattr(streaming, "NDJSON_CHUNK_BYTES", 100)
+    chunks = asyncio.run(collect(ndjson_chunks(items(50), Item)))
+    assert len(chunks) > 1
+    assert all(len(chunk) < 200 for chunk in chunks)
+    lines = b"".join(chunks).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [{"id": f"i-{n}", "n": n} for n in range(50)]
+
+
+def test_gzip_stream_decompresses_to_the_original():
+    plain = b"".join(asyncio.run(collect(ndjson_chunks(items(2000), Item))))
+    gzipped = b"".join(asyncio.run(collect(compressed(ndjson_chunks(items(2000), Item), "gzip"))))
+    assert zlib.decompress(gzipped, 31) == plain
+    assert len(gzipped) < len(plain) / 4
+
+
+def test_brotli_stream_decompresses_to_the_original():
+    brotli = pytest.importorskip("brotli")
+    plain = b"".join(asyncio.run(collect(ndjson_chunks(items(2000), Item))))
+    compressed_body = b"".join(asyncio.run(collect(compressed(ndjson_chunks(items(2000), Item), "br"))))
+    assert brotli.decompress(compressed_body) == plain
@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+from storage.sqlite import SQLiteStorage
+from tracing import SQLiteCallTracer, SpanExporter, span, start_trace
+
+
+def test_spans_nest_and_server_timing_counts_round_trips():
+    with start_trace("GET /api/transmittals") as trace:
+        with span("handler") as handler_id:
+            with span("lookup", kind="db"):
+                pass
+            with span("lookup", kind="db"):
+                pass
+
+    by_name = {}
+    for recorded in trace.spans:
+        by_name.setdefault(recorded["name"], []).append(recorded)
+    assert [s["parent_id"] for s in by_name["lookup"]] == [handler_id, handler_id]
+    assert by_name["handler"][0]["parent_id"] is None
+    assert trace.db_round_trips == 2
+    assert 'db;dur=' in trace.server_timing()
+    assert 'desc="2 round trips"' in trace.server_timing()
+
+
+def test_spans_outside_a_trace_are_ignored():
+    with span("handler") as span_id:
+        assert span_id is None
+
+
+def test_sqlite_calls_are_recorded_in_the_request_trace(tmp_path):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / "traced.db"), listeners=[SQLiteCallTracer()])
+        await storage.initialize()
+        try:
+            with start_trace("GET /api/transmittals/count") as trace:
+                await storage.transmittals.count({})
+                await storage.transmittals.get("missing", view="version")
+            # Calls outside a request are not attributed to it
+            await storage.transmittals.count({})
+        finally:
+            await storage.close()
+        return trace
+
+    trace = asyncio.run(main())
+    assert trace.db_round_trips == 2
+    assert [s["name"] for s in trace.spans] == ["sqlite.read", "sqlite.read"]
+    assert trace.spans[1]["call"] == "get"
+    assert trace.spans[1]["statements"] == 1
+
+
+def test_exporter_writes_json_lines(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    exporter = SpanExporter(path=str(path), collector_url=None)
+    for name in ("GET /a", "GET /b"):
+        with start_trace(name) as trace:
+            with span("handler"):
+                pass
+        exporter.export(trace)
+    exporter.close()
+
+    traces = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [t["name"] for t in traces] == ["GET /a", "GET /b"]
+    assert traces[0]["spans"][0]["name"] == "handler"
+
+
+def test_exporter_is_off_without_a_sink():
+    exporter = SpanExporter(path=None, collector_url=None)
+    with start_trace("GET /a") as trace:
+        pass
+    exporter.export(trace)
+    assert exporter._thread is None